@@ -3,6 +3,9 @@ ASGI config for project project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Requests to /events/ are served by the Server-Sent Events application of
+volleyballschool (see volleyballschool/events.py), the others by Django.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 """
@@ -13,4 +16,18 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# импортируется после настройки Django в get_asgi_application()
+from volleyballschool.events import (EVENTS_PATH_PREFIX,  # noqa: E402
+                                     sse_application)
+
+
+async def application(scope, receive, send):
+    if (
+        scope['type'] == 'http'
+        and scope['path'].startswith(EVENTS_PATH_PREFIX)
+    ):
+        await sse_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 from .utils import generate_secret_key_into_secret_key_file
 
@@ -30,9 +31,17 @@ except ModuleNotFoundError:
     from .secret_key import SECRET_KEY
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
-
-ALLOWED_HOSTS = []
+# По умолчанию DEBUG выключен, поэтому без DJANGO_DEBUG=1 runserver не
+# раздаёт static и media и показывает страницу 500 без трассировки. Для
+# разработки:
+#     DJANGO_DEBUG=1 python manage.py runserver
+# панель django-debug-toolbar дополнительно включается DJANGO_DEBUG_TOOLBAR=1
+DEBUG = os.environ.get('DJANGO_DEBUG') == '1'
+DEBUG_TOOLBAR = DEBUG and os.environ.get('DJANGO_DEBUG_TOOLBAR') == '1'
+
+ALLOWED_HOSTS = os.environ.get(
+    'DJANGO_ALLOWED_HOSTS', 'localhost,127.0.0.1',
+).split(',')
 INTERNAL_IPS = [
     '127.0.0.1',
 ]
@@ -51,12 +60,14 @@ INSTALLED_APPS = [
 
     'ckeditor',
     'ckeditor_uploader',  # редактор статей в админке
-    'debug_toolbar',
 
     'volleyballschool.apps.VolleyballschoolConfig',
 ]
 
 MIDDLEWARE = [
+    # первым, чтобы учитывать время остальных промежуточных слоёв
+    'volleyballschool.metrics.MetricsMiddleware',
+    'volleyballschool.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -64,10 +75,14 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
 ]
 
+# панель отладки только для разработки, под нагрузкой используйте
+# профилировщик запросов: manage.py profiling on
+if DEBUG_TOOLBAR:
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE.append('debug_toolbar.middleware.DebugToolbarMiddleware')
+
 ROOT_URLCONF = 'project.urls'
 
 TEMPLATES = [
@@ -100,6 +115,20 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# Кэш расписания и версия цен, хранимых в памяти процессов, сбрасываются
+# сигналами. При запуске нескольких процессов используйте общий для всех
+# процессов бэкенд (Memcached, Redis и т.п.)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'volleyballschool',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -151,5 +180,22 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_ROOT = BASE_DIR / 'media'
 MEDIA_URL = '/media/'
 
+# Адреса сборщиков метрик /metrics/, например '10.0.0.5,10.0.0.6'. По
+# умолчанию метрики видны только сотрудникам: за прокси на том же сервере у
+# всех запросов REMOTE_ADDR 127.0.0.1, поэтому INTERNAL_IPS не подходит
+
+METRICS_ALLOWED_IPS = [
+    ip for ip in os.environ.get('DJANGO_METRICS_ALLOWED_IPS', '').split(',')
+    if ip
+]
+
+# Профили запросов, см. volleyballschool.profiling. Каталог в checkout
+# (/profiles/) не отслеживается git, в production лучше задать
+# DJANGO_PROFILING_DIR вне каталога проекта
+
+PROFILING_DIR = Path(
+    os.environ.get('DJANGO_PROFILING_DIR', BASE_DIR / 'profiles')
+)
+
 CKEDITOR_UPLOAD_PATH = "uploads/"
 CKEDITOR_ALLOW_NONIMAGE_FILES = False
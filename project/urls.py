@@ -13,8 +13,6 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-import debug_toolbar
-
 from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
@@ -25,11 +23,15 @@ urlpatterns = [
     path('admin/', admin.site.urls),
 
     path('ckeditor/', include('ckeditor_uploader.urls')),
-    path('__debug__/', include(debug_toolbar.urls)),
 
     path('', include('volleyballschool.urls')),
 ]
 
+if settings.DEBUG_TOOLBAR:
+    import debug_toolbar
+
+    urlpatterns += [path('__debug__/', include(debug_toolbar.urls))]
+
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL,
                           document_root=settings.MEDIA_ROOT)
@@ -2,10 +2,11 @@ from functools import partial
 
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as DjangoUserAdmin
+from django.core.exceptions import ValidationError
 
-from .models import (Article, Coach, Court, News, OneTimeTraining,
-                     Subscription, SubscriptionSample, Timetable, Training,
-                     User)
+from .models import (Article, BalanceTransaction, Coach, Court, News,
+                     OneTimeTraining, Subscription, SubscriptionSample,
+                     Timetable, Training, User)
 
 
 @admin.register(User)
@@ -23,6 +24,40 @@ class UserAdmin(DjangoUserAdmin):
         }),
         ('Важные даты', {'fields': ('last_login', 'date_joined')}),
     )
+    # баланс изменяется только операциями BalanceTransaction, исправления
+    # вносятся корректировками в разделе операций по балансу
+    readonly_fields = ('balance',)
+
+
+@admin.register(BalanceTransaction)
+class BalanceTransactionAdmin(admin.ModelAdmin):
+
+    list_display = ('created_at', 'user', 'kind', 'amount')
+    list_filter = ('kind',)
+    list_select_related = ('user',)
+    search_fields = ('user__username',)
+    date_hierarchy = 'created_at'
+    autocomplete_fields = ('user',)
+
+    def get_fields(self, request, obj=None):
+        # сотрудники добавляют только корректировки, тип задается сам
+        if obj is None:
+            return ('user', 'amount')
+        return ('user', 'kind', 'amount', 'created_at')
+
+    def save_model(self, request, obj, form, change):
+        obj.kind = BalanceTransaction.Kinds.CORRECTION
+        if not obj.apply():
+            # баланс уменьшился после проверки формы
+            raise ValidationError(
+                'Недостаточно средств для списания, баланс изменился'
+            )
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 
 @admin.register(News)
@@ -165,3 +200,4 @@ class TrainingAdmin(admin.ModelAdmin):
     list_filter = ('court', 'skill_level', 'day_of_week', 'coach')
     ordering = ['-date', 'court', 'skill_level']
     radio_fields = {'status': admin.VERTICAL}
+    readonly_fields = ('learners_count',)
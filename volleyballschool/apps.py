@@ -5,3 +5,6 @@ class VolleyballschoolConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'volleyballschool'
     verbose_name = 'Сайт VolleyballSchool'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,193 @@
+"""Server-Sent Events of free places of trainings.
+
+Registrations and cancellations publish the number of free places of the
+changed trainings to the in-process EventHub, and sse_application (mounted
+in project/asgi.py) streams them to subscribed clients:
+
+    /events/timetable/<skill_level>/  - trainings of the skill level, the
+                                        timetable pages
+    /events/training/<pk>/            - a single training, the registration
+                                        page
+
+The hub lives in the memory of the process, so events of registrations
+made by other worker processes are not delivered.
+"""
+import asyncio
+import json
+import re
+import threading
+from collections import defaultdict
+
+from django.db import transaction
+
+from .models import Training
+
+EVENTS_PATH_PREFIX = '/events/'
+KEEPALIVE_INTERVAL = 15  # секунд
+SUBSCRIBER_QUEUE_SIZE = 100
+RETRY_INTERVAL = 5000  # миллисекунд, через сколько браузер переподключится
+
+EVENTS_PATH_RE = re.compile(
+    r'^/events/(?:timetable/(?P<skill_level>[1-3])'
+    r'|training/(?P<training_pk>\d+))/$'
+)
+
+
+def level_channel(skill_level):
+    return 'level:{}'.format(skill_level)
+
+
+def training_channel(training_pk):
+    return 'training:{}'.format(training_pk)
+
+
+def _put_dropping_oldest(queue, event):
+    # события содержат текущее состояние, поэтому медленному клиенту
+    # достаточно последних
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(event)
+
+
+class EventHub:
+    """Publish/subscribe of events by channel name inside the process.
+
+    Subscribers are asyncio queues of the event loop which subscribed, and
+    publish() may be called from any thread, e.g. from sync views.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, channel):
+        """Return a new subscriber of [channel]. Must be called from a
+        running event loop; events are read by subscriber[1].get().
+        """
+        subscriber = (
+            asyncio.get_running_loop(),
+            asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE),
+        )
+        with self._lock:
+            self._subscribers[channel].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, channel, subscriber):
+        with self._lock:
+            self._subscribers[channel].discard(subscriber)
+            if not self._subscribers[channel]:
+                del self._subscribers[channel]
+
+    def has_subscribers(self):
+        with self._lock:
+            return bool(self._subscribers)
+
+    def publish(self, channel, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(_put_dropping_oldest, queue, event)
+            except RuntimeError:  # цикл событий подписчика уже закрыт
+                self.unsubscribe(channel, (loop, queue))
+
+
+hub = EventHub()
+
+
+def publish_free_places(training_pks):
+    """Publish the number of free places of trainings with [training_pks]
+    to the channels of the trainings and of their skill levels after the
+    current transaction is committed. Does nothing without subscribers.
+    """
+    if not training_pks or not hub.has_subscribers():
+        return
+    training_pks = list(training_pks)
+    transaction.on_commit(lambda: _publish_free_places(training_pks))
+
+
+def _publish_free_places(training_pks):
+    trainings = Training.objects.filter(pk__in=training_pks).values(
+        'pk', 'skill_level', 'learners_count',
+    )
+    for training in trainings:
+        event = {
+            'training': training['pk'],
+            'skill_level': training['skill_level'],
+            'free_places': (Training.MAX_LEARNERS_PER_TRAINING
+                            - training['learners_count']),
+        }
+        hub.publish(training_channel(training['pk']), event)
+        hub.publish(level_channel(training['skill_level']), event)
+
+
+def format_event(event):
+    return 'event: free-places\ndata: {}\n\n'.format(
+        json.dumps(event),
+    ).encode()
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def sse_application(scope, receive, send):
+    """ASGI application streaming events of the channel selected by the
+    path, see the module docstring.
+    """
+    match = EVENTS_PATH_RE.match(scope['path'])
+    if scope['method'] != 'GET' or match is None:
+        await send({
+            'type': 'http.response.start',
+            'status': 404,
+            'headers': [(b'content-type', b'text/plain; charset=utf-8')],
+        })
+        await send({'type': 'http.response.body', 'body': b'Not Found'})
+        return
+    if match.group('skill_level'):
+        channel = level_channel(match.group('skill_level'))
+    else:
+        channel = training_channel(match.group('training_pk'))
+    subscriber = hub.subscribe(channel)
+    disconnect = asyncio.ensure_future(_wait_for_disconnect(receive))
+    next_event = asyncio.ensure_future(subscriber[1].get())
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': 'retry: {}\n\n'.format(RETRY_INTERVAL).encode(),
+            'more_body': True,
+        })
+        while True:
+            done, _ = await asyncio.wait(
+                {next_event, disconnect},
+                timeout=KEEPALIVE_INTERVAL,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if disconnect in done:
+                break
+            if next_event in done:
+                body = format_event(next_event.result())
+                next_event = asyncio.ensure_future(subscriber[1].get())
+            else:
+                body = b': keepalive\n\n'
+            await send({
+                'type': 'http.response.body',
+                'body': body,
+                'more_body': True,
+            })
+    finally:
+        hub.unsubscribe(channel, subscriber)
+        next_event.cancel()
+        disconnect.cancel()
@@ -0,0 +1,132 @@
+import datetime
+import timeit
+
+from django.core.management.base import BaseCommand
+from volleyballschool.models import Court, Training
+from volleyballschool.utils import transform_for_timetable
+
+
+def _transform_for_timetable_nested_scan(query_set, start_date,
+                                         number_of_weeks):
+    """The previous implementation of transform_for_timetable, which rescans
+    the whole [query_set] for every cell of the grid. Kept only as the
+    baseline for the benchmark.
+    """
+    courts = set()
+    for training in query_set:
+        courts.add(training.court)
+    transformed_query_set = []
+    for court in courts:
+        trainigs_for_court = dict()
+        trainigs_for_court['name'] = court
+        trainigs_for_court['weeks'] = [[] for _ in range(number_of_weeks)]
+        for week_number in range(number_of_weeks):
+            for date in (
+                start_date + datetime.timedelta(n) for n
+                in range(7*week_number, 7*(week_number+1))
+            ):
+                for query in query_set:
+                    if query.date == date and query.court == court:
+                        trainigs_for_court['weeks'][week_number].append(
+                            query
+                        )
+                        break
+                else:
+                    trainigs_for_court['weeks'][week_number].append(
+                        {'date': date}
+                    )
+        transformed_query_set.append(trainigs_for_court)
+    return transformed_query_set
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the timetable grid builder (transform_for_timetable) with ' +
+        'the previous nested scan implementation on in-memory trainings ' +
+        'for different numbers of courts. The database is not used.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-c',
+            '--courts',
+            type=int,
+            nargs='+',
+            default=[10, 100, 1000],
+            help='Numbers of courts to benchmark',
+        )
+        parser.add_argument(
+            '-w',
+            '--weeks',
+            type=int,
+            default=2,
+            help='Number of weeks in the timetable',
+        )
+        parser.add_argument(
+            '-t',
+            '--trainings-per-week',
+            type=int,
+            default=3,
+            help='Number of trainings per court in a week (1-7)',
+        )
+        parser.add_argument(
+            '-r',
+            '--repeat',
+            type=int,
+            default=3,
+            help='Number of runs of each implementation, the best is shown',
+        )
+
+    def handle(self, *args, **options):
+        start_date = datetime.date(2021, 5, 31)  # понедельник
+        number_of_weeks = options['weeks']
+        self.stdout.write(
+            '{:>7} {:>10} {:>14} {:>14} {:>9}'.format(
+                'courts', 'trainings', 'nested scan,s', 'indexed,s',
+                'speedup',
+            )
+        )
+        for courts_qty in options['courts']:
+            trainings = self._make_trainings(
+                courts_qty,
+                start_date,
+                number_of_weeks,
+                options['trainings_per_week'],
+            )
+            results = []
+            for function in (_transform_for_timetable_nested_scan,
+                             transform_for_timetable):
+                timer = timeit.Timer(
+                    lambda: function(trainings, start_date, number_of_weeks)
+                )
+                results.append(min(timer.repeat(options['repeat'], 1)))
+            nested_scan_time, indexed_time = results
+            self.stdout.write(
+                '{:>7} {:>10} {:>14.4f} {:>14.4f} {:>8.1f}x'.format(
+                    courts_qty,
+                    len(trainings),
+                    nested_scan_time,
+                    indexed_time,
+                    nested_scan_time / indexed_time,
+                )
+            )
+
+    def _make_trainings(self, courts_qty, start_date, number_of_weeks,
+                        trainings_per_week):
+        """Unsaved trainings, evenly spread across the days of the week."""
+        trainings = []
+        for court_id in range(1, courts_qty + 1):
+            court = Court(pk=court_id, name='Зал {}'.format(court_id))
+            for week_number in range(number_of_weeks):
+                for day in range(trainings_per_week):
+                    date = start_date + datetime.timedelta(
+                        days=7*week_number + (court_id + 2*day) % 7
+                    )
+                    trainings.append(Training(
+                        day_of_week=date.isoweekday(),
+                        skill_level=1,
+                        start_time=datetime.time(18, 00, 00),
+                        date=date,
+                        court=court,
+                    ))
+        return trainings
@@ -0,0 +1,162 @@
+import re
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from volleyballschool.models import (Article, Subscription,
+                                     SubscriptionSample, Training, User)
+from volleyballschool.utils import bump_schedule_version
+
+# небольшие справочные таблицы, которые допустимо читать целиком
+SCAN_ALLOWED_TABLES = {
+    'volleyballschool_article',
+    'volleyballschool_coach',
+    'volleyballschool_court',
+    'volleyballschool_news',
+    'volleyballschool_onetimetraining',
+    'volleyballschool_subscriptionsample',
+}
+
+FULL_SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(?P<table>\w+)(?P<rest>.*)$')
+
+
+class Command(BaseCommand):
+    help = (
+        'For volleyballscholl app request every page with GET, run ' +
+        'EXPLAIN QUERY PLAN on each SELECT query of the page and fail if ' +
+        'any of them falls back to a full table scan. SQLite only.\n ' +
+        'Run against a database with realistic data'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-u',
+            '--username',
+            default=None,
+            help='User for pages which require login, the first user by \
+                  default',
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError(
+                'EXPLAIN QUERY PLAN is supported for SQLite only'
+            )
+        if options['username']:
+            user = User.objects.get(username=options['username'])
+        else:
+            user = User.objects.order_by('pk').first()
+        full_scans = []
+        for name, args, data, session_data in self._get_pages(user):
+            if args is None:
+                self.stdout.write('{}: skipped, no data'.format(name))
+                continue
+            # расписание всех уровней - общий снимок в кэше, без сброса
+            # запрос выполнила бы только первая страница расписания
+            bump_schedule_version()
+            for sql in self._get_select_queries(name, args, data,
+                                                session_data, user):
+                plan = self._explain(sql)
+                scanned_tables = self._get_scanned_tables(plan)
+                if scanned_tables:
+                    full_scans.append((name, sql, scanned_tables))
+                    self.stdout.write(self.style.ERROR(
+                        '{}: full scan of {}\n  {}\n{}'.format(
+                            name, ', '.join(scanned_tables), sql,
+                            '\n'.join('    ' + line for line in plan),
+                        )
+                    ))
+                elif options['verbosity'] > 1:
+                    self.stdout.write('{}: {}\n{}'.format(
+                        name, sql, '\n'.join('    ' + line for line in plan),
+                    ))
+            self.stdout.write('{}: checked'.format(name))
+        if full_scans:
+            raise CommandError(
+                '{} queries fall back to a full table scan'.format(
+                    len(full_scans),
+                )
+            )
+        self.stdout.write(self.style.SUCCESS('No full table scans'))
+
+    def _get_pages(self, user):
+        """(url name, url args or None if there is no data for the page,
+        GET data, session data) for every page of volleyballschool.urls
+        """
+        article = Article.objects.filter(active=True).first()
+        subscription_sample = SubscriptionSample.objects.filter(
+            active=True).first()
+        training = Training.objects.upcoming().first()
+        subscription = None
+        if user:
+            subscription = Subscription.objects.filter(user=user).first()
+        pages = [
+            ('index_page', [], {}, {}),
+            ('levels', [], {}, {}),
+            ('news', [], {}, {}),
+            ('coaches', [], {}, {}),
+            ('prices', [], {}, {}),
+            ('courts', [], {}, {}),
+            ('articles', [], {}, {}),
+            ('article-detail', article and [article.slug], {}, {}),
+            ('timetable', [1], {}, {}),
+            ('timetable', [2], {}, {}),
+            ('timetable', [3], {}, {}),
+            ('timetable', [1], {'week': 2, 'weeks': 4}, {}),
+            ('timetable-all', [], {}, {}),
+            ('timetable-api', [1], {}, {}),
+            ('register', [], {}, {}),
+        ]
+        login_required_pages = [
+            ('buying-a-subscription',
+             subscription_sample and [subscription_sample.pk], {}, {}),
+            ('success-buying-a-subscription',
+             subscription and [subscription.pk], {}, {'submitted': True}),
+            ('registration-for-training', training and [training.pk], {}, {}),
+            ('account', [], {}, {}),
+            ('replenishment', [], {}, {}),
+            ('replenishment-success', [], {'next': '/account/'}, {}),
+        ]
+        if not user:
+            login_required_pages = [
+                (name, None, data, session_data)
+                for name, args, data, session_data in login_required_pages
+            ]
+        return pages + login_required_pages
+
+    def _get_select_queries(self, name, args, data, session_data, user):
+        path = reverse(name, args=args)
+        request = RequestFactory().get(path, data)
+        request.user = user or AnonymousUser()
+        request.session = SessionStore()
+        request.session.update(session_data)
+        match = resolve(path)
+        with CaptureQueriesContext(connection) as context:
+            response = match.func(request, *match.args, **match.kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+        return [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].lstrip().upper().startswith('SELECT')
+        ]
+
+    def _explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def _get_scanned_tables(self, plan):
+        scanned_tables = []
+        for line in plan:
+            match = FULL_SCAN_RE.match(line.strip())
+            if (
+                match
+                and 'USING' not in match.group('rest')
+                and match.group('table') not in SCAN_ALLOWED_TABLES
+            ):
+                scanned_tables.append(match.group('table'))
+        return scanned_tables
@@ -10,13 +10,14 @@ class Command(BaseCommand):
     )
 
     def handle(self, *args, **options):
-        active_timetables = Timetable.objects.filter(active=True)
-        if not options['from_monday']:
-            for timetable in active_timetables:
-                timetable.create_upcoming_trainings()
-        else:
-            for timetable in active_timetables:
-                timetable.create_upcoming_trainings(from_monday=True)
+        created, skipped = (
+            Timetable.create_upcoming_trainings_for_active_timetables(
+                from_monday=options['from_monday'],
+            )
+        )
+        self.stdout.write(
+            'Created: {}, skipped: {}'.format(created, skipped)
+        )
 
     def add_arguments(self, parser):
         parser.add_argument(
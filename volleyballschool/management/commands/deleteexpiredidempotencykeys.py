@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from volleyballschool.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = (
+        'For volleyballscholl app delete idempotency keys of forms older ' +
+        'than IdempotencyKey.TTL in batches.\n Run at least once a day'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-b', '--batch-size', type=int, default=1000,
+            help='Number of keys deleted by one query',
+        )
+
+    def handle(self, *args, **options):
+        deleted = IdempotencyKey.delete_expired(
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write('Deleted: {}'.format(deleted))
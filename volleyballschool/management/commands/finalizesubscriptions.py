@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from volleyballschool.models import Subscription
+
+
+class Command(BaseCommand):
+    help = (
+        'For volleyballscholl app save the start and end dates of ' +
+        'subscriptions which have started and deactivate expired and ' +
+        'used up subscriptions.\n Run at least once a day'
+    )
+
+    def handle(self, *args, **options):
+        result = Subscription.objects.finalize_lifecycle()
+        self.stdout.write(
+            'Started: {}, end dates set: {}, deactivated: {}'.format(
+                result['started_by_training']
+                + result['started_by_purchase'],
+                result['end_dates'],
+                result['expired'] + result['used_up'],
+            )
+        )
@@ -0,0 +1,433 @@
+import datetime
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from volleyballschool.models import (BalanceTransaction, Coach, Court,
+                                     OneTimeTraining, Subscription,
+                                     SubscriptionSample, Timetable, Training,
+                                     User)
+from volleyballschool.utils import (bump_prices_version,
+                                    bump_schedule_version, copy_same_fields,
+                                    get_copy_plan)
+
+USERNAME_PREFIX = '+79'
+START_TIMES = [datetime.time(hour) for hour in range(9, 22)]
+SUBSCRIPTION_SAMPLES = (
+    # (количество тренировок, срок действия, стоимость)
+    (4, 30, 3000),
+    (8, 45, 5600),
+    (12, 60, 7800),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'For volleyballscholl app fill the database with a large ' +
+        'synthetic data set for load tests and benchmarks: users with ' +
+        'phone number usernames, courts, coaches, timetables, trainings ' +
+        'created from the timetables for the given number of years up to ' +
+        'the next 15 days, learners of the trainings and subscriptions in ' +
+        'every state of their lifecycle. The data set is the same for the ' +
+        'same options, seed and date. Rows are inserted with bulk inserts ' +
+        'in a single transaction, large tables bypass model instances.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-u', '--users', type=int, default=200000,
+            help='Number of users',
+        )
+        parser.add_argument(
+            '-c', '--courts', type=int, default=50,
+            help='Number of courts',
+        )
+        parser.add_argument(
+            '--coaches', type=int, default=20,
+            help='Number of coaches',
+        )
+        parser.add_argument(
+            '-t', '--timetables-per-court', type=int, default=6,
+            help='Number of weekly timetable rules of each court (1-21)',
+        )
+        parser.add_argument(
+            '-y', '--years', type=int, default=2,
+            help='Number of years of past trainings',
+        )
+        parser.add_argument(
+            '--subscribers', type=float, default=0.3,
+            help='Share of users who buy subscriptions',
+        )
+        parser.add_argument(
+            '-s', '--seed', type=int, default=0,
+            help='Seed of the random generator',
+        )
+        parser.add_argument(
+            '--today', type=datetime.date.fromisoformat,
+            default=None,
+            help='Date to generate the data relative to, YYYY-MM-DD, '
+                 'today by default',
+        )
+        parser.add_argument(
+            '--password', default='password',
+            help='Password of all generated users',
+        )
+        parser.add_argument(
+            '-b', '--batch-size', type=int, default=5000,
+            help='Number of rows in one INSERT',
+        )
+
+    def handle(self, *args, **options):
+        if not 1 <= options['timetables_per_court'] <= 21:
+            raise CommandError('--timetables-per-court must be 1-21')
+        if User.objects.filter(
+            username__startswith=USERNAME_PREFIX,
+        ).exists():
+            raise CommandError(
+                'The database already contains generated users'
+            )
+        self.rng = random.Random(options['seed'])
+        self.today = options['today'] or datetime.date.today()
+        self.batch_size = options['batch_size']
+        started_at = time.perf_counter()
+        with transaction.atomic():
+            self._create_prices()
+            coaches = self._create_coaches(options['coaches'])
+            timetables = self._create_timetables(
+                self._create_courts(options['courts']),
+                coaches,
+                options['timetables_per_court'],
+            )
+            user_pks = self._create_users(
+                options['users'], options['password'],
+            )
+            trainings = self._create_trainings(timetables, options['years'])
+            trainings_of_users = self._create_learners(trainings, user_pks)
+            self._create_subscriptions(
+                user_pks, trainings_of_users, options['subscribers'],
+            )
+            self._reset_sequences([
+                Coach, Court, Timetable, User, Training, Subscription,
+            ])
+            finalized = Subscription.objects.finalize_lifecycle()
+        bump_schedule_version()
+        bump_prices_version()
+        self.stdout.write('Subscriptions finalized: {}'.format(
+            sum(finalized.values()),
+        ))
+        self.stdout.write(self.style.SUCCESS(
+            'Done in {:.1f}s'.format(time.perf_counter() - started_at)
+        ))
+
+    def _bulk_create(self, model, objects):
+        model.objects.bulk_create(objects, batch_size=self.batch_size)
+        self._report(model, len(objects))
+        return objects
+
+    def _insert_rows(self, model, field_names, rows):
+        """INSERT [rows] (tuples of values of [field_names]) into the table
+        of [model] with executemany() and without model instances, which
+        are the bottleneck of bulk_create() for hundreds of thousands of
+        rows. Other fields get their defaults, auto_now(_add) fields get the
+        current time. Signals are not sent and save() is not called.
+        """
+        fields = [model._meta.get_field(name) for name in field_names]
+        now = datetime.datetime.now()
+        default_fields, default_values = [], []
+        for field in model._meta.concrete_fields:
+            if field in fields or field.primary_key:
+                continue
+            if getattr(field, 'auto_now', False) or getattr(
+                    field, 'auto_now_add', False):
+                value = now
+                if field.get_internal_type() == 'DateField':
+                    value = now.date()
+            else:
+                value = field.get_default()
+            default_fields.append(field)
+            default_values.append(
+                field.get_db_prep_save(value, connection),
+            )
+        # значения целых и строковых полей передаются как есть
+        preparers = [
+            None if field.get_internal_type() in (
+                'AutoField', 'BigAutoField', 'CharField', 'ForeignKey',
+                'IntegerField', 'PositiveIntegerField',
+                'PositiveSmallIntegerField', 'SmallIntegerField',
+            ) else field.get_db_prep_save
+            for field in fields
+        ]
+        quote_name = connection.ops.quote_name
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            quote_name(model._meta.db_table),
+            ', '.join(quote_name(field.column)
+                      for field in fields + default_fields),
+            ', '.join(['%s'] * (len(fields) + len(default_fields))),
+        )
+        rows = list(rows)
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), self.batch_size):
+                cursor.executemany(sql, [
+                    [
+                        value if prepare is None
+                        else prepare(value, connection)
+                        for prepare, value in zip(preparers, row)
+                    ] + default_values
+                    for row in rows[start:start + self.batch_size]
+                ])
+        self._report(model, len(rows))
+
+    def _report(self, model, rows_qty):
+        self.stdout.write('{}: {}'.format(model._meta.db_table, rows_qty))
+
+    def _reset_sequences(self, models):
+        """Move the primary key sequences of [models] past the explicitly
+        inserted primary keys, so the next ORM insert does not get a
+        duplicate key (PostgreSQL, Oracle; nothing to do on SQLite and
+        MySQL).
+        """
+        statements = connection.ops.sequence_reset_sql(no_style(), models)
+        if statements:
+            with connection.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
+
+    def _next_pk(self, model):
+        """Primary keys are assigned explicitly, because bulk_create() does
+        not return them on every database backend.
+        """
+        last = model.objects.order_by('-pk').values_list('pk', flat=True)
+        return (last.first() or 0) + 1
+
+    def _create_prices(self):
+        if not OneTimeTraining.objects.exists():
+            OneTimeTraining.objects.create(price=900)
+        if not SubscriptionSample.objects.exists():
+            self._bulk_create(SubscriptionSample, [
+                SubscriptionSample(
+                    name='Абонемент на {} занятий'.format(trainings_qty),
+                    amount=amount,
+                    trainings_qty=trainings_qty,
+                    validity=validity,
+                    active=True,
+                )
+                for trainings_qty, validity, amount in SUBSCRIPTION_SAMPLES
+            ])
+
+    def _create_coaches(self, coaches_qty):
+        first_pk = self._next_pk(Coach)
+        return self._bulk_create(Coach, [
+            Coach(
+                pk=pk,
+                name='Тренер {}'.format(pk),
+                description='',
+                active=True,
+            )
+            for pk in range(first_pk, first_pk + coaches_qty)
+        ])
+
+    def _create_courts(self, courts_qty):
+        first_pk = self._next_pk(Court)
+        return self._bulk_create(Court, [
+            Court(
+                pk=pk,
+                name='Зал {}'.format(pk),
+                address='ул. Спортивная, д. {}'.format(pk),
+                metro='Станция {}'.format(pk % 30 + 1),
+                passport_required=self.rng.random() < 0.2,
+                active=True,
+            )
+            for pk in range(first_pk, first_pk + courts_qty)
+        ])
+
+    def _create_timetables(self, courts, coaches, timetables_per_court):
+        """Weekly rules with distinct (day of week, skill level) for every
+        court, so trainings created from them never collide.
+        """
+        pk = self._next_pk(Timetable)
+        timetables = []
+        for court in courts:
+            slots = self.rng.sample(
+                [(day, level) for day in range(1, 8) for level in (1, 2, 3)],
+                timetables_per_court,
+            )
+            for day_of_week, skill_level in sorted(slots):
+                timetables.append(Timetable(
+                    pk=pk,
+                    day_of_week=day_of_week,
+                    skill_level=skill_level,
+                    court=court,
+                    coach=self.rng.choice(coaches) if coaches else None,
+                    start_time=self.rng.choice(START_TIMES),
+                    active=True,
+                ))
+                pk += 1
+        return self._bulk_create(Timetable, timetables)
+
+    def _create_users(self, users_qty, password):
+        """Returns:
+            [list]: primary keys of the users
+        """
+        first_pk = self._next_pk(User)
+        user_pks = list(range(first_pk, first_pk + users_qty))
+        password = make_password(password)  # хэш вычисляется один раз
+        phone_numbers = self.rng.sample(range(10**9), users_qty)
+        balances = [self.rng.choice((0, 0, 900, 1800, 5000))
+                    for _ in user_pks]
+        self._insert_rows(
+            User,
+            ['id', 'username', 'password', 'balance'],
+            (
+                (pk, '{}{:09d}'.format(USERNAME_PREFIX, phone_number),
+                 password, balance)
+                for pk, phone_number, balance
+                in zip(user_pks, phone_numbers, balances)
+            ),
+        )
+        self._insert_rows(
+            BalanceTransaction,
+            ['user', 'amount', 'kind'],
+            (
+                (pk, balance, BalanceTransaction.Kinds.OPENING_BALANCE)
+                for pk, balance in zip(user_pks, balances) if balance
+            ),
+        )
+        return user_pks
+
+    def _create_trainings(self, timetables, years):
+        """Plan trainings of every timetable from [years] years ago to
+        Timetable.DAYS_OF_UPCOMING_TRAININGS days from today. They are
+        inserted by _create_learners().
+
+        Returns:
+            [list]: unsaved Training objects with primary keys
+        """
+        timetables_by_day = {}
+        for timetable in timetables:
+            timetables_by_day.setdefault(
+                timetable.day_of_week, [],
+            ).append(timetable)
+        pk = self._next_pk(Training)
+        trainings = []
+        date = self.today - datetime.timedelta(days=365*years)
+        end_date = self.today + datetime.timedelta(
+            days=Timetable.DAYS_OF_UPCOMING_TRAININGS - 1,
+        )
+        statuses = (
+            [Training.ListOfStatuses.OK] * 46
+            + [Training.ListOfStatuses.COACH_REPLACEMENT,
+               Training.ListOfStatuses.TIME_CHANGE,
+               Training.ListOfStatuses.CANCELED,
+               Training.ListOfStatuses.CANCELED]
+        )
+        while date <= end_date:
+            for timetable in timetables_by_day.get(date.isoweekday(), ()):
+                training = Training(pk=pk, date=date)
+                copy_same_fields(timetable, training)
+                training.status = self.rng.choice(statuses)
+                training.set_start_and_end()
+                trainings.append(training)
+                pk += 1
+            date += datetime.timedelta(days=1)
+        return trainings
+
+    def _create_learners(self, trainings, user_pks):
+        """Register random users for [trainings], some of them up to
+        Training.MAX_LEARNERS_PER_TRAINING, and insert the trainings with
+        their learners_count and the learners.
+
+        Returns:
+            [dict]: {user pk: list of trainings of the user}
+        """
+        learners = []
+        trainings_of_users = {}
+        for training in trainings:
+            training.learners_count = 0
+            if training.status == Training.ListOfStatuses.CANCELED:
+                continue
+            training.learners_count = min(
+                self.rng.randint(0, Training.MAX_LEARNERS_PER_TRAINING + 4),
+                Training.MAX_LEARNERS_PER_TRAINING,
+                len(user_pks),
+            )
+            for user_pk in self.rng.sample(user_pks,
+                                           training.learners_count):
+                learners.append((training.pk, user_pk))
+                trainings_of_users.setdefault(user_pk, []).append(training)
+        field_names = ['id', 'learners_count', 'start_at', 'end_at'] + list(
+            get_copy_plan(Timetable, Training),
+        ) + ['date', 'status']
+        self._insert_rows(
+            Training,
+            field_names,
+            (
+                tuple(getattr(training, Training._meta.get_field(
+                    name).attname) for name in field_names)
+                for training in trainings
+            ),
+        )
+        self._insert_rows(
+            Training.learners.through, ['training', 'user'], learners,
+        )
+        return trainings_of_users
+
+    def _create_subscriptions(self, user_pks, trainings_of_users,
+                              subscribers_share):
+        """Subscriptions of random users bought on dates of their trainings,
+        so they cover every lifecycle state: not started yet, started by the
+        first training or by the purchase date, used up and expired.
+        finalize_lifecycle() saves the states afterwards.
+        """
+        pk = self._next_pk(Subscription)
+        subscriptions = []
+        subscription_trainings = []
+        subscribers_qty = int(len(user_pks) * subscribers_share)
+        for user_pk in sorted(self.rng.sample(user_pks, subscribers_qty)):
+            user_trainings = sorted(
+                trainings_of_users.get(user_pk, ()),
+                key=lambda training: training.start_at,
+            )
+            first_training = 0
+            for _ in range(self.rng.randint(1, 3)):
+                trainings_qty, validity, _ = self.rng.choice(
+                    SUBSCRIPTION_SAMPLES,
+                )
+                if first_training < len(user_trainings):
+                    purchase_date = (
+                        user_trainings[first_training].date
+                        - datetime.timedelta(days=self.rng.randint(0, 12))
+                    )
+                else:
+                    purchase_date = self.today - datetime.timedelta(
+                        days=self.rng.randint(0, 60),
+                    )
+                end_date = purchase_date + datetime.timedelta(
+                    days=validity + 10,
+                )
+                used_trainings = [
+                    training for training
+                    in user_trainings[first_training:]
+                    if training.date <= end_date
+                ][:self.rng.randint(0, trainings_qty)]
+                first_training += len(used_trainings)
+                subscriptions.append(
+                    (pk, user_pk, trainings_qty, validity, purchase_date),
+                )
+                subscription_trainings.extend(
+                    (pk, training.pk) for training in used_trainings
+                )
+                pk += 1
+        # purchase_date передается явно, auto_now_add не применяется
+        self._insert_rows(
+            Subscription,
+            ['id', 'user', 'trainings_qty', 'validity', 'purchase_date'],
+            subscriptions,
+        )
+        self._insert_rows(
+            Subscription.trainings.through,
+            ['subscription', 'training'],
+            subscription_trainings,
+        )
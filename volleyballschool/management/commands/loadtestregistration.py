@@ -0,0 +1,373 @@
+import datetime
+import http.cookiejar
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Q, Sum
+from django.urls import reverse
+from volleyballschool.models import (BalanceTransaction, OneTimeTraining,
+                                     Subscription, Training, User)
+
+USERNAME_PREFIX = 'loadtest-'
+CSRF_TOKEN_RE = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+IDEMPOTENCY_KEY_RE = re.compile(r'name="idempotency_key" value="([0-9a-f]*)"')
+PAYMENT_PATHS = ('subscription', 'balance')
+STEPS = ('login', 'training page', 'registration')
+
+
+class _NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Redirects are returned as responses, so the latency of a POST does
+    not include the page it redirects to.
+    """
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of non-empty [sorted_values]."""
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class Client:
+    """HTTP client of one simulated user with its own cookies."""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies),
+            _NoRedirectHandler,
+        )
+
+    def request(self, path, data=None):
+        """Returns:
+            [tuple]: (status, body) of the response
+        """
+        if data is not None:
+            data = urllib.parse.urlencode(data).encode()
+        request = urllib.request.Request(self.base_url + path, data=data)
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                return response.status, response.read().decode()
+        except urllib.error.HTTPError as error:
+            with error:
+                return error.code, error.read().decode(errors='replace')
+
+
+class Command(BaseCommand):
+    help = (
+        'For volleyballscholl app simulate a rush of registrations for ' +
+        'trainings against a running server, e.g. a local runserver with ' +
+        'the same database. Creates users paying by subscription and by ' +
+        'balance, logs them in, then all of them register for the same ' +
+        'upcoming trainings at once, each form is submitted several times ' +
+        'with the same idempotency key. Reports throughput, latency ' +
+        'percentiles and errors of every step and checks invariants: no ' +
+        'overbooking, no negative balances, no double charges. The users ' +
+        'and their registrations are deleted afterwards unless --keep.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url', default='http://127.0.0.1:8000',
+            help='Base URL of the server',
+        )
+        parser.add_argument(
+            '-u', '--users', type=int, default=40,
+            help='Number of simulated users, half of them pay by ' +
+                 'subscription',
+        )
+        parser.add_argument(
+            '-t', '--trainings', type=int, default=2,
+            help='Number of upcoming trainings every user registers for',
+        )
+        parser.add_argument(
+            '-c', '--concurrency', type=int, default=20,
+            help='Number of simultaneous registrations',
+        )
+        parser.add_argument(
+            '-d', '--duplicates', type=int, default=2,
+            help='How many times every registration form is submitted ' +
+                 'at once with the same idempotency key',
+        )
+        parser.add_argument(
+            '--timeout', type=float, default=30,
+            help='Timeout of a request, seconds',
+        )
+        parser.add_argument(
+            '-s', '--seed', type=int, default=0,
+            help='Seed of the order of registrations',
+        )
+        parser.add_argument(
+            '--keep', action='store_true',
+            help='Keep the users and their registrations',
+        )
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--users and --concurrency must be positive')
+        if options['duplicates'] < 1:
+            raise CommandError('--duplicates must be positive')
+        # тренировки с наибольшим количеством свободных мест
+        trainings = list(
+            Training.objects.cancellable().order_by(
+                'learners_count', 'start_at',
+            )[:options['trainings']]
+        )
+        if len(trainings) < options['trainings']:
+            raise CommandError(
+                'Not enough upcoming trainings, create them with '
+                'createvolleyballtrainings'
+            )
+        self.url = options['url']
+        self.timeout = options['timeout']
+        self.samples = defaultdict(list)
+        self.samples_lock = threading.Lock()
+        self.forms_not_shown = 0
+        self.started_at = datetime.datetime.now()
+        password = User.objects.make_random_password()
+        users = self._create_users(options['users'], password, trainings)
+        try:
+            clients = self._log_in(users, password, options['concurrency'])
+            tasks = [
+                (clients[user.pk], user, training)
+                for user in users if user.pk in clients
+                for training in trainings
+            ]
+            random.Random(options['seed']).shuffle(tasks)
+            rush_started_at = time.perf_counter()
+            with ThreadPoolExecutor(options['concurrency']) as executor:
+                for client, user, training in tasks:
+                    executor.submit(self._register, client, user, training,
+                                    options['duplicates'])
+            rush_time = time.perf_counter() - rush_started_at
+            self._report(rush_time)
+            violations = self._check_invariants(users, trainings)
+        finally:
+            if not options['keep']:
+                self._delete_users(users)
+        if violations:
+            for violation in violations:
+                self.stdout.write(self.style.ERROR(violation))
+            raise CommandError(
+                '{} invariant violations'.format(len(violations))
+            )
+        self.stdout.write(self.style.SUCCESS('All invariants hold'))
+
+    def _create_users(self, users_qty, password, trainings):
+        """Subscriptions and balances of the users cover only half of the
+        trainings, so payments of one user race with each other too.
+        """
+        run = self.started_at.strftime('%Y%m%d%H%M%S')
+        trainings_qty = max(1, len(trainings) // 2)
+        price = OneTimeTraining.get_cached().price
+        users = []
+        for number in range(users_qty):
+            user = User.objects.create_user(
+                '{}{}-{}'.format(USERNAME_PREFIX, run, number),
+                password=password,
+            )
+            user.payment_by = PAYMENT_PATHS[number % 2]
+            if user.payment_by == 'subscription':
+                Subscription.objects.create(
+                    user=user, trainings_qty=trainings_qty, validity=30,
+                )
+            else:
+                user.credit_balance(
+                    price * trainings_qty,
+                    BalanceTransaction.Kinds.REPLENISHMENT,
+                )
+            users.append(user)
+        return users
+
+    def _log_in(self, users, password, concurrency):
+        """Returns:
+            [dict]: Client by pk of every user who logged in
+        """
+        def log_in(user):
+            client = Client(self.url, self.timeout)
+            path = reverse('login')
+            with self._measure('login') as result:
+                status, body = client.request(path)
+                csrf_token = CSRF_TOKEN_RE.search(body)
+                status, body = client.request(path, {
+                    'csrfmiddlewaretoken': csrf_token and csrf_token[1],
+                    'username': user.username,
+                    'password': password,
+                })
+                result['ok'] = status == 302
+            return user.pk, client if result['ok'] else None
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            clients = dict(executor.map(log_in, users))
+        return {pk: client for pk, client in clients.items() if client}
+
+    def _register(self, client, user, training, duplicates):
+        path = reverse('registration-for-training', args=[training.pk])
+        with self._measure('training page') as result:
+            status, body = client.request(path)
+            result['ok'] = status == 200
+        if not result['ok']:
+            return
+        idempotency_key = IDEMPOTENCY_KEY_RE.search(body)
+        if idempotency_key is None:
+            # мест нет или оплатить нечем, формы записи на странице нет
+            with self.samples_lock:
+                self.forms_not_shown += 1
+            return
+        data = {
+            'csrfmiddlewaretoken': CSRF_TOKEN_RE.search(body)[1],
+            'idempotency_key': idempotency_key[1],
+            'payment_by': user.payment_by,
+            'confirm': 'Подтвердить',
+        }
+
+        def submit():
+            with self._measure('registration') as result:
+                status, body = client.request(path, data)
+                result['ok'] = status == 302
+
+        # повторные нажатия кнопки отправляются одновременно с первым
+        threads = [threading.Thread(target=submit)
+                   for _ in range(duplicates - 1)]
+        for thread in threads:
+            thread.start()
+        submit()
+        for thread in threads:
+            thread.join()
+
+    @contextmanager
+    def _measure(self, step):
+        """Records the latency of the block and whether it set
+        result['ok']. Connection errors are counted as failed requests.
+        """
+        result = {'ok': False}
+        started_at = time.perf_counter()
+        try:
+            yield result
+        except OSError:
+            result['ok'] = False
+        finally:
+            elapsed = time.perf_counter() - started_at
+            with self.samples_lock:
+                self.samples[step].append((elapsed, result['ok']))
+
+    def _report(self, rush_time):
+        self.stdout.write('{:<14} {:>8} {:>7} {:>9} {:>8} {:>8} {:>8}'.format(
+            'step', 'requests', 'errors', 'req/s', 'p50,ms', 'p95,ms',
+            'p99,ms',
+        ))
+        for step in STEPS:
+            samples = self.samples[step]
+            if not samples:
+                continue
+            latencies = sorted(elapsed for elapsed, _ in samples)
+            errors = sum(1 for _, ok in samples if not ok)
+            throughput = ''
+            if step != 'login':
+                throughput = '{:.1f}'.format(len(samples) / rush_time)
+            self.stdout.write(
+                '{:<14} {:>8} {:>7} {:>9} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+                    step, len(samples), errors, throughput,
+                    *(percentile(latencies, percent) * 1000
+                      for percent in (50, 95, 99)),
+                )
+            )
+        self.stdout.write('Registration forms not shown: {}'.format(
+            self.forms_not_shown,
+        ))
+
+    def _check_invariants(self, users, trainings):
+        """Returns:
+            [list]: descriptions of the violations
+        """
+        violations = []
+        training_pks = [training.pk for training in trainings]
+        for training in Training.objects.filter(pk__in=training_pks).annotate(
+            learners_qty=Count('learners'),
+        ):
+            if training.learners_qty > Training.MAX_LEARNERS_PER_TRAINING:
+                violations.append('Training {} is overbooked: {}/{}'.format(
+                    training.pk, training.learners_qty,
+                    Training.MAX_LEARNERS_PER_TRAINING,
+                ))
+            if training.learners_qty != training.learners_count:
+                violations.append(
+                    'Training {}: learners_count {} != {} learners'.format(
+                        training.pk, training.learners_count,
+                        training.learners_qty,
+                    )
+                )
+        user_pks = [user.pk for user in users]
+        paid_trainings = dict(
+            User.objects.filter(pk__in=user_pks).annotate(
+                payments=Count(
+                    'balance_transactions',
+                    filter=Q(balance_transactions__kind=(
+                        BalanceTransaction.Kinds.TRAINING_PAYMENT
+                    )),
+                ),
+            ).values_list('pk', 'payments')
+        )
+        registrations = dict(
+            User.objects.filter(pk__in=user_pks).annotate(
+                trainings_qty=Count(
+                    'trainings', filter=Q(trainings__pk__in=training_pks),
+                ),
+            ).values_list('pk', 'trainings_qty')
+        )
+        ledger = dict(
+            User.objects.filter(pk__in=user_pks).annotate(
+                total=Sum('balance_transactions__amount'),
+            ).values_list('pk', 'total')
+        )
+        subscriptions = Subscription.objects.filter(
+            user__in=user_pks,
+        ).annotate(used=Count('trainings'))
+        used_subscription_trainings = defaultdict(int)
+        for subscription in subscriptions:
+            used_subscription_trainings[subscription.user_id] += (
+                subscription.used
+            )
+            if subscription.used > subscription.trainings_qty:
+                violations.append(
+                    'Subscription {} of {} is overused: {}/{}'.format(
+                        subscription.pk, subscription.user, subscription.used,
+                        subscription.trainings_qty,
+                    )
+                )
+        for user in User.objects.filter(pk__in=user_pks):
+            if user.balance < 0:
+                violations.append('Balance of {} is negative: {}'.format(
+                    user, user.balance,
+                ))
+            if user.balance != (ledger[user.pk] or 0):
+                violations.append(
+                    'Balance of {} {} != {} by the ledger'.format(
+                        user, user.balance, ledger[user.pk] or 0,
+                    )
+                )
+            paid = (paid_trainings[user.pk]
+                    + used_subscription_trainings[user.pk])
+            if paid != registrations[user.pk]:
+                violations.append(
+                    '{} is charged {} times for {} registrations'.format(
+                        user, paid, registrations[user.pk],
+                    )
+                )
+        return violations
+
+    def _delete_users(self, users):
+        User.objects.filter(pk__in=[user.pk for user in users]).delete()
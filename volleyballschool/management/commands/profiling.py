@@ -0,0 +1,105 @@
+import io
+import pstats
+
+from django.core.management.base import BaseCommand, CommandError
+from volleyballschool.profiling import (REFRESH_INTERVAL, REPORT_FILE_NAME,
+                                        delete_control_file, get_dump_dir,
+                                        get_profiling_dir, read_control_file,
+                                        write_control_file)
+
+
+class Command(BaseCommand):
+    help = (
+        'For volleyballscholl app turn the sampling profiler of requests ' +
+        '(volleyballschool.profiling.ProfilingMiddleware) on or off in ' +
+        'all running processes, show its state, or summarize the saved ' +
+        'profiles into a top-functions report per url name'
+    )
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='action', required=True)
+        on = subparsers.add_parser('on', help='Turn profiling on')
+        on.add_argument(
+            '-e', '--every', type=int, default=100,
+            help='Profile every N-th request on average',
+        )
+        on.add_argument(
+            '--slower-than', type=float, default=None,
+            help='Save only profiles of requests slower than SECONDS',
+        )
+        subparsers.add_parser('off', help='Turn profiling off')
+        subparsers.add_parser('status', help='Show whether profiling is on')
+        report = subparsers.add_parser(
+            'report', help='Write report.txt for every url name',
+        )
+        report.add_argument(
+            'view_names', nargs='*',
+            help='Url names to report, all by default',
+        )
+        report.add_argument(
+            '-l', '--limit', type=int, default=30,
+            help='Number of functions in a report',
+        )
+        report.add_argument(
+            '-s', '--sort', default='cumulative',
+            choices=['cumulative', 'tottime', 'ncalls'],
+            help='Sort functions by',
+        )
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if action == 'on':
+            if options['every'] < 1:
+                raise CommandError('--every must be positive')
+            write_control_file(options['every'], options['slower_than'])
+            self.stdout.write(
+                'Profiling is turned on, running processes pick it up in '
+                '{}s'.format(REFRESH_INTERVAL)
+            )
+        elif action == 'off':
+            delete_control_file()
+            self.stdout.write('Profiling is turned off')
+        elif action == 'status':
+            self._status()
+        else:
+            self._report(options['view_names'], options['limit'],
+                         options['sort'])
+
+    def _status(self):
+        config = read_control_file()
+        if config is None:
+            self.stdout.write('Profiling is off')
+            return
+        self.stdout.write('Profiling is on: every {} request(s){}'.format(
+            config['every'],
+            ', saved if slower than {}s'.format(config['slower_than'])
+            if config.get('slower_than') is not None else '',
+        ))
+
+    def _report(self, view_names, limit, sort):
+        profiling_dir = get_profiling_dir()
+        if view_names:
+            dump_dirs = [get_dump_dir(name) for name in view_names]
+        else:
+            dump_dirs = sorted(
+                path for path in profiling_dir.glob('*') if path.is_dir()
+            )
+        reported = 0
+        for dump_dir in dump_dirs:
+            dumps = sorted(dump_dir.glob('*.prof'))
+            if not dumps:
+                self.stdout.write('{}: no profiles'.format(dump_dir.name))
+                continue
+            output = io.StringIO()
+            output.write('{}: {} profiles\n\n'.format(
+                dump_dir.name, len(dumps),
+            ))
+            stats = pstats.Stats(*map(str, dumps), stream=output)
+            stats.strip_dirs().sort_stats(sort).print_stats(limit)
+            (dump_dir / REPORT_FILE_NAME).write_text(output.getvalue())
+            self.stdout.write('{}: {} profiles, {}'.format(
+                dump_dir.name, len(dumps), dump_dir / REPORT_FILE_NAME,
+            ))
+            reported += 1
+        if not reported:
+            raise CommandError('No profiles in {}'.format(profiling_dir))
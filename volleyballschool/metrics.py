@@ -0,0 +1,329 @@
+"""Request, database and cache metrics in the Prometheus text format.
+
+MetricsMiddleware counts requests of every view (by url name), their
+latency and the number and time of their database queries, in total and
+by query fingerprint, in the memory of the process. Cache lookups are
+counted by record_cache_lookup(). The counters of every process are saved
+to the cache backend at most once in FLUSH_INTERVAL seconds, and the
+metrics view sums the counters of all processes which share the cache
+backend:
+
+    volleyballschool_http_requests_total{view, method, status}
+    volleyballschool_http_request_duration_seconds{view}  - histogram
+    volleyballschool_db_queries_total{view}
+    volleyballschool_db_query_duration_seconds_total{view}
+    volleyballschool_cache_lookups_total{cache, result}   - hit/miss
+    volleyballschool_db_fingerprint_queries_total{view, fingerprint}
+    volleyballschool_db_fingerprint_duration_seconds_total{view, fingerprint}
+    volleyballschool_db_fingerprint_duration_seconds_max{view, fingerprint}
+    volleyballschool_db_suspected_n_plus_one_total{view, fingerprint}
+    volleyballschool_db_fingerprint_info{fingerprint, sql} - always 1
+    volleyballschool_metrics_workers                      - processes
+
+The hit ratio of a cache is hits / (hits + misses) of
+volleyballschool_cache_lookups_total. Fingerprints of queries are
+described in volleyballschool.querylog, the SQL of a fingerprint id is
+the sql label of volleyballschool_db_fingerprint_info. Counters of a
+stopped process stay in the sum until its entry expires from the cache
+(WORKER_TIMEOUT), then the process is dropped from the list of processes
+when another process joins it.
+"""
+import bisect
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import connection
+
+from .querylog import QueryRecorder, get_view_name
+
+PREFIX = 'volleyballschool_'
+FLUSH_INTERVAL = 10  # секунд
+WORKER_TIMEOUT = 24 * 60 * 60  # секунд
+WORKERS_CACHE_KEY = 'volleyballschool:metrics:workers'
+WORKER_CACHE_KEY = 'volleyballschool:metrics:worker:{}'
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'),
+)
+HTTP_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+FAMILIES = {
+    'http_requests_total': ('counter', 'Number of requests.'),
+    'http_request_duration_seconds': (
+        'histogram', 'Time from the request to the response.',
+    ),
+    'db_queries_total': ('counter', 'Number of database queries.'),
+    'db_query_duration_seconds_total': (
+        'counter', 'Time of database queries.',
+    ),
+    'cache_lookups_total': ('counter', 'Number of cache lookups.'),
+    'db_fingerprint_queries_total': (
+        'counter', 'Number of database queries with the fingerprint.',
+    ),
+    'db_fingerprint_duration_seconds_total': (
+        'counter', 'Time of database queries with the fingerprint.',
+    ),
+    'db_fingerprint_duration_seconds_max': (
+        'gauge', 'Longest database query with the fingerprint.',
+    ),
+    'db_suspected_n_plus_one_total': (
+        'counter', 'Number of requests which repeated the fingerprint.',
+    ),
+    'db_fingerprint_info': ('gauge', 'SQL of the fingerprint.'),
+}
+# значения этих метрик разных процессов не суммируются, берётся наибольшее
+MAX_MERGED_METRICS = {
+    'db_fingerprint_duration_seconds_max',
+    'db_fingerprint_info',
+}
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+class Metrics:
+    """Counters of one process. A sample is keyed by (metric name, labels),
+    where labels is a tuple of (label, value) pairs, so the samples of
+    different processes are summed by key. Histogram buckets are stored
+    non-cumulative and accumulated in render().
+    """
+
+    def __init__(self, worker_id=None):
+        self.worker_id = worker_id or '{}:{}'.format(
+            socket.gethostname(), os.getpid(),
+        )
+        self._lock = threading.Lock()
+        self._samples = defaultdict(float)
+        self._flushed_at = 0
+
+    def record_request(self, view, method, status, duration, queries_qty,
+                       queries_duration):
+        if method not in HTTP_METHODS:
+            method = 'other'
+        bucket = DURATION_BUCKETS[
+            bisect.bisect_left(DURATION_BUCKETS, duration)
+        ]
+        view_labels = (('view', view),)
+        with self._lock:
+            samples = self._samples
+            samples['http_requests_total', (
+                ('view', view), ('method', method), ('status', str(status)),
+            )] += 1
+            samples['http_request_duration_seconds_bucket', (
+                ('view', view), ('le', _format_bound(bucket)),
+            )] += 1
+            samples['http_request_duration_seconds_sum', view_labels] += (
+                duration
+            )
+            samples['http_request_duration_seconds_count', view_labels] += 1
+            samples['db_queries_total', view_labels] += queries_qty
+            samples['db_query_duration_seconds_total', view_labels] += (
+                queries_duration
+            )
+
+    def record_cache_lookup(self, name, hit):
+        with self._lock:
+            self._samples['cache_lookups_total', (
+                ('cache', name), ('result', 'hit' if hit else 'miss'),
+            )] += 1
+
+    def record_queries(self, view, fingerprints, suspected):
+        """Count the queries of a request by fingerprint, see
+        volleyballschool.querylog.QueryRecorder.
+
+        Args:
+            view ([str]): url name of the view
+            fingerprints ([dict]): QueryRecorder.fingerprints
+            suspected ([list]): fingerprints of suspected N+1 queries
+        """
+        with self._lock:
+            samples = self._samples
+            for (fingerprint_id, sql), (count, total, longest) in (
+                fingerprints.items()
+            ):
+                labels = (('view', view), ('fingerprint', fingerprint_id))
+                samples['db_fingerprint_queries_total', labels] += count
+                samples['db_fingerprint_duration_seconds_total', labels] += (
+                    total
+                )
+                key = 'db_fingerprint_duration_seconds_max', labels
+                samples[key] = max(samples[key], longest)
+                samples['db_fingerprint_info', (
+                    ('fingerprint', fingerprint_id), ('sql', sql),
+                )] = 1
+            for fingerprint_id, _ in suspected:
+                samples['db_suspected_n_plus_one_total', (
+                    ('view', view), ('fingerprint', fingerprint_id),
+                )] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._samples)
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._flushed_at = 0
+
+    def flush(self, force=False):
+        """Save the counters of the process to the cache backend, at most
+        once in FLUSH_INTERVAL seconds unless [force].
+        """
+        now = time.monotonic()
+        if not force and now - self._flushed_at < FLUSH_INTERVAL:
+            return
+        self._flushed_at = now
+        cache.set(
+            WORKER_CACHE_KEY.format(self.worker_id),
+            self.snapshot(),
+            WORKER_TIMEOUT,
+        )
+        # список процессов может потерять процесс при одновременной
+        # записи или истечь, тогда процесс добавит себя при следующем
+        # сохранении
+        workers = cache.get(WORKERS_CACHE_KEY) or []
+        if self.worker_id not in workers:
+            # остановленные процессы, счётчики которых истекли, удаляются
+            snapshots = cache.get_many(
+                [WORKER_CACHE_KEY.format(worker_id) for worker_id in workers]
+            )
+            workers = [
+                worker_id for worker_id in workers
+                if WORKER_CACHE_KEY.format(worker_id) in snapshots
+            ]
+            cache.set(WORKERS_CACHE_KEY, workers + [self.worker_id],
+                      WORKER_TIMEOUT)
+
+    def collect(self):
+        """Return the sum of the counters of all processes, the counters of
+        the current process are taken from its memory.
+
+        Returns:
+            [tuple]: (samples, number of processes)
+        """
+        workers = [
+            worker_id for worker_id in cache.get(WORKERS_CACHE_KEY) or []
+            if worker_id != self.worker_id
+        ]
+        snapshots = cache.get_many(
+            [WORKER_CACHE_KEY.format(worker_id) for worker_id in workers]
+        )
+        samples = defaultdict(float, self.snapshot())
+        for snapshot in snapshots.values():
+            for key, value in snapshot.items():
+                if key[0] in MAX_MERGED_METRICS:
+                    samples[key] = max(samples[key], value)
+                else:
+                    samples[key] += value
+        return samples, len(snapshots) + 1
+
+    def render(self):
+        """Return the metrics of all processes in the Prometheus text
+        exposition format.
+        """
+        samples, workers_qty = self.collect()
+        by_family = defaultdict(list)
+        for (name, labels), value in samples.items():
+            family = name
+            if name.startswith('http_request_duration_seconds'):
+                family = 'http_request_duration_seconds'
+            by_family[family].append((name, labels, value))
+        lines = []
+        for family, (kind, help_text) in FAMILIES.items():
+            lines.append('# HELP {}{} {}'.format(PREFIX, family, help_text))
+            lines.append('# TYPE {}{} {}'.format(PREFIX, family, kind))
+            family_samples = sorted(by_family.get(family, []))
+            if kind == 'histogram':
+                family_samples = self._accumulate_buckets(family_samples)
+            for name, labels, value in family_samples:
+                lines.append('{}{}{} {}'.format(
+                    PREFIX, name, _format_labels(labels), _format_value(value),
+                ))
+        lines.append('# HELP {}metrics_workers Number of processes in the '
+                     'sums.'.format(PREFIX))
+        lines.append('# TYPE {}metrics_workers gauge'.format(PREFIX))
+        lines.append('{}metrics_workers {}'.format(PREFIX, workers_qty))
+        return '\n'.join(lines) + '\n'
+
+    def _accumulate_buckets(self, family_samples):
+        """Return the cumulative buckets of every bound in ascending order
+        followed by _sum and _count for every set of labels, as the format
+        requires.
+        """
+        buckets = defaultdict(dict)
+        totals = defaultdict(list)
+        for name, labels, value in family_samples:
+            if name.endswith('_bucket'):
+                labels = dict(labels)
+                bound = labels.pop('le')
+                buckets[tuple(labels.items())][bound] = value
+            else:
+                totals[labels].append((name, labels, value))
+        result = []
+        for labels in sorted(set(buckets) | set(totals)):
+            total = 0
+            for bound in map(_format_bound, DURATION_BUCKETS):
+                total += buckets[labels].get(bound, 0)
+                result.append((
+                    'http_request_duration_seconds_bucket',
+                    labels + (('le', bound),),
+                    total,
+                ))
+            # _count после _sum
+            result.extend(sorted(totals[labels], reverse=True))
+        return result
+
+
+def _escape_label_value(value):
+    return (str(value).replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(label, _escape_label_value(value))
+        for label, value in labels
+    ))
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+metrics = Metrics()
+
+
+def record_cache_lookup(name, hit):
+    """Count a lookup of the cache [name], see the module docstring."""
+    metrics.record_cache_lookup(name, hit)
+
+
+class MetricsMiddleware:
+    """Count requests of every view, see the module docstring. Place it
+    first in MIDDLEWARE to measure the time of the other middleware too.
+    Only the queries of the default database are counted.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder(request)
+        started_at = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+        duration = time.perf_counter() - started_at
+        view = get_view_name(request)
+        metrics.record_request(view, request.method, response.status_code,
+                               duration, recorder.queries_qty,
+                               recorder.duration)
+        metrics.record_queries(view, recorder.fingerprints,
+                               recorder.finish())
+        metrics.flush()
+        return response
@@ -0,0 +1,33 @@
+# Generated by Django 3.2 on 2026-10-17 15:01
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_learners_count(apps, schema_editor):
+    Training = apps.get_model('volleyballschool', 'Training')
+    learners_qty = Training.learners.through.objects.filter(
+        training=OuterRef('pk'),
+    ).order_by().values('training').annotate(
+        qty=Count('pk'),
+    ).values('qty')
+    Training.objects.update(
+        learners_count=Coalesce(Subquery(learners_qty), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('volleyballschool', '0005_alter_training_learners'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='training',
+            name='learners_count',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Количество посетителей'),
+        ),
+        migrations.RunPython(fill_learners_count, migrations.RunPython.noop),
+    ]
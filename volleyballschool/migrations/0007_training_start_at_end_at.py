@@ -0,0 +1,51 @@
+# Generated by Django 3.2 on 2026-10-17 15:30
+
+import datetime
+
+from django.db import migrations, models
+
+TRAINING_DURATION = datetime.timedelta(hours=2)
+
+
+def fill_start_at_end_at(apps, schema_editor):
+    Training = apps.get_model('volleyballschool', 'Training')
+    trainings = list(Training.objects.only('pk', 'date', 'start_time'))
+    for training in trainings:
+        training.start_at = datetime.datetime.combine(
+            training.date, training.start_time,
+        )
+        training.end_at = training.start_at + TRAINING_DURATION
+    Training.objects.bulk_update(
+        trainings, ['start_at', 'end_at'], batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('volleyballschool', '0006_training_learners_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='training',
+            name='start_at',
+            field=models.DateTimeField(db_index=True, editable=False, null=True, verbose_name='Начало'),
+        ),
+        migrations.AddField(
+            model_name='training',
+            name='end_at',
+            field=models.DateTimeField(db_index=True, editable=False, null=True, verbose_name='Окончание'),
+        ),
+        migrations.RunPython(fill_start_at_end_at, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='training',
+            name='start_at',
+            field=models.DateTimeField(db_index=True, editable=False, verbose_name='Начало'),
+        ),
+        migrations.AlterField(
+            model_name='training',
+            name='end_at',
+            field=models.DateTimeField(db_index=True, editable=False, verbose_name='Окончание'),
+        ),
+    ]
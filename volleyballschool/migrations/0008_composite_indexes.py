@@ -0,0 +1,21 @@
+# Generated by Django 3.2 on 2026-10-17 15:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('volleyballschool', '0007_training_start_at_end_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['user', 'purchase_date', 'active'], name='subscription_user_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='training',
+            index=models.Index(fields=['skill_level', 'date', 'active'], name='training_timetable_idx'),
+        ),
+    ]
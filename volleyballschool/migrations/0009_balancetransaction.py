@@ -0,0 +1,60 @@
+# Generated by Django 3.2 on 2026-10-17 15:08
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+OPENING_BALANCE = 1
+
+
+def create_opening_balances(apps, schema_editor):
+    """Переносит текущие балансы пользователей в журнал одной операцией
+    'начальный баланс' на каждого пользователя с ненулевым балансом.
+    """
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    BalanceTransaction = apps.get_model(
+        'volleyballschool', 'BalanceTransaction',
+    )
+    BalanceTransaction.objects.bulk_create(
+        [
+            BalanceTransaction(
+                user_id=user_pk, amount=balance, kind=OPENING_BALANCE,
+            )
+            for user_pk, balance in User.objects.exclude(
+                balance=0,
+            ).values_list('pk', 'balance')
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('volleyballschool', '0008_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceTransaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=9, verbose_name='Сумма (руб.)')),
+                ('kind', models.SmallIntegerField(choices=[(1, 'начальный баланс'), (2, 'пополнение'), (3, 'покупка абонемента'), (4, 'оплата разового занятия'), (5, 'возврат за разовое занятие')], verbose_name='Операция')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата и время')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_transactions', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Операция по балансу',
+                'verbose_name_plural': 'Операции по балансу',
+                'ordering': ['-created_at', '-id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='balancetransaction',
+            index=models.Index(fields=['user', '-created_at'], name='balance_user_created_at_idx'),
+        ),
+        migrations.RunPython(
+            create_opening_balances, migrations.RunPython.noop,
+        ),
+    ]
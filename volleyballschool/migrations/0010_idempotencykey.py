@@ -0,0 +1,33 @@
+# Generated by Django 3.2 on 2026-10-17 15:11
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('volleyballschool', '0009_balancetransaction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=32, unique=True, verbose_name='Ключ')),
+                ('response_url', models.CharField(blank=True, max_length=200, verbose_name='Адрес ответа')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата и время')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Ключ идемпотентности',
+                'verbose_name_plural': 'Ключи идемпотентности',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='idempotencykey',
+            index=models.Index(fields=['user', 'created_at'], name='idempotency_user_created_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2 on 2026-10-17 15:53
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('volleyballschool', '0010_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='training',
+            name='training_timetable_idx',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-17 16:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('volleyballschool', '0011_remove_training_timetable_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='balancetransaction',
+            name='kind',
+            field=models.SmallIntegerField(choices=[(1, 'начальный баланс'), (2, 'пополнение'), (3, 'покупка абонемента'), (4, 'оплата разового занятия'), (5, 'возврат за разовое занятие'), (6, 'корректировка')], verbose_name='Операция'),
+        ),
+    ]
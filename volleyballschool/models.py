@@ -2,13 +2,19 @@ import datetime
 
 from ckeditor_uploader.fields import RichTextUploadingField
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import (Case, Count, DateField, Exists,
+                              ExpressionWrapper, F, IntegerField, Min,
+                              OuterRef, Subquery, Sum, When)
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
 
 from .utils import (
-    create_trainings_based_on_timeteble_for_x_days, copy_same_fields,
-    get_upcoming_training_or_404
+    AddDays, bump_schedule_version,
+    create_trainings_based_on_timeteble_for_x_days,
+    create_trainings_based_on_timetables_for_x_days, get_copy_plan,
+    get_process_cached, get_upcoming_training_or_404
 )
 
 
@@ -34,26 +40,200 @@ class User(AbstractUser):
     def get_first_active_subscription(self, training_date):
         """returns first by purchase_date active subscription with not null
         remaining trainings of user valid for upcoming training_date or None.
+        The subscription is found by one query and nothing is saved, see
+        SubscriptionQuerySet.available_for().
 
         Args:
             training_date (datetime.date):
                 date for which the subscription activity is checked.
         """
-        subscriptions = list(
-            self.subscriptions.filter(active=True).order_by('purchase_date')
+        return self.subscriptions.available_for(training_date).first()
+
+    def credit_balance(self, amount, kind):
+        """Пополняет баланс на amount и записывает операцию в журнал
+        BalanceTransaction, см. BalanceTransaction.apply().
+
+        Returns:
+            [bool]: True, если операция выполнена.
+        """
+        return self._change_balance(amount, kind)
+
+    def debit_balance(self, amount, kind):
+        """Списывает amount с баланса, если на балансе достаточно средств, и
+        записывает операцию в журнал BalanceTransaction.
+
+        Returns:
+            [bool]: True, если средства списаны.
+        """
+        return self._change_balance(-amount, kind)
+
+    def _change_balance(self, amount, kind):
+        is_applied = BalanceTransaction(
+            user=self, amount=amount, kind=kind,
+        ).apply()
+        if is_applied:
+            self.refresh_from_db(fields=['balance'])
+        return is_applied
+
+    @classmethod
+    def recalculate_balances(cls, user_pks=None):
+        """Пересчитывает баланс пользователей (всех или с переданными pk)
+        как сумму их операций в журнале BalanceTransaction одним UPDATE.
+        """
+        transactions_sum = BalanceTransaction.objects.filter(
+            user=OuterRef('pk'),
+        ).order_by().values('user').annotate(
+            total=Sum('amount'),
+        ).values('total')
+        users = cls.objects.all()
+        if user_pks is not None:
+            users = users.filter(pk__in=user_pks)
+        return users.update(
+            balance=Coalesce(Subquery(transactions_sum), 0),
         )
-        for subscription in subscriptions:
-            subscription_is_active, remaining_trainings_qty = (
-                subscription.is_active(return_qty=True)
-            )
-            subscription_end_date = subscription.get_end_date()
-            if (
-                subscription_is_active
-                and training_date >= datetime.date.today()
-                and subscription_end_date >= training_date
-                and remaining_trainings_qty > 0
-            ):
-                return subscription
+
+
+class BalanceTransaction(models.Model):
+    """Журнал операций по балансу пользователя. Записи только добавляются,
+    User.balance хранит сумму amount всех операций пользователя и
+    изменяется вместе с добавлением записи, см. apply().
+    """
+
+    class Kinds(models.IntegerChoices):
+        OPENING_BALANCE = 1, 'начальный баланс'
+        REPLENISHMENT = 2, 'пополнение'
+        SUBSCRIPTION_PURCHASE = 3, 'покупка абонемента'
+        TRAINING_PAYMENT = 4, 'оплата разового занятия'
+        TRAINING_REFUND = 5, 'возврат за разовое занятие'
+        CORRECTION = 6, 'корректировка'
+
+    user = models.ForeignKey(
+        User,
+        verbose_name='Пользователь',
+        on_delete=models.CASCADE,
+        related_name='balance_transactions',
+    )
+    amount = models.DecimalField(
+        verbose_name='Сумма (руб.)',
+        max_digits=9,
+        decimal_places=2,
+    )
+    kind = models.SmallIntegerField(
+        verbose_name='Операция',
+        choices=Kinds.choices,
+    )
+    created_at = models.DateTimeField('Дата и время', auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at', '-id']
+        verbose_name = 'Операция по балансу'
+        verbose_name_plural = 'Операции по балансу'
+        indexes = [
+            models.Index(
+                fields=['user', '-created_at'],
+                name='balance_user_created_at_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return '{} {} {}'.format(self.user, self.get_kind_display(),
+                                 self.amount)
+
+    def clean(self):
+        if self.amount == 0:
+            raise ValidationError({
+                'amount': ValidationError(
+                    'сумма операции не должна быть равной нулю',
+                    code='invalid',
+                ),
+            })
+        if (
+            self.amount is not None and self.amount < 0
+            and self.user_id is not None
+            and self.user.balance < -self.amount
+        ):
+            raise ValidationError({
+                'amount': ValidationError(
+                    'списание больше баланса пользователя (%(balance)s)',
+                    code='invalid',
+                    params={'balance': self.user.balance},
+                ),
+            })
+
+    def apply(self):
+        """Изменяет баланс пользователя на amount атомарным
+        UPDATE balance = balance + amount (при списании с условием
+        WHERE balance >= -amount) и сохраняет операцию в той же транзакции.
+        Одновременные операции не теряют изменений и не уводят баланс в
+        минус.
+
+        Returns:
+            [bool]: False, если для списания недостаточно средств.
+        """
+        with transaction.atomic():
+            users = User.objects.filter(pk=self.user_id)
+            if self.amount < 0:
+                users = users.filter(balance__gte=-self.amount)
+            if not users.update(balance=F('balance') + self.amount):
+                return False
+            self.save()
+        return True
+
+
+class IdempotencyKey(models.Model):
+    """Ключ идемпотентности формы: скрытое поле idempotency_key, которое
+    выдается при показе формы. Первый POST с ключом выполняется и
+    запоминает адрес, на который перенаправил пользователя, повторные POST
+    с тем же ключом (двойной клик, повтор запроса прокси) только
+    перенаправляют на этот адрес. Ключи старше TTL удаляются.
+    """
+
+    TTL = datetime.timedelta(days=1)
+
+    key = models.CharField('Ключ', max_length=32, unique=True)
+    user = models.ForeignKey(
+        User,
+        verbose_name='Пользователь',
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+    response_url = models.CharField('Адрес ответа', max_length=200,
+                                    blank=True)
+    created_at = models.DateTimeField('Дата и время', auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Ключ идемпотентности'
+        verbose_name_plural = 'Ключи идемпотентности'
+        indexes = [
+            models.Index(
+                fields=['user', 'created_at'],
+                name='idempotency_user_created_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return self.key
+
+    @classmethod
+    def delete_expired(cls, user=None, batch_size=1000):
+        """Удаляет ключи старше TTL (только ключи user, если он передан)
+        пачками по batch_size, каждая пачка удаляется отдельным коротким
+        запросом и не блокирует запись в базу надолго.
+
+        Returns:
+            [int]: количество удалённых ключей
+        """
+        expired_keys = cls.objects.filter(
+            created_at__lt=datetime.datetime.now() - cls.TTL,
+        )
+        if user is not None:
+            expired_keys = expired_keys.filter(user=user)
+        deleted = 0
+        while True:
+            pks = list(expired_keys.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return deleted
+            deleted += cls.objects.filter(pk__in=pks).delete()[0]
 
 
 class News(models.Model):
@@ -118,6 +298,19 @@ class SubscriptionSample(models.Model):
                 ),
             })
 
+    @classmethod
+    def get_active(cls):
+        """Активные шаблоны абонементов из кэша процесса, см.
+        get_process_cached().
+
+        Returns:
+            [tuple]
+        """
+        return get_process_cached(
+            'active_subscription_samples',
+            lambda: tuple(cls.objects.filter(active=True)),
+        )
+
     def get_price_for_one_training(self):
         try:
             return int(self.amount / self.trainings_qty)
@@ -125,6 +318,152 @@ class SubscriptionSample(models.Model):
             return "количество тренировок не должно быть равным нулю"
 
 
+class SubscriptionQuerySet(models.QuerySet):
+
+    def with_usage(self):
+        """Аннотирует абонементы значениями, которые вычисляют методы
+        модели, но без дополнительных запросов и без сохранения:
+        used_trainings_qty, remaining_trainings_qty, first_training_date,
+        effective_start_date (см. Subscription.get_start_date()) и
+        effective_end_date (см. Subscription.get_end_date()).
+        """
+        subscription_trainings = (
+            Subscription.trainings.through.objects.filter(
+                subscription=OuterRef('pk'),
+            ).order_by().values('subscription')
+        )
+        used_trainings_qty = subscription_trainings.annotate(
+            qty=Count('pk'),
+        ).values('qty')
+        first_training_date = subscription_trainings.annotate(
+            first_date=Min('training__date'),
+        ).values('first_date')
+        return self.annotate(
+            used_trainings_qty=Coalesce(Subquery(used_trainings_qty), 0),
+            first_training_date=Subquery(
+                first_training_date, output_field=DateField(),
+            ),
+        ).annotate(
+            remaining_trainings_qty=ExpressionWrapper(
+                F('trainings_qty') - F('used_trainings_qty'),
+                output_field=IntegerField(),
+            ),
+            effective_start_date=Case(
+                When(start_date__isnull=False, then=F('start_date')),
+                When(
+                    first_training_date__lte=AddDays(F('purchase_date'), 10),
+                    then=F('first_training_date'),
+                ),
+                default=F('purchase_date'),
+                output_field=DateField(),
+            ),
+        ).annotate(
+            effective_end_date=Case(
+                When(end_date__isnull=False, then=F('end_date')),
+                default=AddDays(F('effective_start_date'), F('validity')),
+                output_field=DateField(),
+            ),
+        )
+
+    def with_activity(self):
+        """with_usage() и currently_active: действителен ли абонемент
+        сегодня, то же, что is_active(readonly=True), но без
+        дополнительных запросов.
+        """
+        today = datetime.date.today()
+        cancellable_trainings = Training.objects.filter(
+            subscription=OuterRef('pk'),
+        ).cancellable()
+        return self.with_usage().annotate(
+            currently_active=Case(
+                When(active=False, then=False),
+                When(effective_end_date__lt=today, then=False),
+                When(remaining_trainings_qty__gt=0, then=True),
+                When(Exists(cancellable_trainings), then=True),
+                default=False,
+                output_field=models.BooleanField(),
+            ),
+        )
+
+    def available_for(self, training_date):
+        """Активные абонементы с оставшимися тренировками, действительные на
+        дату предстоящей тренировки training_date, в порядке покупки.
+        """
+        if training_date < datetime.date.today():
+            return self.none()
+        return self.filter(active=True).with_usage().filter(
+            remaining_trainings_qty__gt=0,
+            effective_end_date__gte=training_date,
+        ).order_by('purchase_date', 'pk')
+
+    def finalize_lifecycle(self):
+        """Одним набором UPDATE-запросов сохраняет наступившие даты начала и
+        окончания действия абонементов и деактивирует завершившиеся
+        абонементы, то есть делает для всех абонементов то же, что
+        get_start_date(), get_end_date() и is_active() делают для одного.
+        Предназначен для периодического запуска (команда
+        finalizesubscriptions), после чего методы модели можно вызывать с
+        readonly=True.
+
+        Returns:
+            [dict]: количество обновленных абонементов на каждом шаге
+        """
+        today = datetime.date.today()
+        first_training_date = Subquery(
+            Subscription.trainings.through.objects.filter(
+                subscription=OuterRef('pk'),
+            ).order_by('training__date').values('training__date')[:1],
+            output_field=DateField(),
+        )
+        with transaction.atomic():
+            started_by_training = self.filter(
+                start_date__isnull=True,
+            ).annotate(
+                first_training_date=first_training_date,
+            ).filter(
+                first_training_date__lte=AddDays(F('purchase_date'), 10),
+                first_training_date__lt=today,
+            ).update(
+                start_date=first_training_date,
+                end_date=AddDays(first_training_date, F('validity')),
+            )
+            started_by_purchase = self.filter(
+                start_date__isnull=True,
+                purchase_date__lt=today - datetime.timedelta(days=10),
+            ).update(
+                start_date=F('purchase_date'),
+                end_date=AddDays(F('purchase_date'), F('validity')),
+            )
+            end_dates = self.filter(
+                start_date__isnull=False,
+                end_date__isnull=True,
+            ).update(
+                end_date=AddDays(F('start_date'), F('validity')),
+            )
+            expired = self.filter(
+                pk__in=self.filter(active=True).with_usage().filter(
+                    effective_end_date__lt=today,
+                ).values('pk'),
+            ).update(active=False)
+            cancellable_trainings = Training.objects.filter(
+                subscription=OuterRef('pk'),
+            ).cancellable()
+            used_up = self.filter(
+                pk__in=self.filter(active=True).with_usage().filter(
+                    remaining_trainings_qty__lte=0,
+                ).exclude(
+                    Exists(cancellable_trainings),
+                ).values('pk'),
+            ).update(active=False)
+        return {
+            'started_by_training': started_by_training,
+            'started_by_purchase': started_by_purchase,
+            'end_dates': end_dates,
+            'expired': expired,
+            'used_up': used_up,
+        }
+
+
 class Subscription(models.Model):
     """
     Конкретный абонемент пользователя.
@@ -165,9 +504,19 @@ class Subscription(models.Model):
     )
     active = models.BooleanField('Активный', default=True)
 
+    objects = SubscriptionQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Абонемент пользователя'
         verbose_name_plural = 'Абонементы пользователей'
+        indexes = [
+            # get_first_active_subscription(), AccountView: пользователь,
+            # сортировка по дате покупки, active проверяется по индексу
+            models.Index(
+                fields=['user', 'purchase_date', 'active'],
+                name='subscription_user_active_idx',
+            ),
+        ]
 
     def __str__(self):
         return (
@@ -177,10 +526,16 @@ class Subscription(models.Model):
             )
         )
 
-    def get_start_date(self):
+    def get_start_date(self, readonly=False):
         """Дата отсчёта срока действия абонемента.
         Отсчёт с момента первого посещения тренировки, но не позднее чем через
         10 дней с момента покупки абонемента.
+
+        Args:
+            readonly (bool, optional):
+                При readonly=True наступившая дата начала не сохраняется в
+                базу данных, её сохраняет finalize_lifecycle().
+                Defaults to False.
         Returns:
             [datetime.date]
         """
@@ -191,26 +546,28 @@ class Subscription(models.Model):
                                   + datetime.timedelta(days=10))
         validity = datetime.timedelta(days=self.validity)
         if first_training and first_training.date <= ten_days_from_purchase:
-            if datetime.date.today() > first_training.date:
+            if datetime.date.today() > first_training.date and not readonly:
                 self.start_date = first_training.date
                 self.end_date = self.start_date + validity
                 self.save(update_fields=['start_date', 'end_date'])
             return first_training.date
-        if datetime.date.today() > ten_days_from_purchase:
+        if datetime.date.today() > ten_days_from_purchase and not readonly:
             self.start_date = self.purchase_date
             self.end_date = self.start_date + validity
             self.save(update_fields=['start_date', 'end_date'])
         return self.purchase_date
 
-    def get_end_date(self):
+    def get_end_date(self, readonly=False):
         if self.end_date:
             return self.end_date
         if not self.start_date:
-            start_date = self.get_start_date()
+            start_date = self.get_start_date(readonly=readonly)
             if self.end_date:
                 return self.end_date
         validity = datetime.timedelta(days=self.validity)
         if self.start_date:
+            if readonly:
+                return self.start_date + validity
             self.end_date = self.start_date + validity
             self.save(update_fields=['end_date'])
             return self.end_date
@@ -219,7 +576,7 @@ class Subscription(models.Model):
     def get_remaining_trainings_qty(self):
         return self.trainings_qty - self.trainings.count()
 
-    def is_active(self, return_qty=False):
+    def is_active(self, return_qty=False, readonly=False):
         """Возвращает False, если абонемент не активен.
         Если абонемент активен, то проверяет его действительность по
         временным рамкам и количеству посещенных тренировок по абонементу. И
@@ -232,14 +589,19 @@ class Subscription(models.Model):
                 возвращает вторым значением количество тренировок доступных по
                 текущему абонементу.
                 Defaults to False.
+            readonly (bool, optional):
+                При readonly=True ничего не сохраняется в базу данных,
+                завершившиеся абонементы деактивирует finalize_lifecycle().
+                Defaults to False.
         """
         if self.active is False:
             if return_qty is False:
                 return False
             return False, self.get_remaining_trainings_qty()
-        if datetime.date.today() > self.get_end_date():
-            self.active = False
-            self.save(update_fields=['active'])
+        if datetime.date.today() > self.get_end_date(readonly=readonly):
+            if not readonly:
+                self.active = False
+                self.save(update_fields=['active'])
             if return_qty is False:
                 return False
             return False, self.get_remaining_trainings_qty()
@@ -247,8 +609,9 @@ class Subscription(models.Model):
         if remaining_trainings_qty <= 0:
             last_training = self.trainings.order_by('date').last()
             if not last_training.is_more_than_an_hour_before_start():
-                self.active = False
-                self.save(update_fields=['active'])
+                if not readonly:
+                    self.active = False
+                    self.save(update_fields=['active'])
                 if return_qty is False:
                     return False
                 return False, remaining_trainings_qty
@@ -273,10 +636,19 @@ class OneTimeTraining(models.Model):
         return 'Изменить стоимость разового занятия'
 
     def save(self, *args, **kwargs):
-        if OneTimeTraining.objects.first():
+        if self.pk is None and OneTimeTraining.objects.exists():
             return
         super().save(*args, **kwargs)
 
+    @classmethod
+    def get_cached(cls):
+        """Единственная запись из кэша процесса, см. get_process_cached().
+
+        Returns:
+            [OneTimeTraining | None]
+        """
+        return get_process_cached('one_time_training', cls.objects.first)
+
 
 class Court(models.Model):
     """Волейбольные залы"""
@@ -395,6 +767,8 @@ class TimetableSample(models.Model):
 
 class Timetable(TimetableSample):
 
+    DAYS_OF_UPCOMING_TRAININGS = 15
+
     class Meta:
         verbose_name = 'Расписание'
         verbose_name_plural = 'Расписание'
@@ -409,37 +783,140 @@ class Timetable(TimetableSample):
         )
 
     def save(self, *args, **kwargs):
-        if self.id:  # если расписание уже создано ранее
-            self_before_saving = Timetable.objects.get(pk=self.pk)
-            matching_trainings = Training.objects.filter(
-                date__gte=datetime.date.today(),
-                skill_level=self_before_saving.skill_level,
-                court=self_before_saving.court,
-                day_of_week=self_before_saving.day_of_week,
-                status=1,
-            )
-            if matching_trainings:
-                for training in matching_trainings:
-                    copy_same_fields(self, training)
-                    training.save()  # копируем поля на случай если изменились
-        super().save(*args, **kwargs)
-        self.create_upcoming_trainings()
+        """Сохраняет расписание и переносит изменившиеся поля в предстоящие
+        тренировки этого расписания.
+
+        Returns:
+            [int]: количество измененных тренировок
+        """
+        updated_trainings_qty = 0
+        with transaction.atomic():
+            if self.id:  # если расписание уже создано ранее
+                self_before_saving = Timetable.objects.get(pk=self.pk)
+                updated_trainings_qty = self.update_upcoming_trainings(
+                    self_before_saving,
+                )
+            super().save(*args, **kwargs)
+            self.create_upcoming_trainings()
+        return updated_trainings_qty
 
     def delete(self, *args, **kwargs):
-        matching_trainings = Training.objects.filter(
-                date__gte=datetime.date.today(),
-                skill_level=self.skill_level,
-                court=self.court,
-                day_of_week=self.day_of_week,
+        with transaction.atomic():
+            trainings_deleted, trainings_deleted_per_model = (
+                self._get_upcoming_trainings(self).delete()
             )
-        if matching_trainings:
-            matching_trainings.delete()
-        super().delete(*args, **kwargs)
+            deleted, deleted_per_model = super().delete(*args, **kwargs)
+        for model_label, qty in trainings_deleted_per_model.items():
+            deleted_per_model[model_label] = (
+                deleted_per_model.get(model_label, 0) + qty
+            )
+        return trainings_deleted + deleted, deleted_per_model
+
+    def update_upcoming_trainings(self, self_before_saving):
+        """Копирует поля, изменившиеся по сравнению с self_before_saving, в
+        предстоящие тренировки расписания со статусом OK одним UPDATE.
+
+        Returns:
+            [int]: количество измененных тренировок
+        """
+        changed_fields = {
+            attname: getattr(self, attname)
+            for attname in get_copy_plan(Timetable, Training)
+            if getattr(self, attname) != getattr(self_before_saving, attname)
+        }
+        if not changed_fields:
+            return 0
+        updated_trainings_qty = self._get_upcoming_trainings(
+            self_before_saving,
+        ).filter(
+            status=Training.ListOfStatuses.OK,
+        ).update(**changed_fields)
+        if updated_trainings_qty:
+            if 'start_time' in changed_fields:
+                self._get_upcoming_trainings(self).filter(
+                    status=Training.ListOfStatuses.OK,
+                    start_time=self.start_time,
+                ).sync_start_and_end()
+            bump_schedule_version()  # update() не отправляет сигналы
+        return updated_trainings_qty
+
+    @staticmethod
+    def _get_upcoming_trainings(timetable):
+        return Training.objects.filter(
+            date__gte=datetime.date.today(),
+            skill_level=timetable.skill_level,
+            court_id=timetable.court_id,
+            day_of_week=timetable.day_of_week,
+        )
 
     def create_upcoming_trainings(self, from_monday=False):
+        """Returns:
+            [tuple]: number of created trainings, number of skipped trainings
+        """
         if self.active is True:
-            create_trainings_based_on_timeteble_for_x_days(self, Training, 15,
-                                                           from_monday)
+            return create_trainings_based_on_timeteble_for_x_days(
+                self, Training, self.DAYS_OF_UPCOMING_TRAININGS, from_monday,
+            )
+        return 0, 0
+
+    @classmethod
+    def create_upcoming_trainings_for_active_timetables(cls,
+                                                        from_monday=False):
+        """Create upcoming trainings for all active timetables with one query
+        for existing trainings and one bulk insert.
+
+        Returns:
+            [tuple]: number of created trainings, number of skipped trainings
+        """
+        return create_trainings_based_on_timetables_for_x_days(
+            cls.objects.filter(active=True),
+            Training,
+            cls.DAYS_OF_UPCOMING_TRAININGS,
+            from_monday,
+        )
+
+
+class TrainingQuerySet(models.QuerySet):
+
+    def upcoming(self):
+        """Тренировки, которые еще не закончились."""
+        return self.filter(end_at__gt=datetime.datetime.now())
+
+    def cancellable(self):
+        """Тренировки, запись на которые еще можно отменить (более чем за
+        час до начала).
+        """
+        an_hour_later = datetime.datetime.now() + datetime.timedelta(hours=1)
+        return self.filter(start_at__gt=an_hour_later)
+
+    def in_progress(self):
+        now = datetime.datetime.now()
+        return self.filter(start_at__lte=now, end_at__gt=now)
+
+    def with_registration(self, user):
+        """Аннотирует тренировки флагом is_registered: записан ли user на
+        тренировку, без загрузки пользователей.
+        """
+        return self.annotate(
+            is_registered=Exists(
+                Training.learners.through.objects.filter(
+                    training=OuterRef('pk'), user=user.pk,
+                ),
+            ),
+        )
+
+    def sync_start_and_end(self):
+        """Пересчитывает start_at и end_at тренировок после update() полей
+        date или start_time: один SELECT и один bulk_update().
+
+        Returns:
+            [int]: количество тренировок
+        """
+        trainings = list(self.only('pk', 'date', 'start_time'))
+        for training in trainings:
+            training.set_start_and_end()
+        self.model.objects.bulk_update(trainings, ['start_at', 'end_at'])
+        return len(trainings)
 
 
 class Training(TimetableSample):
@@ -464,7 +941,24 @@ class Training(TimetableSample):
         blank=True,
         related_name='trainings',
     )
+    learners_count = models.PositiveSmallIntegerField(
+        verbose_name='Количество посетителей',
+        default=0,
+        editable=False,
+    )
     date = models.DateField('Дата')
+    start_at = models.DateTimeField(
+        verbose_name='Начало',
+        editable=False,
+        db_index=True,
+    )
+    end_at = models.DateTimeField(
+        verbose_name='Окончание',
+        editable=False,
+        db_index=True,
+    )
+
+    objects = TrainingQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Тренировка'
@@ -498,15 +992,59 @@ class Training(TimetableSample):
             })
 
     def get_free_places(self):
-        free_places = self.MAX_LEARNERS_PER_TRAINING - self.learners.count()
+        free_places = self.MAX_LEARNERS_PER_TRAINING - self.learners_count
         return free_places
 
+    def add_learner(self, user):
+        """Записывает пользователя на тренировку, если есть свободные места.
+        Место резервируется условным UPDATE ... WHERE learners_count < MAX,
+        который блокирует строку тренировки до конца транзакции, поэтому
+        одновременные запросы не могут превысить MAX_LEARNERS_PER_TRAINING.
+        Вызывайте внутри transaction.atomic() вместе с оплатой тренировки.
+
+        Returns:
+            [bool]: True, если место зарезервировано и пользователь записан.
+        """
+        with transaction.atomic():
+            place_is_reserved = Training.objects.filter(
+                pk=self.pk,
+                learners_count__lt=self.MAX_LEARNERS_PER_TRAINING,
+            ).update(learners_count=F('learners_count') + 1)
+            if place_is_reserved:
+                self.learners.add(user)
+        return bool(place_is_reserved)
+
     @classmethod
-    def get_upcoming_training_or_404(cls, pk):
-        return get_upcoming_training_or_404(cls, pk)
+    def update_learners_count(cls, training_pks):
+        """Пересчитывает learners_count тренировок с переданными pk одним
+        UPDATE по таблице связи с посетителями.
+        """
+        learners_qty = cls.learners.through.objects.filter(
+            training=OuterRef('pk'),
+        ).order_by().values('training').annotate(
+            qty=Count('pk'),
+        ).values('qty')
+        cls.objects.filter(pk__in=training_pks).update(
+            learners_count=Coalesce(Subquery(learners_qty), 0),
+        )
 
-    def get_end_datetime(self):
-        start_datetime = datetime.datetime(
+    @classmethod
+    def get_upcoming_training_or_404(cls, pk, user=None):
+        return get_upcoming_training_or_404(cls, pk, user)
+
+    def save(self, *args, **kwargs):
+        self.set_start_and_end()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'date', 'start_time'} & set(
+                update_fields):
+            kwargs['update_fields'] = {*update_fields, 'start_at', 'end_at'}
+        super().save(*args, **kwargs)
+
+    def set_start_and_end(self):
+        """Вычисляет start_at и end_at по date и start_time. Вызывайте перед
+        bulk_create(), save() делает это сам.
+        """
+        self.start_at = datetime.datetime(
             year=self.date.year,
             month=self.date.month,
             day=self.date.day,
@@ -514,8 +1052,12 @@ class Training(TimetableSample):
             minute=self.start_time.minute,
             second=self.start_time.second,
         )
-        end_datetime = start_datetime + self.TRAINING_DURATION
-        return end_datetime
+        self.end_at = self.start_at + self.TRAINING_DURATION
+
+    def get_end_datetime(self):
+        if self.end_at is None:
+            self.set_start_and_end()
+        return self.end_at
 
     def is_more_than_an_hour_before_start(self):
         start_time = self.get_end_datetime() - self.TRAINING_DURATION
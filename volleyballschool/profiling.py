@@ -0,0 +1,155 @@
+"""Sampling cProfile profiler of requests for production.
+
+ProfilingMiddleware does nothing until profiling is turned on by
+`manage.py profiling on`, which writes the control file CONTROL_FILE_NAME
+to settings.PROFILING_DIR. Every process checks the control file at most
+once in REFRESH_INTERVAL seconds, so profiling is turned on and off
+without restarting workers. When it is on:
+
+    every           - every N-th request on average is profiled
+    slower_than     - if set, only profiles of requests slower than this
+                      number of seconds are saved
+
+Only sampled requests are profiled, so set every to 1 to catch every slow
+request at the cost of profiling all requests. A process profiles one
+request at a time. Profiles are saved as
+PROFILING_DIR/<url name>/<time>-<duration>ms-<pid>.prof, at most
+MAX_DUMPS_PER_VIEW per url name, and `manage.py profiling report`
+summarizes them into top-functions reports per url name.
+"""
+import cProfile
+import datetime
+import json
+import os
+import random
+import re
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+from .querylog import get_view_name
+
+CONTROL_FILE_NAME = 'profiling.json'
+REPORT_FILE_NAME = 'report.txt'
+REFRESH_INTERVAL = 5  # секунд
+MAX_DUMPS_PER_VIEW = 100
+UNSAFE_FILE_NAME_CHARS_RE = re.compile(r'[^\w.-]')
+
+
+def get_profiling_dir():
+    return Path(settings.PROFILING_DIR)
+
+
+def read_control_file():
+    """Return the profiling settings from the control file or None if
+    profiling is turned off.
+
+    Returns:
+        [dict]: {'every': int, 'slower_than': float or None}
+    """
+    try:
+        with open(get_profiling_dir() / CONTROL_FILE_NAME) as control_file:
+            return json.load(control_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_control_file(every, slower_than=None):
+    """Turn profiling on in all processes, see the module docstring."""
+    profiling_dir = get_profiling_dir()
+    profiling_dir.mkdir(parents=True, exist_ok=True)
+    # запись через временный файл, чтобы процессы не прочли половину файла
+    temporary_path = profiling_dir / '{}.{}'.format(
+        CONTROL_FILE_NAME, os.getpid(),
+    )
+    with open(temporary_path, 'w') as control_file:
+        json.dump({'every': every, 'slower_than': slower_than}, control_file)
+    os.replace(temporary_path, profiling_dir / CONTROL_FILE_NAME)
+
+
+def delete_control_file():
+    """Turn profiling off in all processes."""
+    try:
+        os.remove(get_profiling_dir() / CONTROL_FILE_NAME)
+    except FileNotFoundError:
+        pass
+
+
+def get_dump_dir(view_name):
+    return get_profiling_dir() / UNSAFE_FILE_NAME_CHARS_RE.sub(
+        '-', view_name,
+    )
+
+
+class ProfilingMiddleware:
+    """Profile sampled requests, see the module docstring."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self._lock = threading.Lock()
+        self._checked_at = None
+        self._control_file_mtime = None
+        self._config = None
+
+    def __call__(self, request):
+        config = self._get_config()
+        if (
+            config is None
+            or random.random() * config['every'] >= 1
+            # профилировщик не может работать в двух потоках одновременно
+            or not self._lock.acquire(blocking=False)
+        ):
+            return self.get_response(request)
+        try:
+            profile = cProfile.Profile()
+            started_at = time.perf_counter()
+            profile.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profile.disable()
+            duration = time.perf_counter() - started_at
+            slower_than = config.get('slower_than')
+            if slower_than is None or duration > slower_than:
+                self._save(profile, get_view_name(request), duration)
+        finally:
+            self._lock.release()
+        return response
+
+    def _get_config(self):
+        now = time.monotonic()
+        if (
+            self._checked_at is not None
+            and now - self._checked_at < REFRESH_INTERVAL
+        ):
+            return self._config
+        self._checked_at = now
+        try:
+            mtime = os.stat(
+                get_profiling_dir() / CONTROL_FILE_NAME
+            ).st_mtime_ns
+        except OSError:
+            self._control_file_mtime = self._config = None
+            return None
+        if mtime != self._control_file_mtime:
+            self._control_file_mtime = mtime
+            self._config = read_control_file()
+        return self._config
+
+    def _save(self, profile, view_name, duration):
+        dump_dir = get_dump_dir(view_name)
+        dump_dir.mkdir(parents=True, exist_ok=True)
+        profile.dump_stats(dump_dir / '{}-{}ms-{}.prof'.format(
+            datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'),
+            round(duration * 1000),
+            os.getpid(),
+        ))
+        # старые профили удаляются, имена начинаются со времени
+        dumps = sorted(dump_dir.glob('*.prof'))
+        for dump in dumps[:-MAX_DUMPS_PER_VIEW]:
+            try:
+                dump.unlink()
+            except FileNotFoundError:  # удален другим процессом
+                pass
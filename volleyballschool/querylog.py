@@ -0,0 +1,151 @@
+"""Database query instrumentation: fingerprints, the slow query log and
+suspected N+1 queries.
+
+QueryRecorder is an execute wrapper (connection.execute_wrapper()) which
+measures the queries of a request and groups them by fingerprint(): the
+SQL with literals and placeholders replaced by ? and lists of values
+collapsed, so one ORM query with different values has one fingerprint.
+
+    - queries slower than SLOW_QUERY_THRESHOLD seconds are logged to the
+      'volleyballschool.queries' logger with the line of the project code
+      which ran them;
+    - a SELECT fingerprint repeated N_PLUS_ONE_THRESHOLD or more times in
+      one request is logged as a suspected N+1 by finish().
+
+MetricsMiddleware records every request with it and exposes the counts
+and times per fingerprint and view, see volleyballschool.metrics.
+"""
+import functools
+import hashlib
+import logging
+import os
+import re
+import sys
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger('volleyballschool.queries')
+
+SLOW_QUERY_THRESHOLD = 0.1  # секунд
+N_PLUS_ONE_THRESHOLD = 5
+
+WHITESPACE_RE = re.compile(r'\s+')
+STRING_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL_RE = re.compile(r'(?<![\w."])-?\d+(?:\.\d+)?\b')
+PLACEHOLDER_RE = re.compile(r'%s|\?')
+VALUES_LIST_RE = re.compile(r'\((?:\?, )*\?\)(?:, \((?:\?, )*\?\))*')
+# имена точек сохранения Django уникальны, например "s140_x1"
+SAVEPOINT_RE = re.compile(r'"s\d+_x\d+"')
+# модули, строки которых не являются местом вызова запроса
+INSTRUMENTATION_FILES = {
+    os.path.join(os.path.dirname(__file__), name)
+    for name in ('querylog.py', 'metrics.py', 'profiling.py')
+}
+
+
+@functools.lru_cache(maxsize=2048)
+def fingerprint(sql):
+    """Return the fingerprint of [sql] and its short id.
+
+    Returns:
+        [tuple]: (id, normalized SQL)
+    """
+    normalized = WHITESPACE_RE.sub(' ', sql.strip())
+    normalized = STRING_LITERAL_RE.sub('?', normalized)
+    normalized = NUMBER_LITERAL_RE.sub('?', normalized)
+    normalized = PLACEHOLDER_RE.sub('?', normalized)
+    normalized = VALUES_LIST_RE.sub('(...)', normalized)
+    normalized = SAVEPOINT_RE.sub('?', normalized)
+    fingerprint_id = hashlib.sha1(normalized.encode()).hexdigest()[:12]
+    return fingerprint_id, normalized
+
+
+def get_view_name(request):
+    """Url name of the view of [request], 'unmatched' for urls without a
+    view, so they do not multiply the labels of metrics.
+    """
+    match = request.resolver_match
+    return match.view_name if match else 'unmatched'
+
+
+def _get_caller():
+    """Return 'path:line in function' of the innermost frame of the
+    project code outside of the instrumentation, or None.
+    """
+    base_dir = str(settings.BASE_DIR) + os.sep
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if (
+            filename.startswith(base_dir)
+            and filename not in INSTRUMENTATION_FILES
+            and 'site-packages' not in filename
+        ):
+            return '{}:{} in {}'.format(
+                os.path.relpath(filename, base_dir), frame.f_lineno,
+                frame.f_code.co_name,
+            )
+        frame = frame.f_back
+    return None
+
+
+class QueryRecorder:
+    """Execute wrapper which records the queries of [request], see the
+    module docstring.
+
+    Attributes:
+        queries_qty ([int]): number of queries
+        duration ([float]): time of the queries, seconds
+        fingerprints ([dict]): {(id, normalized SQL): [count, total time,
+            max time]} of the queries
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.queries_qty = 0
+        self.duration = 0.0
+        self.fingerprints = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started_at = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started_at
+            self.queries_qty += 1
+            self.duration += duration
+            key = fingerprint(sql)
+            stats = self.fingerprints.get(key)
+            if stats is None:
+                self.fingerprints[key] = [1, duration, duration]
+            else:
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] = max(stats[2], duration)
+            if duration >= SLOW_QUERY_THRESHOLD:
+                logger.warning(
+                    'Slow query %.1fms in %s at %s: %s',
+                    duration * 1000, get_view_name(self.request),
+                    _get_caller() or 'unknown', key[1],
+                )
+
+    def finish(self):
+        """Log SELECT fingerprints repeated N_PLUS_ONE_THRESHOLD or more
+        times.
+
+        Returns:
+            [list]: (id, normalized SQL) of the suspected N+1 queries
+        """
+        suspected = [
+            key for key, (count, _, _) in self.fingerprints.items()
+            if count >= N_PLUS_ONE_THRESHOLD
+            and key[1].upper().startswith('SELECT')
+        ]
+        for key in suspected:
+            logger.warning(
+                'Suspected N+1 in %s: %d queries %s',
+                get_view_name(self.request), self.fingerprints[key][0],
+                key[1],
+            )
+        return suspected
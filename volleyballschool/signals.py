@@ -0,0 +1,70 @@
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete)
+from django.dispatch import receiver
+
+from .events import publish_free_places
+from .models import (OneTimeTraining, SubscriptionSample, Timetable, Training,
+                     User)
+from .utils import bump_prices_version, bump_schedule_version
+
+
+@receiver(post_save, sender=Training)
+@receiver(post_delete, sender=Training)
+@receiver(post_save, sender=Timetable)
+@receiver(post_delete, sender=Timetable)
+def invalidate_timetable_cache(sender, **kwargs):
+    bump_schedule_version()
+
+
+@receiver(post_save, sender=OneTimeTraining)
+@receiver(post_delete, sender=OneTimeTraining)
+@receiver(post_save, sender=SubscriptionSample)
+@receiver(post_delete, sender=SubscriptionSample)
+def invalidate_prices_cache(sender, **kwargs):
+    bump_prices_version()
+
+
+@receiver(m2m_changed, sender=Training.learners.through)
+def invalidate_timetable_cache_on_learners_change(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_schedule_version()
+
+
+@receiver(m2m_changed, sender=Training.learners.through)
+def update_learners_count(sender, instance, action, reverse, pk_set,
+                          **kwargs):
+    if action == 'pre_clear' and reverse:
+        instance._cleared_training_pks = list(
+            instance.trainings.values_list('pk', flat=True)
+        )
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        training_pks = [instance.pk]
+        Training.update_learners_count(training_pks)
+        instance.refresh_from_db(fields=['learners_count'])
+    elif action == 'post_clear':
+        training_pks = instance.__dict__.pop('_cleared_training_pks', [])
+        Training.update_learners_count(training_pks)
+    else:
+        training_pks = pk_set
+        Training.update_learners_count(training_pks)
+    publish_free_places(training_pks)
+
+
+# связи с тренировками удаляются каскадом без m2m_changed
+@receiver(pre_delete, sender=User)
+def remember_trainings_of_deleted_user(sender, instance, **kwargs):
+    instance._deleted_training_pks = list(
+        instance.trainings.values_list('pk', flat=True)
+    )
+
+
+@receiver(post_delete, sender=User)
+def update_learners_count_of_deleted_user(sender, instance, **kwargs):
+    training_pks = instance.__dict__.pop('_deleted_training_pks', [])
+    if not training_pks:
+        return
+    Training.update_learners_count(training_pks)
+    bump_schedule_version()
+    publish_free_places(training_pks)
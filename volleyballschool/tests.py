@@ -1,17 +1,42 @@
+import asyncio
 import datetime
+import re
+import shutil
+import tempfile
+import time
+from io import StringIO
+from pathlib import Path
 from unittest import mock
 
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Count, Sum
 from django.http.response import Http404
-from django.test import TestCase
+from django.test import LiveServerTestCase, RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import NoReverseMatch, reverse
 
-from .models import (Article, Coach, Court, News, OneTimeTraining,
-                     Subscription, SubscriptionSample, Timetable, Training,
-                     User)
-from .utils import (_date_of_the_current_week_monday,
-                    cancel_registration_for_training, copy_same_fields,
+from . import profiling, querylog, urls
+from .events import hub, sse_application, training_channel
+from .management.commands import (benchmarktimetable, checkqueryplans,
+                                  loadtestregistration)
+from .metrics import (DURATION_BUCKETS, WORKER_CACHE_KEY, WORKERS_CACHE_KEY,
+                      Metrics, metrics)
+from .querylog import QueryRecorder, fingerprint
+from .models import (Article, BalanceTransaction, Coach, Court,
+                     IdempotencyKey, News, OneTimeTraining, Subscription,
+                     SubscriptionSample, Timetable, Training, User)
+from .utils import (_date_of_the_current_week_monday, bump_prices_version,
+                    bump_schedule_version, cancel_registration_for_training,
+                    copy_same_fields, copy_same_fields_to_many,
                     create_trainings_based_on_timeteble_for_x_days,
-                    get_start_date_and_end_date, transform_for_timetable)
+                    create_trainings_based_on_timetables_for_x_days,
+                    get_copy_plan, get_schedule_version,
+                    get_start_date_and_end_date, get_timetable_range,
+                    is_registered_for_training, transform_for_timetable)
 
 
 class UserModelGetFirstActiveSubscriptionTests(TestCase):
@@ -123,6 +148,129 @@ class UserModelGetFirstActiveSubscriptionTests(TestCase):
             second_active_sub
         )
 
+    def test_one_query_without_saving(self):
+        active_sub = Subscription.objects.create(
+            active=True, user=self.user, trainings_qty=2, validity=30)
+        active_sub.trainings.add(self.future_training)
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.user.get_first_active_subscription(
+                    training_date=self.today,
+                ),
+                active_sub
+            )
+
+    def test_subscription_for_date_after_end_date(self):
+        active_sub = Subscription.objects.create(
+            active=True, user=self.user, trainings_qty=2, validity=30)
+        active_sub.purchase_date = self.today-datetime.timedelta(days=5)
+        active_sub.save(update_fields=['purchase_date'])
+        self.assertIsNone(
+            self.user.get_first_active_subscription(
+                training_date=self.today+datetime.timedelta(days=26),
+            )
+        )
+        self.assertEqual(
+            self.user.get_first_active_subscription(
+                training_date=self.today+datetime.timedelta(days=25),
+            ),
+            active_sub
+        )
+
+
+class UserModelBalanceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # Set up data for the whole TestCase
+        cls.user = User.objects.create_user('test_user')
+
+    def test_credit_and_debit_balance(self):
+        self.assertTrue(self.user.credit_balance(
+            1000, BalanceTransaction.Kinds.REPLENISHMENT))
+        self.assertTrue(self.user.debit_balance(
+            900, BalanceTransaction.Kinds.SUBSCRIPTION_PURCHASE))
+        self.assertEqual(self.user.balance, 100)
+        self.assertEqual(User.objects.get(pk=self.user.pk).balance, 100)
+        self.assertEqual(
+            list(self.user.balance_transactions.values_list(
+                'kind', 'amount')),
+            [(BalanceTransaction.Kinds.SUBSCRIPTION_PURCHASE, -900),
+             (BalanceTransaction.Kinds.REPLENISHMENT, 1000)],
+        )
+
+    def test_debit_balance_if_user_has_no_enough_money(self):
+        self.user.credit_balance(899, BalanceTransaction.Kinds.REPLENISHMENT)
+        self.assertFalse(self.user.debit_balance(
+            900, BalanceTransaction.Kinds.TRAINING_PAYMENT))
+        self.assertEqual(User.objects.get(pk=self.user.pk).balance, 899)
+        self.assertEqual(self.user.balance_transactions.count(), 1)
+
+    def test_debit_balance_does_not_lose_concurrent_changes(self):
+        self.user.credit_balance(900, BalanceTransaction.Kinds.REPLENISHMENT)
+        stale_user = User.objects.get(pk=self.user.pk)
+        self.user.debit_balance(
+            900, BalanceTransaction.Kinds.SUBSCRIPTION_PURCHASE)
+        # баланс в памяти устарел, но списание проверяется в базе
+        self.assertFalse(stale_user.debit_balance(
+            900, BalanceTransaction.Kinds.SUBSCRIPTION_PURCHASE))
+        self.assertEqual(stale_user.balance, 900)
+        self.assertEqual(User.objects.get(pk=self.user.pk).balance, 0)
+
+    def test_recalculate_balances(self):
+        user2 = User.objects.create_user('test_user2', balance=500)
+        self.user.credit_balance(300, BalanceTransaction.Kinds.REPLENISHMENT)
+        User.objects.filter(pk=self.user.pk).update(balance=0)
+        self.assertEqual(User.recalculate_balances(), 2)
+        self.assertEqual(User.objects.get(pk=self.user.pk).balance, 300)
+        self.assertEqual(User.objects.get(pk=user2.pk).balance, 0)
+
+
+class BalanceTransactionAdminTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # Set up data for the whole TestCase
+        cls.user = User.objects.create_user('test_user')
+        cls.user.credit_balance(500, BalanceTransaction.Kinds.REPLENISHMENT)
+        cls.staff = User.objects.create_superuser('staff')
+        cls.url = reverse('admin:volleyballschool_balancetransaction_add')
+
+    def setUp(self):
+        self.client.force_login(self.staff)
+
+    def test_correction_changes_balance(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        for amount, balance in ((-200, 300), (50, 350)):
+            response = self.client.post(
+                self.url, {'user': self.user.pk, 'amount': amount},
+            )
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(User.objects.get(pk=self.user.pk).balance,
+                             balance)
+        self.assertEqual(
+            list(self.user.balance_transactions.values_list(
+                'kind', 'amount')),
+            [(BalanceTransaction.Kinds.CORRECTION, 50),
+             (BalanceTransaction.Kinds.CORRECTION, -200),
+             (BalanceTransaction.Kinds.REPLENISHMENT, 500)],
+        )
+        correction = self.user.balance_transactions.first()
+        response = self.client.get(reverse(
+            'admin:volleyballschool_balancetransaction_change',
+            args=[correction.pk],
+        ))
+        self.assertEqual(response.status_code, 200)
+
+    def test_correction_can_not_make_balance_negative(self):
+        for amount in (-501, 0):
+            response = self.client.post(
+                self.url, {'user': self.user.pk, 'amount': amount},
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.context['adminform'].form.errors)
+        self.assertEqual(User.objects.get(pk=self.user.pk).balance, 500)
+        self.assertEqual(self.user.balance_transactions.count(), 1)
+
 
 class SubscriptionModelTests(TestCase):
     @classmethod
@@ -384,8 +532,122 @@ class SubscriptionModelTests(TestCase):
         self.assertEqual(self.sub.is_active(return_qty=True), (True, 2))
         self.assertIs(self.sub.active, True)
 
+    def test_with_usage(self):
+        self.sub.purchase_date = self.today-datetime.timedelta(days=5)
+        self.sub.save(update_fields=['purchase_date'])
+        self.sub.trainings.add(self.past_training)
+        sub = Subscription.objects.with_usage().get(pk=self.sub.pk)
+        self.assertEqual(sub.used_trainings_qty, 1)
+        self.assertEqual(sub.remaining_trainings_qty,
+                         self.sub.get_remaining_trainings_qty())
+        self.assertEqual(sub.first_training_date, self.past_training.date)
+        self.assertEqual(sub.effective_start_date,
+                         self.sub.get_start_date())
+        self.assertEqual(sub.effective_end_date, self.sub.get_end_date())
+
+    def test_with_usage_training_later_than_10_days_since_purchase(self):
+        self.sub.purchase_date = self.today-datetime.timedelta(days=12)
+        self.sub.save(update_fields=['purchase_date'])
+        self.sub.trainings.add(self.past_training)
+        sub = Subscription.objects.with_usage().get(pk=self.sub.pk)
+        self.assertEqual(sub.effective_start_date, self.sub.purchase_date)
+        self.assertEqual(sub.effective_end_date,
+                         self.sub.purchase_date+datetime.timedelta(days=30))
+
+    def test_with_activity(self):
+        expired, used_up, used_up_with_upcoming, inactive = [
+            Subscription.objects.create(
+                user=self.user, trainings_qty=1, validity=30)
+            for _ in range(4)
+        ]
+        expired.purchase_date = self.today-datetime.timedelta(days=45)
+        expired.save(update_fields=['purchase_date'])
+        used_up.trainings.add(self.past_training)
+        used_up_with_upcoming.trainings.add(self.future_training)
+        inactive.active = False
+        inactive.save(update_fields=['active'])
+        subscriptions = [self.sub, expired, used_up, used_up_with_upcoming,
+                         inactive]
+        currently_active = dict(
+            Subscription.objects.with_activity().values_list(
+                'pk', 'currently_active'))
+        self.assertEqual(
+            [currently_active[sub.pk] for sub in subscriptions],
+            [True, False, False, True, False],
+        )
+        self.assertEqual(
+            [sub.is_active(readonly=True) for sub in subscriptions],
+            [True, False, False, True, False],
+        )
+
+    def test_readonly_methods_do_not_save(self):
+        self.sub.purchase_date = self.today-datetime.timedelta(days=45)
+        self.sub.save(update_fields=['purchase_date'])
+        with self.assertNumQueries(1):
+            self.assertIs(self.sub.is_active(readonly=True), False)
+        self.assertEqual(self.sub.get_start_date(readonly=True),
+                         self.sub.purchase_date)
+        self.sub.refresh_from_db()
+        self.assertIsNone(self.sub.start_date)
+        self.assertIsNone(self.sub.end_date)
+        self.assertIs(self.sub.active, True)
+
+    def test_finalize_lifecycle(self):
+        started_by_training, started_by_purchase, expired, used_up = [
+            Subscription.objects.create(
+                user=self.user, trainings_qty=qty, validity=30)
+            for qty in (2, 2, 2, 1)
+        ]
+        for sub, days in ((started_by_training, 5), (started_by_purchase, 15),
+                          (expired, 45), (used_up, 2)):
+            sub.purchase_date = self.today-datetime.timedelta(days=days)
+        Subscription.objects.bulk_update(
+            [started_by_training, started_by_purchase, expired, used_up],
+            ['purchase_date'])
+        started_by_training.trainings.add(self.past_training)
+        used_up.trainings.add(self.past_training)
+        with self.assertNumQueries(7):
+            result = Subscription.objects.finalize_lifecycle()
+        self.assertEqual(result, {
+            'started_by_training': 2,
+            'started_by_purchase': 2,
+            'end_dates': 0,
+            'expired': 1,
+            'used_up': 1,
+        })
+        for sub in (self.sub, started_by_training, started_by_purchase,
+                    expired, used_up):
+            sub.refresh_from_db()
+        self.assertIsNone(self.sub.start_date)
+        self.assertEqual(started_by_training.start_date,
+                         self.past_training.date)
+        self.assertEqual(started_by_training.end_date,
+                         self.past_training.date+datetime.timedelta(days=30))
+        self.assertEqual(started_by_purchase.start_date,
+                         started_by_purchase.purchase_date)
+        self.assertEqual(
+            started_by_purchase.end_date,
+            started_by_purchase.purchase_date+datetime.timedelta(days=30))
+        self.assertEqual(
+            [sub.active for sub in (self.sub, started_by_training,
+                                    started_by_purchase, expired, used_up)],
+            [True, True, True, False, False]
+        )
+
 
 class OneTimeTrainingTests(TestCase):
+    def test_get_cached(self):
+        record = OneTimeTraining.objects.create(price=900)
+        self.assertEqual(OneTimeTraining.get_cached().price, 900)
+        with self.assertNumQueries(0):
+            self.assertEqual(OneTimeTraining.get_cached(), record)
+        record.price = 1000
+        record.save()
+        self.assertEqual(OneTimeTraining.objects.get().price, 1000)
+        self.assertEqual(OneTimeTraining.get_cached().price, 1000)
+        record.delete()
+        self.assertIsNone(OneTimeTraining.get_cached())
+
     def test_save_inability_to_save_more_than_one_record(self):
         record1 = OneTimeTraining.objects.create(price=1)
         record2 = OneTimeTraining.objects.create(price=2)
@@ -409,6 +671,19 @@ class TrainingTests(TestCase):
             court=cls.court1,
         )
 
+    def test_learners_count_after_deleting_a_learner(self):
+        users = [User.objects.create_user('user{}'.format(number))
+                 for number in range(3)]
+        self.upcoming_training.learners.add(*users)
+        schedule_version = get_schedule_version()
+        users[0].delete()
+        self.upcoming_training.refresh_from_db()
+        self.assertEqual(self.upcoming_training.learners_count, 2)
+        self.assertNotEqual(get_schedule_version(), schedule_version)
+        User.objects.filter(pk__in=[users[1].pk, users[2].pk]).delete()
+        self.upcoming_training.refresh_from_db()
+        self.assertEqual(self.upcoming_training.learners_count, 0)
+
     def test_get_end_datetime(self):
         training = Training.objects.create(
             day_of_week=1,
@@ -448,6 +723,29 @@ class TrainingTests(TestCase):
         training.learners.remove(user2)
         self.assertEqual(training.get_free_places(), 2)
 
+    def test_learners_count(self):
+        user1 = User.objects.create_user('test_user1')
+        user2 = User.objects.create_user('test_user2')
+        training = self.upcoming_training
+        training.learners.add(user1, user2)
+        self.assertEqual(training.learners_count, 2)
+        user1.trainings.remove(training)
+        training.refresh_from_db()
+        self.assertEqual(training.learners_count, 1)
+        user2.trainings.clear()
+        training.refresh_from_db()
+        self.assertEqual(training.learners_count, 0)
+
+    def test_add_learner(self):
+        user1 = User.objects.create_user('test_user1')
+        user2 = User.objects.create_user('test_user2')
+        training = self.upcoming_training
+        with mock.patch.object(Training, 'MAX_LEARNERS_PER_TRAINING', 1):
+            self.assertIs(training.add_learner(user1), True)
+            self.assertIs(training.add_learner(user2), False)
+        self.assertEqual(list(training.learners.all()), [user1])
+        self.assertEqual(training.learners_count, 1)
+
     def test_is_more_than_an_hour_before_start_is_true(self):
         after_now_61_minutes = (
             datetime.datetime.now() + datetime.timedelta(hours=1, minutes=1))
@@ -489,6 +787,46 @@ class TrainingTests(TestCase):
         training.save(update_fields=(['date', 'start_time']))
         self.assertIs(training.is_more_than_an_hour_before_start(), False)
 
+    def test_start_at_and_end_at(self):
+        training = self.upcoming_training
+        self.assertEqual(
+            training.start_at,
+            datetime.datetime.combine(training.date, training.start_time)
+        )
+        training.start_time = datetime.time(20, 00, 00)
+        training.save(update_fields=['start_time'])
+        training.refresh_from_db()
+        self.assertEqual(training.start_at.time(), datetime.time(20, 00, 00))
+        self.assertEqual(training.end_at,
+                         training.start_at+training.TRAINING_DURATION)
+
+    def test_upcoming_cancellable_and_in_progress(self):
+        now = datetime.datetime.now()
+        started = now - datetime.timedelta(minutes=30)
+        in_progress_training = Training.objects.create(
+            day_of_week=started.isoweekday(),
+            skill_level=2,
+            date=started.date(),
+            start_time=started.time(),
+            court=self.court1,
+        )
+        soon = now + datetime.timedelta(minutes=30)
+        soon_training = Training.objects.create(
+            day_of_week=soon.isoweekday(),
+            skill_level=3,
+            date=soon.date(),
+            start_time=soon.time(),
+            court=self.court1,
+        )
+        self.assertEqual(
+            set(Training.objects.upcoming()),
+            {self.upcoming_training, in_progress_training, soon_training}
+        )
+        self.assertEqual(list(Training.objects.cancellable()),
+                         [self.upcoming_training])
+        self.assertEqual(list(Training.objects.in_progress()),
+                         [in_progress_training])
+
     def test_get_upcoming_training_or_404_for_upcoming_training(self):
         pk = self.upcoming_training.pk
         self.assertEqual(
@@ -496,6 +834,32 @@ class TrainingTests(TestCase):
             self.upcoming_training
         )
 
+    def test_get_upcoming_training_or_404_with_user(self):
+        user = User.objects.create_user('test_user')
+        pk = self.upcoming_training.pk
+        with self.assertNumQueries(1):
+            training = Training.get_upcoming_training_or_404(pk, user)
+            self.assertIs(training.is_registered, False)
+        self.upcoming_training.learners.add(user)
+        training = Training.get_upcoming_training_or_404(pk, user)
+        self.assertIs(training.is_registered, True)
+        self.assertEqual(training.learners_count, 1)
+
+    def test_is_registered_for_training_with_prefetched_learners(self):
+        user = User.objects.create_user('test_user')
+        other_user = User.objects.create_user('other_user')
+        self.upcoming_training.learners.add(user)
+        pk = self.upcoming_training.pk
+        training = Training.get_upcoming_training_or_404(pk)
+        with self.assertNumQueries(0):
+            self.assertIs(is_registered_for_training(user, training), True)
+            self.assertIs(
+                is_registered_for_training(other_user, training), False
+            )
+        training = Training.objects.get(pk=pk)
+        with self.assertNumQueries(1):
+            self.assertIs(is_registered_for_training(user, training), True)
+
     def test_get_upcoming_training_or_404_for_past_training(self):
         past_training = Training.objects.create(
             day_of_week=1,
@@ -537,6 +901,31 @@ class UtilsTests(TestCase):
         self.assertEqual(training.start_time, datetime.time(18, 00, 00))
         self.assertEqual(training.active, True)
 
+    def test_get_copy_plan(self):
+        self.assertEqual(
+            get_copy_plan(Timetable, Training),
+            ('day_of_week', 'skill_level', 'court_id', 'coach_id',
+             'start_time', 'active')
+        )
+        self.assertEqual(get_copy_plan(SubscriptionSample, Subscription),
+                         ('trainings_qty', 'validity', 'active'))
+
+    def test_copy_same_fields_to_many_does_not_load_related_objects(self):
+        court1 = Court.objects.create(passport_required=False, active=True)
+        Timetable.objects.create(
+            day_of_week=1,
+            skill_level=1,
+            court=court1,
+            start_time=datetime.time(18, 00, 00),
+        )
+        timetable = Timetable.objects.get()
+        trainings = [Training(), Training()]
+        with self.assertNumQueries(0):
+            copy_same_fields_to_many(timetable, trainings)
+        for training in trainings:
+            self.assertEqual(training.court_id, court1.pk)
+            self.assertEqual(training.start_time, datetime.time(18, 00, 00))
+
     @mock.patch('volleyballschool.utils.datetime', wraps=datetime)
     def test_date_of_the_current_week_monday(self, mocked_datetime):
         mocked_datetime.date.today.return_value = datetime.date(2010, 1, 1)
@@ -549,6 +938,20 @@ class UtilsTests(TestCase):
         start_date, end_date = get_start_date_and_end_date(2)
         self.assertEqual(start_date, datetime.date(2019, 12, 30))
         self.assertEqual(end_date, datetime.date(2020, 1, 12))
+        start_date, end_date = get_start_date_and_end_date(4, week_offset=-1)
+        self.assertEqual(start_date, datetime.date(2019, 12, 23))
+        self.assertEqual(end_date, datetime.date(2020, 1, 19))
+
+    def test_get_timetable_range(self):
+        self.assertEqual(get_timetable_range({}), (0, 2))
+        self.assertEqual(get_timetable_range({'week': '3', 'weeks': '4'}),
+                         (3, 4))
+        self.assertEqual(get_timetable_range({'week': '-50', 'weeks': '0'}),
+                         (-4, 1))
+        self.assertEqual(get_timetable_range({'week': '50', 'weeks': '50'}),
+                         (8, 6))
+        self.assertEqual(get_timetable_range({'week': 'x', 'weeks': ''}),
+                         (0, 2))
 
     def test_transform_for_timetable(self):
         court1 = Court.objects.create(
@@ -613,6 +1016,16 @@ class UtilsTests(TestCase):
         self.assertEqual(transform_for_timetable(query_set, start_date, 2),
                          expected_result)
 
+    def test_transform_for_timetable_same_as_nested_scan(self):
+        command = benchmarktimetable.Command()
+        start_date = datetime.date(2021, 5, 31)
+        trainings = command._make_trainings(5, start_date, 3, 4)
+        self.assertEqual(
+            transform_for_timetable(trainings, start_date, 3),
+            benchmarktimetable._transform_for_timetable_nested_scan(
+                trainings, start_date, 3),
+        )
+
     @mock.patch('volleyballschool.utils.datetime', wraps=datetime)
     def test_create_trainings_based_on_timeteble_for_x_days(self, 
                                                             mocked_datetime):
@@ -681,6 +1094,33 @@ class UtilsTests(TestCase):
                          datetime.date(2020, 10, 20))
         self.assertEqual(all_trainings.count(), 2)
 
+    @mock.patch('volleyballschool.utils.datetime', wraps=datetime)
+    def test_create_trainings_based_on_timetables_for_x_days(self,
+                                                             mocked_datetime):
+        mocked_datetime.date.today.return_value = datetime.date(2020, 10, 10)
+        court1 = Court.objects.create(passport_required=False, active=True)
+        timetables = [
+            Timetable.objects.create(
+                day_of_week=day_of_week,
+                skill_level=1,
+                start_time=datetime.time(18, 00, 00),
+                court=court1,
+            )
+            for day_of_week in (2, 4)
+        ]
+        Training.objects.filter(date=datetime.date(2020, 10, 13)).delete()
+        with self.assertNumQueries(2):
+            created, skipped = (
+                create_trainings_based_on_timetables_for_x_days(
+                    timetables, Training, 15)
+            )
+        self.assertEqual((created, skipped), (1, 3))
+        self.assertEqual(Training.objects.count(), 4)
+        self.assertEqual(
+            Training.objects.get(date=datetime.date(2020, 10, 13)).end_at,
+            datetime.datetime(2020, 10, 13, 20, 00, 00)
+        )
+
     def test_cancel_registration_for_training_more_than_an_hour_before_start(self):
         after_now_61_minutes = (
             datetime.datetime.now() + datetime.timedelta(hours=1, minutes=1))
@@ -790,6 +1230,8 @@ class TimetableTests(TestCase):
         self.assertEqual(training_past.skill_level, 1)
         self.assertEqual(training_past.start_time, datetime.time(18, 00, 00))
         self.assertEqual(training_1.start_time, datetime.time(20, 00, 00))
+        self.assertEqual(training_1.start_at,
+                         datetime.datetime(2020, 10, 10, 20, 00, 00))
         self.assertEqual(training_1.skill_level, 3)
         self.assertEqual(not_matching_training.start_time,
                          datetime.time(17, 00, 00))
@@ -798,6 +1240,22 @@ class TimetableTests(TestCase):
             self.assertEqual(training_2.start_time, datetime.time(20, 00, 00))
             self.assertEqual(training_2.skill_level, 3)
 
+    @mock.patch('volleyballschool.models.datetime', wraps=datetime)
+    @mock.patch('volleyballschool.utils.datetime', wraps=datetime)
+    def test_save_returns_number_of_updated_trainings(self, mocked_datetime,
+                                                       mock_datetime):
+        mocked_datetime.date.today.return_value = datetime.date(2020, 10, 10)
+        mock_datetime.date.today.return_value = datetime.date(2020, 10, 10)
+        self.training_2.status = Training.ListOfStatuses.CANCELED
+        self.training_2.save()
+        self.assertEqual(self.timetable.save(), 0)  # создана тренировка 24.10
+        self.timetable.start_time = datetime.time(20, 00, 00)
+        self.assertEqual(self.timetable.save(), 2)
+        self.assertEqual(
+            Training.objects.get(pk=self.training_2.pk).start_time,
+            datetime.time(18, 00, 00)
+        )
+
     @mock.patch('volleyballschool.models.datetime', wraps=datetime)
     @mock.patch('volleyballschool.utils.datetime', wraps=datetime)
     def test_save_timetable_has_no_matching_trainings(self, mocked_datetime, mock_datetime):
@@ -865,7 +1323,9 @@ class TimetableTests(TestCase):
     def test_delete(self, mocked_datetime):
         mocked_datetime.date.today.return_value = datetime.date(2020, 10, 10)
         pk = self.timetable.pk
-        self.timetable.delete()
+        deleted, deleted_per_model = self.timetable.delete()
+        self.assertEqual(deleted, 3)
+        self.assertEqual(deleted_per_model['volleyballschool.Training'], 2)
         all_trainings = Training.objects.all()
         self.assertIsNone(Timetable.objects.filter(pk=pk).first())
         self.assertEqual(all_trainings.count(), 2)
@@ -886,7 +1346,220 @@ class TimetableTests(TestCase):
         self.assertGreater(Training.objects.all().count(), 0)
 
 
+class CreateVolleyballTrainingsCommandTests(TestCase):
+    def test_command_output(self):
+        court1 = Court.objects.create(passport_required=False, active=True)
+        Timetable.objects.bulk_create([
+            Timetable(
+                day_of_week=day_of_week,
+                skill_level=1,
+                start_time=datetime.time(18, 00, 00),
+                court=court1,
+                active=active,
+            )
+            for day_of_week, active in ((1, True), (3, True), (5, False))
+        ])
+        out = StringIO()
+        call_command('createvolleyballtrainings', '--from_monday', stdout=out)
+        self.assertEqual(out.getvalue(), 'Created: 5, skipped: 0\n')
+        out = StringIO()
+        call_command('createvolleyballtrainings', '--from_monday', stdout=out)
+        self.assertEqual(out.getvalue(), 'Created: 0, skipped: 5\n')
+
+
+class CheckQueryPlansCommandTests(TestCase):
+    def test_no_full_table_scans(self):
+        court1 = Court.objects.create(passport_required=False, active=True)
+        OneTimeTraining.objects.create(price=900)
+        user = User.objects.create_user('test_user')
+        training = Training.objects.create(
+            day_of_week=1,
+            skill_level=1,
+            date=datetime.date.today()+datetime.timedelta(days=2),
+            start_time=datetime.time(18, 00, 00),
+            court=court1,
+        )
+        training.learners.add(user)
+        Subscription.objects.create(user=user, trainings_qty=2, validity=30)
+        out = StringIO()
+        call_command('checkqueryplans', stdout=out)
+        self.assertIn('No full table scans', out.getvalue())
+
+    def test_timetable_pages_search_trainings_by_start_at(self):
+        court1 = Court.objects.create(passport_required=False, active=True)
+        Training.objects.create(
+            day_of_week=1,
+            skill_level=1,
+            date=datetime.date.today()+datetime.timedelta(days=2),
+            start_time=datetime.time(18, 00, 00),
+            court=court1,
+        )
+        User.objects.create_user('test_user')
+        out = StringIO()
+        call_command('checkqueryplans', verbosity=2, stdout=out)
+        # у каждой страницы расписания свой запрос, а не снимок из кэша
+        plans = re.findall(
+            r'^timetable[^:]*: SELECT .*FROM "volleyballschool_training".*\n'
+            r'((?:    .*\n)+)',
+            out.getvalue(), re.MULTILINE,
+        )
+        self.assertGreaterEqual(len(plans), 3)
+        for plan in plans:
+            self.assertIn('volleyballschool_training_start_at', plan)
+
+    def test_get_scanned_tables(self):
+        command = checkqueryplans.Command()
+        self.assertEqual(
+            command._get_scanned_tables([
+                'SCAN volleyballschool_training',
+                'SCAN TABLE volleyballschool_user',
+                'SCAN volleyballschool_subscription USING INDEX idx',
+                'SCAN volleyballschool_court',
+                'SEARCH volleyballschool_training USING INDEX idx (id=?)',
+            ]),
+            ['volleyballschool_training', 'volleyballschool_user']
+        )
+
+
+class GenerateDataCommandTests(TestCase):
+    def test_generated_data_is_consistent(self):
+        out = StringIO()
+        call_command(
+            'generatedata', users=30, courts=2, coaches=2, years=0,
+            subscribers=0.5, today=datetime.date.today(), stdout=out,
+        )
+        self.assertIn('Done in', out.getvalue())
+        self.assertEqual(User.objects.count(), 30)
+        self.assertEqual(Court.objects.count(), 2)
+        self.assertEqual(Timetable.objects.count(), 12)
+        self.assertTrue(Training.objects.exists())
+        self.assertTrue(Subscription.objects.exists())
+        for training in Training.objects.annotate(
+            learners_qty=Count('learners'),
+        ):
+            self.assertEqual(training.learners_count, training.learners_qty)
+            self.assertLessEqual(
+                training.learners_count,
+                Training.MAX_LEARNERS_PER_TRAINING,
+            )
+        for user in User.objects.all()[:5]:
+            self.assertEqual(
+                user.balance,
+                BalanceTransaction.objects.filter(user=user).aggregate(
+                    total=Sum('amount'),
+                )['total'] or 0,
+            )
+
+    def test_sequences_are_reset(self):
+        with mock.patch.object(
+            connection.ops, 'sequence_reset_sql', return_value=[],
+        ) as sequence_reset_sql:
+            call_command('generatedata', users=10, courts=1, years=0,
+                         stdout=StringIO())
+        models = sequence_reset_sql.call_args.args[1]
+        for model in (User, Court, Training, Subscription):
+            self.assertIn(model, models)
+        court = Court.objects.create(passport_required=False, active=True)
+        self.assertGreater(
+            court.pk, Court.objects.exclude(pk=court.pk).latest('pk').pk,
+        )
+
+    def test_same_seed_gives_same_data(self):
+        call_command('generatedata', users=10, courts=1, years=0,
+                     stdout=StringIO())
+        first = list(Training.objects.order_by('pk').values_list(
+            'court__name', 'start_at', 'learners_count',
+        ))
+        Training.objects.all().delete()
+        User.objects.all().delete()
+        Court.objects.all().delete()
+        Coach.objects.all().delete()
+        call_command('generatedata', users=10, courts=1, years=0,
+                     stdout=StringIO())
+        second = list(Training.objects.order_by('pk').values_list(
+            'court__name', 'start_at', 'learners_count',
+        ))
+        self.assertEqual(first, second)
+
+    def test_refuses_to_run_twice(self):
+        call_command('generatedata', users=5, courts=1, years=0,
+                     stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('generatedata', users=5, courts=1, years=0,
+                         stdout=StringIO())
+
+
+class LoadTestRegistrationCommandTests(LiveServerTestCase):
+    def setUp(self):
+        court1 = Court.objects.create(passport_required=False, active=True)
+        OneTimeTraining.objects.create(price=900)
+        for days in (2, 3):
+            Training.objects.create(
+                day_of_week=1,
+                skill_level=1,
+                date=datetime.date.today()+datetime.timedelta(days=days),
+                start_time=datetime.time(18, 00, 00),
+                court=court1,
+            )
+
+    def test_registrations_and_invariants(self):
+        # тестовый сервер использует одно соединение с базой в памяти,
+        # поэтому запросы отправляются по одному
+        out = StringIO()
+        call_command(
+            'loadtestregistration', url=self.live_server_url, users=4,
+            concurrency=1, duplicates=1, stdout=out,
+        )
+        self.assertIn('All invariants hold', out.getvalue())
+        # абонемента или баланса каждого пользователя хватает на одну
+        # тренировку из двух
+        self.assertIn('Registration forms not shown: 4', out.getvalue())
+        self.assertRegex(out.getvalue(), r'registration +4 +0 ')
+        self.assertFalse(User.objects.exists())
+        self.assertEqual(
+            list(Training.objects.values_list('learners_count', flat=True)),
+            [0, 0],
+        )
+
+    def test_keep(self):
+        call_command(
+            'loadtestregistration', url=self.live_server_url, users=2,
+            concurrency=1, duplicates=1, keep=True, stdout=StringIO(),
+        )
+        self.assertEqual(User.objects.count(), 2)
+        self.assertEqual(
+            sum(Training.objects.values_list('learners_count', flat=True)),
+            2,
+        )
+
+    def test_check_invariants_finds_violations(self):
+        user = User.objects.create_user('test_user')
+        BalanceTransaction(
+            user=user,
+            amount=-100,
+            kind=BalanceTransaction.Kinds.TRAINING_PAYMENT,
+        ).save()
+        User.objects.filter(pk=user.pk).update(balance=-100)
+        command = loadtestregistration.Command()
+        violations = command._check_invariants(
+            [user], list(Training.objects.all()),
+        )
+        self.assertEqual(violations, [
+            'Balance of test_user is negative: -100.00',
+            'test_user is charged 1 times for 0 registrations',
+        ])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadtestregistration.percentile(values, 50), 50)
+        self.assertEqual(loadtestregistration.percentile(values, 99), 99)
+        self.assertEqual(loadtestregistration.percentile([7], 95), 7)
+
+
 class TimetableViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
     def test_skill_level_1_to_3(self):
         skill_levels_list = [
             'для начального уровня',
@@ -952,6 +1625,259 @@ class TimetableViewTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.context['trainings'], expected_result)
 
+    def test_free_places_are_updated_by_level_events(self):
+        court1 = Court.objects.create(passport_required=False, active=True)
+        training = Training.objects.create(
+            day_of_week=datetime.date.today().isoweekday(),
+            skill_level=2,
+            start_time=datetime.time(23, 59, 00),
+            date=datetime.date.today(),
+            court=court1,
+        )
+        training.learners.add(User.objects.create_user('test_user'))
+        response = self.client.get(reverse('timetable', args=[2]))
+        self.assertContains(response, 'data-events="/events/timetable/2/"')
+        self.assertContains(
+            response,
+            '<span data-training="{}">{}</span>'.format(
+                training.pk, training.MAX_LEARNERS_PER_TRAINING - 1,
+            ),
+            html=True,
+        )
+        response = self.client.get(reverse('timetable-all'))
+        for skill_level in (1, 2, 3):
+            self.assertContains(
+                response,
+                'data-events="/events/timetable/{}/"'.format(skill_level),
+            )
+        self.assertContains(response, 'data-training="{}"'.format(
+            training.pk,
+        ))
+
+    def test_timetable_is_cached(self):
+        court1 = Court.objects.create(passport_required=False, active=True)
+        Training.objects.create(
+            day_of_week=datetime.date.today().isoweekday(),
+            skill_level=1,
+            start_time=datetime.time(18, 00, 00),
+            date=datetime.date.today(),
+            court=court1,
+        )
+        url = reverse('timetable', args=[1])
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.context['trainings'][0]['name'], court1)
+
+    def test_week_navigation(self):
+        court1 = Court.objects.create(passport_required=False, active=True)
+        start_date, _ = get_start_date_and_end_date(1, week_offset=3)
+        Training.objects.create(
+            day_of_week=1,
+            skill_level=1,
+            start_time=datetime.time(18, 00, 00),
+            date=start_date,
+            court=court1,
+        )
+        url = reverse('timetable', args=[1])
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'week': 1, 'weeks': 4})
+        self.assertEqual(response.context['start_date'],
+                         start_date - datetime.timedelta(days=14))
+        self.assertEqual(response.context['previous_week'], 0)
+        self.assertEqual(response.context['next_week'], 2)
+        weeks = response.context['trainings'][0]['weeks']
+        self.assertEqual(len(weeks), 4)
+        self.assertEqual(weeks[2][0].date, start_date)
+        self.assertEqual(self.client.get(url).context['trainings'], [])
+        response = self.client.get(url, {'week': 8})
+        self.assertNotIn('next_week', response.context)
+
+    def test_all_levels_timetable_shares_snapshot_with_levels(self):
+        court1 = Court.objects.create(passport_required=False, active=True)
+        for skill_level in (1, 3):
+            Training.objects.create(
+                day_of_week=datetime.date.today().isoweekday(),
+                skill_level=skill_level,
+                start_time=datetime.time(18, 00, 00),
+                date=datetime.date.today(),
+                court=court1,
+            )
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('timetable-all'))
+        self.assertEqual(
+            [(timetable['skill_level'], len(timetable['trainings']))
+             for timetable in response.context['timetables']],
+            [(1, 1), (2, 0), (3, 1)],
+        )
+        with self.assertNumQueries(0):
+            for skill_level in (1, 2, 3):
+                response = self.client.get(
+                    reverse('timetable', args=[skill_level]))
+        self.assertEqual(
+            response.context['trainings'][0]['weeks'][0][
+                datetime.date.today().weekday()].skill_level,
+            3,
+        )
+
+    def test_timetable_cache_is_invalidated(self):
+        court1 = Court.objects.create(passport_required=False, active=True)
+        url = reverse('timetable', args=[1])
+        self.assertEqual(self.client.get(url).context['trainings'], [])
+        training = Training.objects.create(
+            day_of_week=datetime.date.today().isoweekday(),
+            skill_level=1,
+            start_time=datetime.time(18, 00, 00),
+            date=datetime.date.today(),
+            court=court1,
+        )
+        self.assertEqual(len(self.client.get(url).context['trainings']), 1)
+        version = get_schedule_version()
+        training.learners.add(User.objects.create_user('test_user'))
+        self.assertNotEqual(get_schedule_version(), version)
+        training.delete()
+        self.assertEqual(self.client.get(url).context['trainings'], [])
+
+
+class TimetableAPIViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.court1 = Court.objects.create(
+            name='Зал1', passport_required=False, active=True)
+        self.coach = Coach.objects.create(
+            name='Тренер1', description='', active=True)
+        self.training = Training.objects.create(
+            day_of_week=datetime.date.today().isoweekday(),
+            skill_level=1,
+            start_time=datetime.time(18, 00, 00),
+            date=datetime.date.today(),
+            court=self.court1,
+            coach=self.coach,
+        )
+        self.url = reverse('timetable-api', args=[1])
+
+    def test_json(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['skill_level'], 1)
+        self.assertEqual(data['number_of_weeks'], 2)
+        self.assertEqual(len(data['courts']), 1)
+        court = data['courts'][0]
+        self.assertEqual(court['name'], 'Зал1')
+        days = [day for week in court['weeks'] for day in week]
+        self.assertEqual(len(days), 14)
+        self.assertEqual(
+            [day['training'] for day in days if day['training']],
+            [{
+                'id': self.training.pk,
+                'coach': {'id': self.coach.pk, 'name': 'Тренер1'},
+                'status': Training.ListOfStatuses.OK,
+                'status_display': self.training.get_status_display(),
+                'start_time': '18:00:00',
+                'start_at': self.training.start_at.isoformat(),
+                'end_at': self.training.end_at.isoformat(),
+                'free_places': Training.MAX_LEARNERS_PER_TRAINING,
+            }],
+        )
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.training.learners.add(
+            User.objects.create_user(username='test_user'))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(
+            response.json()['courts'][0]['weeks'][0][
+                self.training.date.weekday()]['training']['free_places'],
+            Training.MAX_LEARNERS_PER_TRAINING - 1,
+        )
+
+
+class EventsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # Set up data for the whole TestCase
+        cls.court1 = Court.objects.create(passport_required=False, active=True)
+        cls.training = Training.objects.create(
+            day_of_week=1,
+            skill_level=2,
+            start_time=datetime.time(18, 00, 00),
+            date=datetime.date.today()+datetime.timedelta(days=2),
+            court=cls.court1,
+        )
+        cls.user = User.objects.create_user(username='test_user')
+
+    def _request_events(self, path, event=None):
+        """Send GET [path] to sse_application, publish [event] to the
+        channel of the training once subscribed and disconnect after the
+        first event.
+        """
+        async def request():
+            messages = []
+            disconnected = asyncio.Event()
+
+            async def receive():
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                messages.append(message)
+                if message.get('body', b'').startswith(b'event:'):
+                    disconnected.set()
+
+            scope = {'type': 'http', 'method': 'GET', 'path': path}
+            application = asyncio.ensure_future(
+                sse_application(scope, receive, send))
+            if event is not None:
+                while not hub.has_subscribers():
+                    await asyncio.sleep(0)
+                hub.publish(training_channel(self.training.pk), event)
+            await asyncio.wait_for(application, 1)
+            return messages
+        return async_to_sync(request)()
+
+    def test_sse_application(self):
+        messages = self._request_events(
+            '/events/training/{}/'.format(self.training.pk),
+            {'training': self.training.pk, 'free_places': 3},
+        )
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'),
+                      messages[0]['headers'])
+        self.assertEqual(
+            messages[-1]['body'],
+            b'event: free-places\ndata: {"training": %d, '
+            b'"free_places": 3}\n\n' % self.training.pk,
+        )
+        self.assertFalse(hub.has_subscribers())
+
+    def test_sse_application_wrong_path(self):
+        messages = self._request_events('/events/timetable/5/')
+        self.assertEqual(messages[0]['status'], 404)
+
+    @mock.patch('volleyballschool.events.hub')
+    def test_learners_change_is_published_after_commit(self, mocked_hub):
+        mocked_hub.has_subscribers.return_value = True
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.training.learners.add(self.user)
+            mocked_hub.publish.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+        event = {
+            'training': self.training.pk,
+            'skill_level': 2,
+            'free_places': Training.MAX_LEARNERS_PER_TRAINING - 1,
+        }
+        mocked_hub.publish.assert_has_calls([
+            mock.call('training:{}'.format(self.training.pk), event),
+            mock.call('level:2', event),
+        ])
+
 
 class BuyingASubscriptionViewTests(TestCase):
     @classmethod
@@ -989,6 +1915,10 @@ class BuyingASubscriptionViewTests(TestCase):
         self.user = User.objects.get(pk=self.user.pk)
         self.assertEqual(self.user.balance, 0)
         self.assertEqual(self.user.subscriptions.count(), 1)
+        self.assertEqual(
+            self.user.balance_transactions.get().kind,
+            BalanceTransaction.Kinds.SUBSCRIPTION_PURCHASE,
+        )
         self.assertTrue(self.client.session['submitted'])
         subscription = self.user.subscriptions.last()
         success_url = reverse('success-buying-a-subscription',
@@ -999,6 +1929,28 @@ class BuyingASubscriptionViewTests(TestCase):
         self.assertEqual(self.subscription_sample.validity,
                          subscription.validity)
 
+    def test_repeated_buying_subscription_with_the_same_key(self):
+        User.objects.filter(pk=self.user.pk).update(balance=1800)
+        response = self.client.get(self.url)
+        data = {'confirm': True,
+                'idempotency_key': response.context['idempotency_key']}
+        first_response = self.client.post(self.url, data)
+        self.client.get(first_response.url)  # сбрасывает submitted
+        second_response = self.client.post(self.url, data)
+        self.assertEqual(self.user.subscriptions.count(), 1)
+        self.assertEqual(User.objects.get(pk=self.user.pk).balance, 900)
+        self.assertEqual(second_response.url, first_response.url)
+        self.assertTrue(self.client.session['submitted'])
+
+    def test_buying_subscription_with_another_users_key(self):
+        user2 = User.objects.create_user(username='test_user2')
+        IdempotencyKey.objects.create(key='a' * 32, user=user2,
+                                      response_url='/account/')
+        response = self.client.post(
+            self.url, {'confirm': True, 'idempotency_key': 'a' * 32})
+        self.assertRedirects(response, self.url)
+        self.assertEqual(self.user.subscriptions.count(), 0)
+
     def test_buying_subscription_if_user_has_no_enough_money(self):
         self.user.balance = 899
         self.user.save(update_fields=['balance'])
@@ -1139,6 +2091,20 @@ class RegistrationForTrainingViewTests(TestCase):
         self.user = User.objects.get(pk=self.user.pk)
         self.assertIn(self.user, self.upcoming_training.learners.all())
         self.assertEqual(self.user.balance, 0)
+        self.upcoming_training.refresh_from_db()
+        self.assertEqual(self.upcoming_training.get_free_places(),
+                         Training.MAX_LEARNERS_PER_TRAINING - 1)
+        self.assertRedirects(response, self.url)
+
+    def test_register_for_training_if_user_has_no_enough_money(self):
+        User.objects.filter(pk=self.user.pk).update(balance=899)
+        response = self.client.post(
+            self.url, {'confirm': True, 'payment_by': 'balance'})
+        self.upcoming_training.refresh_from_db()
+        self.assertNotIn(self.user, self.upcoming_training.learners.all())
+        self.assertEqual(self.upcoming_training.learners_count, 0)
+        self.assertEqual(User.objects.get(pk=self.user.pk).balance, 899)
+        self.assertFalse(self.user.balance_transactions.exists())
         self.assertRedirects(response, self.url)
 
     def test_cancel_registration_for_training(self):
@@ -1199,6 +2165,27 @@ class AccountViewTests(TestCase):
                          self.not_active_sub)
         self.assertEqual(response.status_code, 200)
 
+    def test_number_of_queries_does_not_depend_on_data(self):
+        # сессия, пользователь, абонементы, тренировки
+        with self.assertNumQueries(4):
+            self.client.get(self.url)
+        for days in range(3, 6):
+            training = Training.objects.create(
+                day_of_week=1,
+                skill_level=1,
+                date=datetime.date.today()+datetime.timedelta(days=days),
+                start_time=datetime.time(18, 00, 00),
+                court=self.court1,
+            )
+            training.learners.add(self.user)
+            subscription = Subscription.objects.create(
+                active=True, user=self.user, trainings_qty=4, validity=30)
+            subscription.trainings.add(training, self.upcoming_training)
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.context['user_upcoming_trainings']), 4)
+        self.assertContains(response, 'Осталось занятий: <b>2</b>')
+
     def test_cancel_registration_for_training(self):
         response = self.client.post(
             self.url, {'cancel': True, 'pk': self.upcoming_training.pk})
@@ -1270,9 +2257,15 @@ class PricesViewTests(TestCase):
         response = self.client.get(reverse('prices'))
         self.assertEqual(response.status_code, 200)
         self.assertIn(sub_sample2, response.context['subscription_samples'])
-        self.assertEqual(response.context['subscription_samples'].count(), 1)
+        self.assertEqual(len(response.context['subscription_samples']), 1)
         self.assertEqual(one_time_training,
                          response.context['one_time_training'])
+        with self.assertNumQueries(0):
+            self.client.get(reverse('prices'))
+        sub_sample2.active = False
+        sub_sample2.save()
+        response = self.client.get(reverse('prices'))
+        self.assertEqual(response.context['subscription_samples'], ())
 
 
 class CourtsViewTests(TestCase):
@@ -1370,3 +2363,506 @@ class ReplenishmentViewTests(TestCase):
         self.client.force_login(user)
         response = self.client.get(reverse('replenishment'))
         self.assertEqual(response.status_code, 200)
+
+    def test_repeated_replenishment_with_the_same_key(self):
+        user = User.objects.create_user(username='test_user')
+        self.client.force_login(user)
+        expired_key = IdempotencyKey.objects.create(key='a' * 32, user=user)
+        IdempotencyKey.objects.filter(pk=expired_key.pk).update(
+            created_at=datetime.datetime.now() - IdempotencyKey.TTL
+            - datetime.timedelta(minutes=1),
+        )
+        data = {
+            'replenishment_by': 'test',
+            'amount': 500,
+            'next': '/account/',
+            'idempotency_key': 'b' * 32,
+        }
+        first_response = self.client.post(reverse('replenishment'), data)
+        second_response = self.client.post(reverse('replenishment'), data)
+        self.assertEqual(second_response.url, first_response.url)
+        self.assertEqual(User.objects.get(pk=user.pk).balance, 500)
+        self.assertEqual(user.balance_transactions.count(), 1)
+        # устаревшие ключи удаляются командой, а не при каждом POST
+        self.assertEqual(IdempotencyKey.objects.count(), 2)
+        out = StringIO()
+        call_command('deleteexpiredidempotencykeys', '--batch-size', '1',
+                     stdout=out)
+        self.assertEqual(out.getvalue(), 'Deleted: 1\n')
+        self.assertEqual(
+            list(IdempotencyKey.objects.values_list('key', flat=True)),
+            ['b' * 32],
+        )
+
+    def test_key_is_released_if_the_view_fails(self):
+        user = User.objects.create_user(username='test_user')
+        self.client.force_login(user)
+        data = {
+            'replenishment_by': 'test',
+            'amount': 500,
+            'next': '/account/',
+            'idempotency_key': 'b' * 32,
+        }
+        with mock.patch.object(User, 'credit_balance',
+                               side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            self.client.post(reverse('replenishment'), data)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.client.post(reverse('replenishment'), data)
+        self.assertEqual(User.objects.get(pk=user.pk).balance, 500)
+
+
+@override_settings(METRICS_ALLOWED_IPS=['127.0.0.1'])
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        court1 = Court.objects.create(passport_required=False, active=True)
+        Training.objects.create(
+            day_of_week=1,
+            skill_level=1,
+            date=datetime.date.today()+datetime.timedelta(days=2),
+            start_time=datetime.time(18, 00, 00),
+            court=court1,
+        )
+
+    def test_requests_queries_and_cache_lookups_are_counted(self):
+        url = reverse('timetable', args=[1])
+        self.client.get(url)
+        self.client.get(url)
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(
+            response['Content-Type'],
+            'text/plain; version=0.0.4; charset=utf-8',
+        )
+        lines = response.content.decode().splitlines()
+        for line in (
+            'volleyballschool_http_requests_total{view="timetable",'
+            'method="GET",status="200"} 2',
+            'volleyballschool_http_request_duration_seconds_bucket{'
+            'view="timetable",le="+Inf"} 2',
+            'volleyballschool_http_request_duration_seconds_count{'
+            'view="timetable"} 2',
+            # расписание запрашивается из базы только в первый раз
+            'volleyballschool_db_queries_total{view="timetable"} 1',
+            'volleyballschool_cache_lookups_total{cache="timetables",'
+            'result="hit"} 1',
+            'volleyballschool_cache_lookups_total{cache="timetables",'
+            'result="miss"} 1',
+            'volleyballschool_metrics_workers 1',
+        ):
+            self.assertIn(line, lines)
+        buckets = [
+            line for line in lines
+            if line.startswith('volleyballschool_http_request_duration_'
+                               'seconds_bucket{view="timetable"')
+        ]
+        # границы корзин по возрастанию
+        bounds = [float(line.split('le="')[1].split('"')[0])
+                  for line in buckets]
+        self.assertEqual(bounds, list(DURATION_BUCKETS))
+
+    def test_unknown_urls_are_counted_together(self):
+        self.client.get('/no-such-page/')
+        self.client.get('/no-such-page-either/')
+        self.assertIn(
+            'volleyballschool_http_requests_total{view="unmatched",'
+            'method="GET",status="404"} 2',
+            metrics.render().splitlines(),
+        )
+
+    def test_counters_of_all_workers_are_summed(self):
+        worker1 = Metrics('worker1')
+        worker2 = Metrics('worker2')
+        for worker in (worker1, worker2):
+            worker.record_request('prices', 'GET', 200, 0.02, 2, 0.001)
+        worker1.record_cache_lookup('one_time_training', True)
+        worker1.flush(force=True)
+        lines = worker2.render().splitlines()
+        for line in (
+            'volleyballschool_http_requests_total{view="prices",'
+            'method="GET",status="200"} 2',
+            'volleyballschool_http_request_duration_seconds_bucket{'
+            'view="prices",le="0.01"} 0',
+            'volleyballschool_http_request_duration_seconds_bucket{'
+            'view="prices",le="0.025"} 2',
+            'volleyballschool_http_request_duration_seconds_bucket{'
+            'view="prices",le="+Inf"} 2',
+            'volleyballschool_db_queries_total{view="prices"} 4',
+            'volleyballschool_cache_lookups_total{'
+            'cache="one_time_training",result="hit"} 1',
+            'volleyballschool_metrics_workers 2',
+        ):
+            self.assertIn(line, lines)
+
+    def test_expired_workers_are_dropped(self):
+        worker1 = Metrics('worker1')
+        worker1.flush(force=True)
+        cache.delete(WORKER_CACHE_KEY.format('worker1'))  # истекли
+        worker2 = Metrics('worker2')
+        worker2.flush(force=True)
+        self.assertEqual(cache.get(WORKERS_CACHE_KEY), ['worker2'])
+
+    def test_flush_interval(self):
+        worker = Metrics('worker')
+        worker.record_request('prices', 'GET', 200, 0.02, 2, 0.001)
+        worker.flush()
+        worker.record_request('prices', 'GET', 200, 0.02, 2, 0.001)
+        worker.flush()
+        self.assertEqual(
+            cache.get(WORKER_CACHE_KEY.format('worker'))[
+                'http_request_duration_seconds_count', (('view', 'prices'),)
+            ],
+            1,
+        )
+
+    def test_metrics_page_is_not_public(self):
+        url = reverse('metrics')
+        response = self.client.get(url, REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 404)
+        staff = User.objects.create_user('staff', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(url, REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_ALLOWED_IPS=[])
+    def test_metrics_page_is_not_public_behind_a_local_proxy(self):
+        # за nginx на том же сервере все запросы приходят с 127.0.0.1
+        response = self.client.get(
+            reverse('metrics'), REMOTE_ADDR='127.0.0.1',
+            HTTP_X_FORWARDED_FOR='203.0.113.7',
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class QueryLogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+
+    def test_fingerprint(self):
+        for sql, expected in (
+            ('SELECT "t"."id" FROM "t"\n WHERE ("t"."id" IN (%s, %s, %s) '
+             'AND "t"."x" = 5) LIMIT 21',
+             'SELECT "t"."id" FROM "t" WHERE ("t"."id" IN (...) '
+             'AND "t"."x" = ?) LIMIT ?'),
+            ('SELECT * FROM "t" WHERE "t"."id" IN (%s)',
+             'SELECT * FROM "t" WHERE "t"."id" IN (...)'),
+            ('INSERT INTO "t" ("a", "b") VALUES (%s, %s), (%s, %s)',
+             'INSERT INTO "t" ("a", "b") VALUES (...)'),
+            ("SELECT * FROM t1 WHERE name = 'it''s' AND t1.price > 3.5",
+             'SELECT * FROM t1 WHERE name = ? AND t1.price > ?'),
+            ('SAVEPOINT "s140_x1"', 'SAVEPOINT ?'),
+        ):
+            with self.subTest(sql):
+                self.assertEqual(fingerprint(sql)[1], expected)
+        self.assertEqual(
+            fingerprint('SELECT * FROM "t" WHERE "t"."id" IN (%s)'),
+            fingerprint('SELECT * FROM "t" WHERE "t"."id" IN (%s, %s)'),
+        )
+
+    def test_slow_queries_are_logged_with_the_caller(self):
+        user = User.objects.create_user('test_user')
+        self.client.force_login(user)
+        with mock.patch.object(querylog, 'SLOW_QUERY_THRESHOLD', 0), \
+                self.assertLogs('volleyballschool.queries', 'WARNING') as log:
+            self.client.get(reverse('account'))
+        self.assertTrue(all(
+            message.startswith('WARNING:volleyballschool.queries:Slow query')
+            and ' in account at ' in message
+            for message in log.output
+        ))
+        self.assertTrue(any(
+            'volleyballschool/views.py:' in message
+            and 'in get_context_data' in message
+            for message in log.output
+        ), log.output)
+
+    def test_suspected_n_plus_one(self):
+        users = [User.objects.create_user('user{}'.format(number))
+                 for number in range(querylog.N_PLUS_ONE_THRESHOLD)]
+        request = RequestFactory().get('/')
+        recorder = QueryRecorder(request)
+        with connection.execute_wrapper(recorder):
+            for user in users:
+                User.objects.get(pk=user.pk)
+            Court.objects.count()
+        with self.assertLogs('volleyballschool.queries', 'WARNING') as log:
+            suspected = recorder.finish()
+        self.assertEqual(len(suspected), 1)
+        self.assertIn(
+            'Suspected N+1 in unmatched: {} queries SELECT'.format(
+                querylog.N_PLUS_ONE_THRESHOLD,
+            ),
+            log.output[0],
+        )
+        self.assertEqual(recorder.queries_qty,
+                         querylog.N_PLUS_ONE_THRESHOLD + 1)
+        self.assertEqual(recorder.fingerprints[suspected[0]][0],
+                         querylog.N_PLUS_ONE_THRESHOLD)
+
+    def test_fingerprint_metrics(self):
+        worker1 = Metrics('worker1')
+        worker2 = Metrics('worker2')
+        sql_fingerprint = fingerprint('SELECT * FROM "t" WHERE "t"."id" = %s')
+        worker1.record_queries('account', {sql_fingerprint: [6, 0.3, 0.2]},
+                               [sql_fingerprint])
+        worker2.record_queries('account', {sql_fingerprint: [1, 0.1, 0.1]},
+                               [])
+        worker1.flush(force=True)
+        lines = worker2.render().splitlines()
+        labels = '{{view="account",fingerprint="{}"}}'.format(
+            sql_fingerprint[0],
+        )
+        for line in (
+            'volleyballschool_db_fingerprint_queries_total{} 7'.format(
+                labels,
+            ),
+            'volleyballschool_db_fingerprint_duration_seconds_max{} '
+            '0.2'.format(labels),
+            'volleyballschool_db_suspected_n_plus_one_total{} 1'.format(
+                labels,
+            ),
+            'volleyballschool_db_fingerprint_info{{fingerprint="{}",'
+            'sql="SELECT * FROM \\"t\\" WHERE \\"t\\".\\"id\\" = ?"}} '
+            '1'.format(sql_fingerprint[0]),
+        ):
+            self.assertIn(line, lines)
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.profiling_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.profiling_dir)
+        settings_override = override_settings(
+            PROFILING_DIR=self.profiling_dir,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # файл управления перечитывается при каждом запросе
+        refresh_patch = mock.patch.object(profiling, 'REFRESH_INTERVAL', 0)
+        refresh_patch.start()
+        self.addCleanup(refresh_patch.stop)
+
+    def _get_dumps(self, view_name):
+        return list((self.profiling_dir / view_name).glob('*.prof'))
+
+    def test_profiling_is_off_by_default(self):
+        self.client.get(reverse('levels'))
+        self.assertEqual(list(self.profiling_dir.iterdir()), [])
+
+    def test_turn_on_report_and_turn_off(self):
+        out = StringIO()
+        call_command('profiling', 'on', '--every', '1', stdout=out)
+        call_command('profiling', 'status', stdout=out)
+        self.client.get(reverse('levels'))
+        self.client.get(reverse('levels'))
+        self.client.get('/no-such-page/')
+        self.assertEqual(len(self._get_dumps('levels')), 2)
+        self.assertEqual(len(self._get_dumps('unmatched')), 1)
+        call_command('profiling', 'report', 'levels', stdout=out)
+        report = (self.profiling_dir / 'levels' / 'report.txt').read_text()
+        self.assertIn('levels: 2 profiles', report)
+        self.assertIn('function calls', report)
+        call_command('profiling', 'off', stdout=out)
+        call_command('profiling', 'status', stdout=out)
+        self.client.get(reverse('levels'))
+        self.assertEqual(len(self._get_dumps('levels')), 2)
+        self.assertEqual(out.getvalue().splitlines()[1:], [
+            'Profiling is on: every 1 request(s)',
+            'levels: 2 profiles, {}'.format(
+                self.profiling_dir / 'levels' / 'report.txt',
+            ),
+            'Profiling is turned off',
+            'Profiling is off',
+        ])
+
+    def test_only_slow_requests_are_saved(self):
+        call_command('profiling', 'on', '--every', '1', '--slower-than',
+                     '60', stdout=StringIO())
+        self.client.get(reverse('levels'))
+        self.assertEqual(self._get_dumps('levels'), [])
+
+    def test_sampling(self):
+        call_command('profiling', 'on', '--every', '2', stdout=StringIO())
+        with mock.patch.object(profiling.random, 'random',
+                               side_effect=[0.3, 0.7, 0.1]):
+            for _ in range(3):
+                self.client.get(reverse('levels'))
+        self.assertEqual(len(self._get_dumps('levels')), 2)
+
+    def test_old_dumps_are_deleted(self):
+        call_command('profiling', 'on', '--every', '1', stdout=StringIO())
+        with mock.patch.object(profiling, 'MAX_DUMPS_PER_VIEW', 2):
+            for _ in range(3):
+                self.client.get(reverse('levels'))
+        self.assertEqual(len(self._get_dumps('levels')), 2)
+
+    def test_report_of_a_namespaced_view(self):
+        call_command('profiling', 'on', '--every', '1', stdout=StringIO())
+        self.client.get(reverse('admin:login'))
+        self.assertEqual(len(self._get_dumps('admin-login')), 1)
+        out = StringIO()
+        call_command('profiling', 'report', 'admin:login', stdout=out)
+        self.assertTrue(out.getvalue().startswith('admin-login: 1 profiles'))
+
+    def test_report_without_profiles(self):
+        with self.assertRaises(CommandError):
+            call_command('profiling', 'report', stdout=StringIO())
+
+
+@override_settings(METRICS_ALLOWED_IPS=['127.0.0.1'])
+class QueryBudgetTests(TestCase):
+    """Every page of volleyballschool.urls is requested on a small and on a
+    several times larger data set. A page fails if it runs more queries than
+    its budget or if the number of its queries grows with the data.
+    """
+
+    # url name: (max queries, login required)
+    BUDGETS = {
+        'index_page': (1, False),
+        'levels': (0, False),
+        'news': (2, False),
+        'coaches': (1, False),
+        'prices': (2, False),
+        'courts': (1, False),
+        'articles': (2, False),
+        'article-detail': (1, False),
+        'timetable-all': (1, False),
+        'timetable': (1, False),
+        'timetable-api': (1, False),
+        'register': (0, False),
+        'login': (0, False),
+        'logout': (4, True),
+        'buying-a-subscription': (3, True),
+        'success-buying-a-subscription': (6, True),
+        'registration-for-training': (5, True),
+        'account': (4, True),
+        'replenishment': (2, True),
+        'replenishment-success': (2, True),
+        'metrics': (0, False),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        # Set up data for the whole TestCase
+        OneTimeTraining.objects.create(price=900)
+        cls.user = User.objects.create_user('test_user', balance=10000)
+        cls.coach = Coach.objects.create(name='Тренер', description='',
+                                         active=True)
+        cls.article = Article.objects.create(
+            title='Статья', slug='article', short_description='',
+            text='', active=True)
+        cls.subscription_sample = SubscriptionSample.objects.create(
+            name='Абонемент', amount=900, trainings_qty=4, validity=30,
+            active=True)
+        cls.courts_created = 0
+        cls._seed(courts_qty=2, users_qty=3)
+        cls.training = Training.objects.filter(
+            skill_level=1).upcoming().order_by('start_at').first()
+        cls.subscription = cls.user.subscriptions.first()
+
+    @classmethod
+    def _seed(cls, courts_qty, users_qty):
+        """Add [courts_qty] courts with two weeks of trainings of every level
+        on every day and [users_qty] users registered for them, with
+        subscriptions. The request user gets a subscription and trainings
+        too.
+        """
+        today = datetime.date.today()
+        monday = today - datetime.timedelta(days=today.weekday())
+        courts = [
+            Court.objects.create(name='Зал {}'.format(cls.courts_created + i),
+                                 passport_required=False, active=True)
+            for i in range(courts_qty)
+        ]
+        cls.courts_created += courts_qty
+        trainings = []
+        for court in courts:
+            for day in range(14):
+                date = monday + datetime.timedelta(days=day)
+                for skill_level in (1, 2, 3):
+                    training = Training(
+                        day_of_week=date.isoweekday(),
+                        skill_level=skill_level,
+                        start_time=datetime.time(17 + skill_level),
+                        date=date,
+                        court=court,
+                        coach=cls.coach,
+                    )
+                    training.set_start_and_end()
+                    trainings.append(training)
+        Training.objects.bulk_create(trainings)
+        upcoming_trainings = list(Training.objects.filter(
+            court__in=courts, date__gt=today,
+        ).order_by('start_at', 'pk')[:8])
+        users = [cls.user] + [
+            User.objects.create_user('user{}'.format(User.objects.count()))
+            for _ in range(users_qty)
+        ]
+        News.objects.bulk_create([News(title='Новость')
+                                  for _ in range(courts_qty)])
+        for user in users:
+            subscription = Subscription.objects.create(
+                user=user, trainings_qty=10, validity=30)
+            subscription.trainings.add(*upcoming_trainings[:4])
+            user.trainings.add(*upcoming_trainings)
+
+    def _get_args(self, name):
+        return {
+            'article-detail': [self.article.slug],
+            'timetable': [1],
+            'timetable-api': [2],
+            'buying-a-subscription': [self.subscription_sample.pk],
+            'success-buying-a-subscription': [self.subscription.pk],
+            'registration-for-training': [self.training.pk],
+        }.get(name, [])
+
+    def _measure(self, name, login_required):
+        """Return the number of queries and the time of GET of the page."""
+        data = {'next': '/account/'} if name == 'replenishment-success' else {}
+        if login_required:
+            self.client.force_login(self.user)
+            if name == 'success-buying-a-subscription':
+                session = self.client.session
+                session['submitted'] = True
+                session.save()
+        else:
+            self.client.logout()
+        bump_schedule_version()  # расписание не должно браться из кэша
+        bump_prices_version()
+        url = reverse(name, args=self._get_args(name))
+        with CaptureQueriesContext(connection) as context:
+            started_at = time.perf_counter()
+            response = self.client.get(url, data)
+            elapsed = time.perf_counter() - started_at
+        self.assertLess(response.status_code, 400, url)
+        return len(context.captured_queries), elapsed
+
+    def _measure_all(self):
+        return {
+            name: self._measure(name, login_required)
+            for name, (_, login_required) in self.BUDGETS.items()
+        }
+
+    def test_every_url_has_a_budget(self):
+        url_names = {pattern.name for pattern in urls.urlpatterns}
+        self.assertEqual(url_names, set(self.BUDGETS))
+
+    def test_query_budgets(self):
+        small = self._measure_all()
+        self._seed(courts_qty=10, users_qty=15)
+        large = self._measure_all()
+        for name, (budget, _) in self.BUDGETS.items():
+            with self.subTest(name):
+                small_queries, small_time = small[name]
+                large_queries, large_time = large[name]
+                message = (
+                    '{}: {} queries ({:.3f}s) on small data, '
+                    '{} queries ({:.3f}s) on large data'.format(
+                        name, small_queries, small_time, large_queries,
+                        large_time,
+                    )
+                )
+                self.assertLessEqual(large_queries, budget, message)
+                self.assertEqual(small_queries, large_queries, message)
@@ -18,7 +18,9 @@ from .views import (AccountView, ArticleDetailView, ArticlesView,
                     IndexView, LevelsView, NewsView, PricesView,
                     RegisterUserView, RegistrationForTrainingView,
                     ReplenishmentSuccessView, ReplenishmentView,
-                    SuccessBuyingASubscriptionView, TimetableView, logout_user)
+                    SuccessBuyingASubscriptionView, TimetableAllLevelsView,
+                    TimetableAPIView, TimetableView, logout_user,
+                    show_metrics)
 
 urlpatterns = [
     path('', IndexView.as_view(), name='index_page'),
@@ -33,11 +35,21 @@ urlpatterns = [
         ArticleDetailView.as_view(),
         name='article-detail',
     ),
+    path(
+        'timetable/',
+        TimetableAllLevelsView.as_view(),
+        name='timetable-all',
+    ),
     re_path(
         r'^timetable/(?P<skill_level>[1-3]{1})/$',
         TimetableView.as_view(),
         name='timetable'
     ),
+    re_path(
+        r'^api/timetable/(?P<skill_level>[1-3]{1})/$',
+        TimetableAPIView.as_view(),
+        name='timetable-api'
+    ),
     path(
         'buying-a-subscription/<int:pk>/',
         BuyingASubscriptionView.as_view(),
@@ -70,4 +82,5 @@ urlpatterns = [
         name='replenishment-success',
     ),
     path('logout/', logout_user, name='logout'),
+    path('metrics', show_metrics, name='metrics'),
 ]
@@ -1,7 +1,65 @@
 import datetime
-from django.core.exceptions import ValidationError
+import functools
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import DateField, Func, Value
 from django.http import Http404
 
+from .metrics import record_cache_lookup
+
+SCHEDULE_VERSION_CACHE_KEY = 'volleyballschool:schedule-version'
+PRICES_VERSION_CACHE_KEY = 'volleyballschool:prices-version'
+TIMETABLE_CACHE_TIMEOUT = 60 * 60 * 24
+# границы параметров расписания: week - смещение первой недели от текущей,
+# weeks - количество недель
+TIMETABLE_DEFAULT_NUMBER_OF_WEEKS = 2
+TIMETABLE_MAX_NUMBER_OF_WEEKS = 6
+TIMETABLE_MIN_WEEK_OFFSET = -4
+TIMETABLE_MAX_WEEK_OFFSET = 8
+
+
+class AddDays(Func):
+    """Database function: the date [expression] plus [days] days.
+
+    Args:
+        expression: date expression, e.g. F('purchase_date')
+        days: number of days, int or expression, e.g. F('validity')
+    """
+
+    arity = 2
+    template = '(%(expressions)s)'
+    arg_joiner = ' + '
+
+    def __init__(self, expression, days, **extra):
+        if isinstance(days, int):
+            days = Value(days)
+        super().__init__(expression, days, output_field=DateField(), **extra)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler, connection,
+            template="date(%(expressions)s || ' days')",
+            arg_joiner=', ',
+            **extra_context
+        )
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler, connection,
+            template="(%(expressions)s * INTERVAL '1 day')::date",
+            **extra_context
+        )
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler, connection,
+            template='DATE_ADD(%(expressions)s DAY)',
+            arg_joiner=', INTERVAL ',
+            **extra_context
+        )
+
 
 def create_trainings_based_on_timeteble_for_x_days(
     timetable,
@@ -11,93 +69,186 @@ def create_trainings_based_on_timeteble_for_x_days(
 ):
     """Create trainings with certain date based on day of the week from
     timeteble for next x days from current date.
+    See create_trainings_based_on_timetables_for_x_days().
+
+    Returns:
+        [tuple]: number of created trainings, number of skipped trainings
+    """
+    return create_trainings_based_on_timetables_for_x_days(
+        [timetable], training_class, days, from_monday,
+    )
+
+
+def create_trainings_based_on_timetables_for_x_days(
+    timetables,
+    training_class,
+    days,
+    from_monday=False,
+):
+    """Create trainings with certain date based on day of the week from
+    each of timetables for next x days from current date.
+    Trainings which already exist (by the unique_training constraint:
+    skill level, court and date) are found by one query and skipped, the
+    rest are inserted by one bulk insert.
 
     Args:
-        timetable (django.db.models.Model): the model instance which provide
-        values except certain date
+        timetables (iterable): the model instances which provide values
+        except certain date
         training_class (django.db.models.Model):
             the model which new instance accept values from timetable and gets
             certain date.
         days (int): number of days from today for creating trainings
-
-    Raises:
-        e: Validation errors except Unique Constraint violation
+        from_monday (bool): count days from Monday of the current week
 
     Returns:
-        None
+        [tuple]: number of created trainings, number of skipped trainings
     """
     if from_monday:
-        date_list = [
-            _date_of_the_current_week_monday()
-            + datetime.timedelta(days=x) for x in range(days)
-        ]
-    elif not from_monday:
-        date_list = [
-            datetime.date.today()
-            + datetime.timedelta(days=x) for x in range(days)
-        ]
-    for day in date_list:
-        if timetable.day_of_week == day.isoweekday():
-            training_instance = training_class()
-            copy_same_fields(timetable, training_instance)
-            training_instance.date = day
-            try:
-                training_instance.full_clean(validate_unique=True)
-            except ValidationError as e:
-                if 'с такими значениями' in e.messages[0] \
-                        and 'уже существует' in e.messages[0]:
-                    continue  # f'Тренировка c датой {training.date} '
-                    # + f'в {training.court} '
-                    # + f'и на {training.get_skill_level_display()}'
-                    # + ' уже существует'
-                raise e
-            training_instance.save()
+        first_day = _date_of_the_current_week_monday()
+    else:
+        first_day = datetime.date.today()
+    date_list = [first_day + datetime.timedelta(days=x) for x in range(days)]
+    candidates = dict()
+    candidates_qty = 0
+    for timetable in timetables:
+        timetable_trainings = []
+        for day in date_list:
+            if timetable.day_of_week == day.isoweekday():
+                candidates_qty += 1
+                key = (timetable.skill_level, timetable.court_id, day)
+                if key in candidates:
+                    continue
+                candidates[key] = training_class(date=day)
+                timetable_trainings.append(candidates[key])
+        copy_same_fields_to_many(timetable, timetable_trainings)
+    if not candidates:
+        return 0, candidates_qty
+    existing_keys = set(
+        training_class.objects.filter(
+            skill_level__in={key[0] for key in candidates},
+            court_id__in={key[1] for key in candidates},
+            date__gte=date_list[0],
+            date__lte=date_list[-1],
+        ).values_list('skill_level', 'court_id', 'date')
+    )
+    new_trainings = [
+        training for key, training in candidates.items()
+        if key not in existing_keys
+    ]
+    if new_trainings:
+        for training in new_trainings:
+            training.set_start_and_end()
+        training_class.objects.bulk_create(new_trainings)
+        bump_schedule_version()
+    return len(new_trainings), candidates_qty - len(new_trainings)
+
+
+@functools.lru_cache(maxsize=None)
+def get_copy_plan(donor_model, acceptor_model):
+    """Return attribute names of concrete fields (except the primary key)
+    which exist in both models. Foreign keys are represented by their id
+    attributes (e.g. 'court_id'), so copying them does not load related
+    objects. The plan is computed once per pair of models.
+
+    Args:
+        donor_model (django.db.models.Model): the model which provide values
+        acceptor_model (django.db.models.Model):
+            the model which accept values
+
+    Returns:
+        [tuple]: attribute names
+    """
+    acceptor_attnames = {
+        field.attname for field in acceptor_model._meta.concrete_fields
+        if not field.primary_key
+    }
+    return tuple(
+        field.attname for field in donor_model._meta.concrete_fields
+        if not field.primary_key and field.attname in acceptor_attnames
+    )
 
 
 def copy_same_fields(donor, acceptor):
     """Copy field values from one django model instance to another django
-    model instance, if the field names are equal.(Except the 'id' field)
+    model instance, if the field names are equal.(Except the primary key)
 
     Args:
         donor (django.db.models.Model): the model instance which provide values
         acceptor (django.db.models.Model):
             the model instance which accept values
     """
+    for attname in get_copy_plan(type(donor), type(acceptor)):
+        setattr(acceptor, attname, getattr(donor, attname))
 
-    acceptor_field_names = []
-    acceptor_fields = acceptor._meta.get_fields()
-    for field in acceptor_fields:
-        acceptor_field_names.append(field.name)
-
-    donor_fields = donor._meta.get_fields()
 
-    for field in donor_fields:
-        if field.name != 'id' and field.name in acceptor_field_names:
-            field_value_from_donor = getattr(donor, field.name)
-            setattr(acceptor, field.name, field_value_from_donor)
+def copy_same_fields_to_many(donor, acceptors):
+    """Copy field values from one django model instance to each of
+    [acceptors], instances of the same model. See copy_same_fields().
+    """
+    acceptors = list(acceptors)
+    if not acceptors:
+        return
+    values = [
+        (attname, getattr(donor, attname)) for attname
+        in get_copy_plan(type(donor), type(acceptors[0]))
+    ]
+    for acceptor in acceptors:
+        for attname, value in values:
+            setattr(acceptor, attname, value)
 
 
-def get_start_date_and_end_date(number_of_weeks):
-    """Return the current week Monday date as start_date. And return Sunday
-    date of current+[number_of_weeks] week as end_date.
+def get_start_date_and_end_date(number_of_weeks, week_offset=0):
+    """Return the Monday date of the current week + [week_offset] weeks as
+    start_date. And return Sunday date of the [number_of_weeks]-th week from
+    start_date as end_date.
 
     Args:
         number_of_weeks ([int]): Number of weeks to display in the timetable
+        week_offset ([int]): Offset of the first week from the current week
 
     Returns:
         [datetime.date]: start_date, end_date
     """
-    start_date = _date_of_the_current_week_monday()
+    start_date = (_date_of_the_current_week_monday()
+                  + datetime.timedelta(days=7*week_offset))
     end_date = start_date + datetime.timedelta(days=7*number_of_weeks-1)
     return start_date, end_date
 
 
+def get_timetable_range(params):
+    """Return the week offset and the number of weeks of the timetable from
+    'week' and 'weeks' GET [params]. Missing or invalid values are replaced
+    with defaults, the values are clamped to the TIMETABLE_* bounds.
+
+    Returns:
+        [int]: week_offset, number_of_weeks
+    """
+    def get_int(name, default, min_value, max_value):
+        try:
+            value = int(params.get(name, default))
+        except (TypeError, ValueError):
+            value = default
+        return min(max(value, min_value), max_value)
+
+    week_offset = get_int(
+        'week', 0, TIMETABLE_MIN_WEEK_OFFSET, TIMETABLE_MAX_WEEK_OFFSET,
+    )
+    number_of_weeks = get_int(
+        'weeks', TIMETABLE_DEFAULT_NUMBER_OF_WEEKS, 1,
+        TIMETABLE_MAX_NUMBER_OF_WEEKS,
+    )
+    return week_offset, number_of_weeks
+
+
 def transform_for_timetable(query_set, start_date, number_of_weeks):
     """Group [query_set] by courts. For each court create dictionary with
     name of court and with lists in [number_of_weeks] quantity with seven
     elements. Each element of list is related to day of week. The element
     contains date, accessible by [date] key, and Training model object if
     it exist for that day.
+    Trainings are indexed once by (court id, date), so each cell of the
+    grid is filled by a dictionary lookup instead of rescanning [query_set].
+    Courts are ordered by id.
 
     Args:
         query_set: QuerySet
@@ -116,38 +267,257 @@ def transform_for_timetable(query_set, start_date, number_of_weeks):
      ],
     ]}
     """
-    courts = set()
+    courts = dict()
+    trainings_by_court_and_date = dict()
     for training in query_set:
-        courts.add(training.court)
+        courts.setdefault(training.court_id, training.court)
+        trainings_by_court_and_date.setdefault(
+            (training.court_id, training.date), training
+        )
+    dates = [
+        start_date + datetime.timedelta(n) for n
+        in range(7*number_of_weeks)
+    ]
     transformed_query_set = []
-    for court in courts:
+    for court_id in sorted(courts):
         trainigs_for_court = dict()
-        trainigs_for_court['name'] = court
-        trainigs_for_court['weeks'] = [[] for _ in range(number_of_weeks)]
-        for week_number in range(number_of_weeks):
-            for date in (
-                start_date + datetime.timedelta(n) for n
-                in range(7*week_number, 7*(week_number+1))
-            ):
-                for query in query_set:
-                    if query.date == date and query.court == court:
-                        trainigs_for_court['weeks'][week_number].append(
-                            query
-                        )
-                        break
-                else:
-                    trainigs_for_court['weeks'][week_number].append(
-                        {'date': date}
-                    )
+        trainigs_for_court['name'] = courts[court_id]
+        trainigs_for_court['weeks'] = [
+            [
+                trainings_by_court_and_date.get(
+                    (court_id, date), {'date': date}
+                )
+                for date in dates[7*week_number:7*(week_number+1)]
+            ]
+            for week_number in range(number_of_weeks)
+        ]
         transformed_query_set.append(trainigs_for_court)
     return transformed_query_set
 
 
-def get_upcoming_training_or_404(model, pk):
+def _get_version(version_key):
+    version = cache.get(version_key)
+    if version is None:
+        # начинаем с текущего времени, чтобы после вытеснения ключа из кэша
+        # не совпасть с одной из прежних версий
+        cache.add(version_key, time.time_ns(), timeout=None)
+        version = cache.get(version_key)
+    return version
+
+
+def _bump_version(version_key):
+    try:
+        cache.incr(version_key)
+    except ValueError:  # ключа нет в кэше
+        _get_version(version_key)
+
+
+def get_schedule_version():
+    """Return the current version of the schedule. The version is changed by
+    bump_schedule_version() whenever trainings, timetables or learners of
+    trainings are changed, so it is part of every timetable cache key.
+
+    Returns:
+        [int]
+    """
+    return _get_version(SCHEDULE_VERSION_CACHE_KEY)
+
+
+def bump_schedule_version():
+    """Invalidate all cached timetables."""
+    _bump_version(SCHEDULE_VERSION_CACHE_KEY)
+
+
+def get_prices_version():
+    """Return the current version of the prices (one-time training price and
+    subscription samples), see get_process_cached().
+
+    Returns:
+        [int]
+    """
+    return _get_version(PRICES_VERSION_CACHE_KEY)
+
+
+def bump_prices_version():
+    """Invalidate prices cached by get_process_cached() in all processes
+    which share the cache backend.
+    """
+    _bump_version(PRICES_VERSION_CACHE_KEY)
+
+
+_process_cache = {}
+
+
+def get_process_cached(name, loader):
+    """Return the result of [loader]() kept in the memory of the current
+    process. It is loaded again only after the prices version is changed by
+    bump_prices_version(), so a cache hit costs one read of the version from
+    the cache backend and no database queries. The version is shared by all
+    processes if the cache backend is shared.
+
+    Args:
+        name ([str]): name of the cached value
+        loader ([callable]): loads the value, the value must not be changed
+            by callers because it is shared between requests
+
+    Returns:
+        the result of [loader]()
+    """
+    version = get_prices_version()
+    cached = _process_cache.get(name)
+    hit = cached is not None and cached[0] == version
+    record_cache_lookup(name, hit)
+    if hit:
+        return cached[1]
+    value = loader()
+    _process_cache[name] = (version, value)
+    return value
+
+
+def get_cached_timetables(training_class, number_of_weeks, week_offset=0):
+    """Return transformed for timetable trainings of every skill level for
+    [number_of_weeks] weeks from the Monday of the current week +
+    [week_offset] weeks. Trainings of all levels are fetched by a single
+    start_at range query and grouped by level in one pass. The result is
+    cached by date range and schedule version, so it is queried from the
+    database only after the schedule changes, and it is shared by the pages
+    of all levels.
+
+    Args:
+        training_class (django.db.models.Model): the Training model
+        number_of_weeks ([int]): Number of weeks to display in the timetable
+        week_offset ([int]): Offset of the first week from the current week
+
+    Returns:
+        [dict]: {skill level: see transform_for_timetable()} for every skill
+        level of [training_class]
+    """
+    start_date, end_date = get_start_date_and_end_date(
+        number_of_weeks, week_offset,
+    )
+    cache_key = 'volleyballschool:timetables:{}:{}:{}'.format(
+        get_schedule_version(),
+        start_date.isoformat(),
+        number_of_weeks,
+    )
+    timetables = cache.get(cache_key)
+    record_cache_lookup('timetables', timetables is not None)
+    if timetables is None:
+        # диапазон по start_at, а не по date: индекс по start_at подходит
+        # для выборки без фильтра по уровню
+        query_set = training_class.objects.select_related(
+            'court', 'coach'
+        ).filter(
+            start_at__gte=start_date,
+            start_at__lt=end_date + datetime.timedelta(days=1),
+            active=True,
+        )
+        trainings_by_level = {
+            skill_level: [] for skill_level in training_class.SkillLevels
+        }
+        for training in query_set:
+            trainings_by_level.setdefault(
+                training.skill_level, []
+            ).append(training)
+        timetables = {
+            int(skill_level): transform_for_timetable(
+                query_set=trainings,
+                start_date=start_date,
+                number_of_weeks=number_of_weeks,
+            )
+            for skill_level, trainings in trainings_by_level.items()
+        }
+        cache.set(cache_key, timetables, TIMETABLE_CACHE_TIMEOUT)
+    return timetables
+
+
+def get_cached_timetable(training_class, skill_level, number_of_weeks,
+                         week_offset=0):
+    """Return transformed for timetable trainings of [skill_level] for
+    [number_of_weeks] weeks from the Monday of the current week +
+    [week_offset] weeks, taken from the snapshot of all levels returned by
+    get_cached_timetables().
+
+    Args:
+        training_class (django.db.models.Model): the Training model
+        skill_level ([int]): skill level of trainings
+        number_of_weeks ([int]): Number of weeks to display in the timetable
+        week_offset ([int]): Offset of the first week from the current week
+
+    Returns:
+        [list]: see transform_for_timetable()
+    """
+    timetables = get_cached_timetables(
+        training_class, number_of_weeks, week_offset,
+    )
+    return timetables.get(skill_level, [])
+
+
+def get_timetable_etag(skill_level, number_of_weeks, week_offset=0):
+    """Return the ETag of the timetable returned by get_cached_timetable()
+    for the same arguments. It is built from the schedule version and the
+    date range only, so it does not query the database.
+
+    Returns:
+        [str]
+    """
+    start_date, _ = get_start_date_and_end_date(number_of_weeks, week_offset)
+    return '{}-{}-{}-{}'.format(
+        get_schedule_version(),
+        skill_level,
+        start_date.isoformat(),
+        number_of_weeks,
+    )
+
+
+def serialize_timetable(timetable):
+    """Convert the result of transform_for_timetable() to JSON-serializable
+    data: a list of courts with weeks of days, each day with the date and
+    the training of the day or None.
+    """
+    return [
+        {
+            'id': court['name'].pk,
+            'name': court['name'].name,
+            'address': court['name'].address,
+            'metro': court['name'].metro,
+            'weeks': [
+                [_serialize_timetable_day(day) for day in week]
+                for week in court['weeks']
+            ],
+        }
+        for court in timetable
+    ]
+
+
+def _serialize_timetable_day(day):
+    if isinstance(day, dict):
+        return {'date': day['date'].isoformat(), 'training': None}
+    coach = None
+    if day.coach is not None:
+        coach = {'id': day.coach.pk, 'name': day.coach.name}
+    return {
+        'date': day.date.isoformat(),
+        'training': {
+            'id': day.pk,
+            'coach': coach,
+            'status': day.status,
+            'status_display': day.get_status_display(),
+            'start_time': day.start_time.isoformat(),
+            'start_at': day.start_at.isoformat(),
+            'end_at': day.end_at.isoformat(),
+            'free_places': day.get_free_places(),
+        },
+    }
+
+
+def get_upcoming_training_or_404(model, pk, user=None):
     """Return a training object by pk if training has not finished, else raise
     Http404.
-    Including select_related for field 'court' and prefetch_related for field
-    'learners'.
+    Including select_related for field 'court'. If [user] is given, the
+    training is annotated with is_registered (see
+    TrainingQuerySet.with_registration()) and fetched with a single query,
+    otherwise learners are prefetched.
 
     Raises:
         Http404
@@ -155,21 +525,33 @@ def get_upcoming_training_or_404(model, pk):
     Returns:
         [object]: the model object
     """
+    trainings = model.objects.select_related('court').upcoming()
+    if user is None:
+        trainings = trainings.prefetch_related('learners')
+    else:
+        trainings = trainings.with_registration(user)
     try:
-        training = model.objects.select_related(
-            'court'
-        ).prefetch_related(
-            'learners'
-        ).filter(
-            date__gte=datetime.date.today()
-        ).get(pk=pk)
+        training = trainings.get(pk=pk)
     except model.DoesNotExist:
         raise Http404()
-    if datetime.datetime.now() > training.get_end_datetime():
-        raise Http404()
     return training
 
 
+def is_registered_for_training(user, training):
+    """Return True if the [user] is a learner of the [training]. Uses the
+    is_registered annotation or the prefetched learners if the training has
+    them.
+    """
+    if hasattr(training, 'is_registered'):
+        return training.is_registered
+    learners = getattr(training, '_prefetched_objects_cache', {}).get(
+        'learners'
+    )
+    if learners is not None:
+        return any(learner.pk == user.pk for learner in learners)
+    return training.learners.filter(pk=user.pk).exists()
+
+
 def _date_of_the_current_week_monday():
     current_week_day = datetime.date.today().isoweekday()
     monday_of_the_current_week = (
@@ -180,16 +562,26 @@ def _date_of_the_current_week_monday():
 
 
 def cancel_registration_for_training(user, training, price_for_one_training):
+    """Cancel the registration of the [user] for the [training] if it starts
+    in more than an hour. The training is returned to the subscription it
+    was paid by, otherwise [price_for_one_training] is refunded to the
+    balance of the [user].
+    """
+    from .models import BalanceTransaction
+
     if (
-        user in training.learners.all()
+        is_registered_for_training(user, training)
         and training.is_more_than_an_hour_before_start()
     ):
-        subscription_of_user = (
-            training.subscription_set.filter(user=user).first()
-        )
-        if subscription_of_user:
-            subscription_of_user.trainings.remove(training)
-        else:
-            user.balance += price_for_one_training
-            user.save(update_fields=['balance'])
-        training.learners.remove(user)
+        with transaction.atomic():
+            subscription_of_user = (
+                training.subscription_set.filter(user=user).first()
+            )
+            if subscription_of_user:
+                subscription_of_user.trainings.remove(training)
+            else:
+                user.credit_balance(
+                    price_for_one_training,
+                    BalanceTransaction.Kinds.TRAINING_REFUND,
+                )
+            training.learners.remove(user)
@@ -1,21 +1,97 @@
 import datetime
+import uuid
 
+from django.conf import settings
 from django.contrib.auth import logout
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Prefetch
+from django.db import IntegrityError, transaction
+from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse_lazy
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django.views.generic import (CreateView, DetailView, ListView,
                                   TemplateView, View)
 
-from volleyballschool.utils import (cancel_registration_for_training,
-                                    copy_same_fields,
+from volleyballschool.utils import (TIMETABLE_MAX_WEEK_OFFSET,
+                                    TIMETABLE_MIN_WEEK_OFFSET,
+                                    cancel_registration_for_training,
+                                    copy_same_fields, get_cached_timetable,
+                                    get_cached_timetables,
                                     get_start_date_and_end_date,
-                                    transform_for_timetable)
+                                    get_timetable_etag, get_timetable_range,
+                                    serialize_timetable)
 
 from .forms import RegisterUserForm
-from .models import (Article, Coach, Court, News, OneTimeTraining,
-                     Subscription, SubscriptionSample, Training, User)
+from .metrics import metrics
+from .models import (Article, BalanceTransaction, Coach, Court,
+                     IdempotencyKey, News, OneTimeTraining, Subscription,
+                     SubscriptionSample, Training)
+
+
+class IdempotentPostMixin:
+    """Делает POST формы идемпотентным по скрытому полю idempotency_key.
+
+    Форма получает новый ключ в контексте (idempotency_key). Первый POST с
+    ключом сохраняет запись IdempotencyKey в отдельной короткой транзакции
+    до выполнения представления, поэтому блокировка записи в базу не
+    удерживается на всё время запроса. Адрес перенаправления сохраняется
+    вторым коротким запросом. Повторный POST с тем же ключом не выполняет
+    запросов на изменение данных и возвращает get_replayed_response(), а
+    пока первый запрос не завершён - перенаправляет на форму. POST без
+    ключа выполняется как обычно. Устаревшие ключи удаляет команда
+    deleteexpiredidempotencykeys.
+    Указывается в базовых классах представления после LoginRequiredMixin.
+    """
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['idempotency_key'] = uuid.uuid4().hex
+        return context
+
+    def dispatch(self, request, *args, **kwargs):
+        key = self._get_idempotency_key(request)
+        if request.method != 'POST' or key is None:
+            return super().dispatch(request, *args, **kwargs)
+        try:
+            with transaction.atomic():
+                idempotency_key = IdempotencyKey.objects.create(
+                    key=key, user=request.user,
+                )
+        except IntegrityError:
+            return self._replay(request, key)
+        try:
+            response = super().dispatch(request, *args, **kwargs)
+        except Exception:
+            # запрос не выполнен, ключ можно использовать повторно
+            idempotency_key.delete()
+            raise
+        response_url = getattr(response, 'url', '')
+        if response_url:
+            IdempotencyKey.objects.filter(pk=idempotency_key.pk).update(
+                response_url=response_url,
+            )
+        return response
+
+    def get_replayed_response(self, request, response_url):
+        return redirect(response_url)
+
+    def _get_idempotency_key(self, request):
+        key = request.POST.get('idempotency_key', '')
+        try:
+            return uuid.UUID(hex=key).hex
+        except ValueError:
+            return None
+
+    def _replay(self, request, key):
+        response_url = IdempotencyKey.objects.filter(
+            key=key, user=request.user,
+        ).values_list('response_url', flat=True).first()
+        if not response_url:
+            # ключ чужой, первый запрос ещё выполняется или не
+            # перенаправил пользователя
+            return redirect(request.path)
+        return self.get_replayed_response(request, response_url)
 
 
 class IndexView(ListView):
@@ -51,9 +127,8 @@ class PricesView(TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['subscription_samples'] = SubscriptionSample.objects.filter(
-            active=True)
-        context['one_time_training'] = OneTimeTraining.objects.first()
+        context['subscription_samples'] = SubscriptionSample.get_active()
+        context['one_time_training'] = OneTimeTraining.get_cached()
         return context
 
 
@@ -79,41 +154,123 @@ class ArticleDetailView(DetailView):
     context_object_name = 'article'
 
 
-class TimetableView(ListView):
+class TimetableRangeMixin:
+    """Диапазон недель страниц расписания из GET-параметров week (смещение
+    первой недели от текущей) и weeks (количество недель), ограниченных
+    get_timetable_range(), и навигация по неделям в контексте.
+    """
+
+    skill_levels_list = {
+        1: 'для начального уровня',
+        2: 'для уровня начальный+',
+        3: 'для среднего уровня',
+    }
+
+    def setup(self, request, *args, **kwargs):
+        super().setup(request, *args, **kwargs)
+        self.week_offset, self.number_of_weeks = get_timetable_range(
+            request.GET,
+        )
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['datetime_now'] = datetime.datetime.now()
+        context['start_date'], context['end_date'] = (
+            get_start_date_and_end_date(
+                self.number_of_weeks, self.week_offset,
+            )
+        )
+        context['number_of_weeks'] = self.number_of_weeks
+        if self.week_offset > TIMETABLE_MIN_WEEK_OFFSET:
+            context['previous_week'] = self.week_offset - 1
+        if self.week_offset < TIMETABLE_MAX_WEEK_OFFSET:
+            context['next_week'] = self.week_offset + 1
+        return context
+
+
+class TimetableView(TimetableRangeMixin, ListView):
 
     template_name = 'volleyballschool/timetable.html'
     context_object_name = 'trainings'
 
     def get_queryset(self):
-        number_of_weeks = 2
-        start_date, end_date = get_start_date_and_end_date(number_of_weeks)
-        query_set = Training.objects.select_related('court', 'coach').filter(
+        transformed_query_set = get_cached_timetable(
+            training_class=Training,
             skill_level=int(self.kwargs['skill_level']),
-            date__gte=start_date,
-            date__lte=end_date,
-            active=True,
-        )
-        transformed_query_set = transform_for_timetable(
-            query_set=query_set,
-            start_date=start_date,
-            number_of_weeks=number_of_weeks,
+            number_of_weeks=self.number_of_weeks,
+            week_offset=self.week_offset,
         )
         return transformed_query_set
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         skill_level_selector = int(self.kwargs['skill_level'])
-        skill_levels_list = {
-            1: 'для начального уровня',
-            2: 'для уровня начальный+',
-            3: 'для среднего уровня',
-        }
-        context['skill_level'] = skill_levels_list[skill_level_selector]
-        context['datetime_now'] = datetime.datetime.now()
+        context['skill_level'] = self.skill_levels_list[skill_level_selector]
+        context['skill_level_number'] = skill_level_selector
         return context
 
 
-class BuyingASubscriptionView(LoginRequiredMixin, DetailView):
+class TimetableAllLevelsView(TimetableRangeMixin, TemplateView):
+    """Расписание всех уровней на одной странице. Использует тот же
+    кэшированный снимок расписания, что и страницы отдельных уровней.
+    """
+
+    template_name = 'volleyballschool/timetable-all.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        timetables = get_cached_timetables(
+            training_class=Training,
+            number_of_weeks=self.number_of_weeks,
+            week_offset=self.week_offset,
+        )
+        context['timetables'] = [
+            {
+                'skill_level': skill_level,
+                'name': self.skill_levels_list[skill_level],
+                'trainings': timetables.get(skill_level, []),
+            }
+            for skill_level in self.skill_levels_list
+        ]
+        return context
+
+
+def _get_timetable_api_etag(request, skill_level):
+    week_offset, number_of_weeks = get_timetable_range(request.GET)
+    return get_timetable_etag(int(skill_level), number_of_weeks, week_offset)
+
+
+@method_decorator(condition(etag_func=_get_timetable_api_etag), name='get')
+class TimetableAPIView(View):
+    """Расписание уровня skill_level в JSON: те же данные и GET-параметры,
+    что у TimetableView. ETag строится по версии расписания, поэтому на
+    запрос с актуальным If-None-Match отвечает 304 без запросов к базе.
+    """
+
+    def get(self, request, *args, **kwargs):
+        skill_level = int(self.kwargs['skill_level'])
+        week_offset, number_of_weeks = get_timetable_range(request.GET)
+        start_date, end_date = get_start_date_and_end_date(
+            number_of_weeks, week_offset,
+        )
+        timetable = get_cached_timetable(
+            training_class=Training,
+            skill_level=skill_level,
+            number_of_weeks=number_of_weeks,
+            week_offset=week_offset,
+        )
+        return JsonResponse({
+            'skill_level': skill_level,
+            'start_date': start_date.isoformat(),
+            'end_date': end_date.isoformat(),
+            'week': week_offset,
+            'number_of_weeks': number_of_weeks,
+            'courts': serialize_timetable(timetable),
+        })
+
+
+class BuyingASubscriptionView(LoginRequiredMixin, IdempotentPostMixin,
+                              DetailView):
 
     template_name = 'volleyballschool/buying-a-subscription.html'
     context_object_name = 'subscription_sample'
@@ -129,20 +286,27 @@ class BuyingASubscriptionView(LoginRequiredMixin, DetailView):
     def post(self, request, *args, **kwargs):
         if request.POST.get('confirm', False):
             subscription_sample = self.get_object()
-            if request.user.balance >= subscription_sample.amount:
-                subscription = Subscription()
-                copy_same_fields(subscription_sample, subscription)
-                subscription.user = request.user
-                subscription.purchase_date = datetime.date.today()
-                subscription.save()
-                request.user.balance -= subscription_sample.amount
-                request.user.save(update_fields=['balance'])
-                request.session['submitted'] = True
-                return redirect(
-                    'success-buying-a-subscription', subscription.id
-                )
+            with transaction.atomic():
+                if request.user.debit_balance(
+                    subscription_sample.amount,
+                    BalanceTransaction.Kinds.SUBSCRIPTION_PURCHASE,
+                ):
+                    subscription = Subscription()
+                    copy_same_fields(subscription_sample, subscription)
+                    subscription.user = request.user
+                    subscription.purchase_date = datetime.date.today()
+                    subscription.save()
+                    request.session['submitted'] = True
+                    return redirect(
+                        'success-buying-a-subscription', subscription.id
+                    )
         return redirect('buying-a-subscription', self.kwargs['pk'])
 
+    def get_replayed_response(self, request, response_url):
+        # страница успешной покупки открывается только после покупки
+        request.session['submitted'] = True
+        return super().get_replayed_response(request, response_url)
+
 
 class SuccessBuyingASubscriptionView(LoginRequiredMixin, View):
 
@@ -162,34 +326,39 @@ class SuccessBuyingASubscriptionView(LoginRequiredMixin, View):
         return redirect('prices')
 
 
-class RegistrationForTrainingView(LoginRequiredMixin, DetailView):
+class RegistrationForTrainingView(LoginRequiredMixin, IdempotentPostMixin,
+                                  DetailView):
 
     template_name = 'volleyballschool/registration-for-training.html'
     context_object_name = 'training'
 
     def get_object(self):
-        training = Training.get_upcoming_training_or_404(self.kwargs['pk'])
+        training = Training.get_upcoming_training_or_404(
+            self.kwargs['pk'], self.request.user,
+        )
         return training
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         user = self.request.user
-        if user in self.object.learners.all():
+        if self.object.is_registered:
             context['already_registered'] = True
         training_date = self.object.date
         context['subscription_of_user'] = user.get_first_active_subscription(
             training_date,
         )
         context['price_for_one_training'] = (
-                        OneTimeTraining.objects.first().price
+                        OneTimeTraining.get_cached().price
                     )
         return context
 
     def post(self, request, *args, **kwargs):
         user = request.user
-        training = Training.get_upcoming_training_or_404(self.kwargs['pk'])
+        training = Training.get_upcoming_training_or_404(
+            self.kwargs['pk'], user,
+        )
         if (request.POST.get('confirm', False)
-                and user not in training.learners.all()):
+                and not training.is_registered):
             # запись на тренировку
             if training.get_free_places() > 0:
                 if request.POST.get('payment_by', False) == 'subscription':
@@ -199,19 +368,26 @@ class RegistrationForTrainingView(LoginRequiredMixin, DetailView):
                         )
                     )
                     if subscription_of_user:
-                        training.learners.add(user)
-                        subscription_of_user.trainings.add(training)
+                        with transaction.atomic():
+                            if training.add_learner(user):
+                                subscription_of_user.trainings.add(training)
                 elif request.POST.get('payment_by', False) == 'balance':
                     price_for_one_training = (
-                        OneTimeTraining.objects.first().price
+                        OneTimeTraining.get_cached().price
                     )
-                    if user.balance >= price_for_one_training:
-                        training.learners.add(user)
-                        user.balance -= price_for_one_training
-                        user.save(update_fields=['balance'])
+                    with transaction.atomic():
+                        if (
+                            training.add_learner(user)
+                            and not user.debit_balance(
+                                price_for_one_training,
+                                BalanceTransaction.Kinds.TRAINING_PAYMENT,
+                            )
+                        ):
+                            # недостаточно средств, запись отменяется
+                            transaction.set_rollback(True)
             return redirect('registration-for-training', self.kwargs['pk'])
         if request.POST.get('cancel', False):
-            price_for_one_training = (OneTimeTraining.objects.first().price)
+            price_for_one_training = OneTimeTraining.get_cached().price
             cancel_registration_for_training(user, training,
                                              price_for_one_training)
         return redirect('registration-for-training', self.kwargs['pk'])
@@ -224,26 +400,19 @@ class AccountView(LoginRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         year_ago = datetime.date.today() - datetime.timedelta(days=365)
-        last_year_subscriptions = (
-            Subscription.objects.prefetch_related('trainings').filter(
-                purchase_date__gte=year_ago).order_by('purchase_date')
-        )
-        prefetch_subscriptions = Prefetch(
-            'subscriptions', queryset=last_year_subscriptions)
-        upcoming_trainings = Training.objects.select_related(
-            'court').filter(date__gte=datetime.date.today())
-        prefetch_trainings = Prefetch(
-            'trainings', queryset=upcoming_trainings)
-        user_pk = self.request.user.pk
-        user = User.objects.prefetch_related(
-            prefetch_trainings, prefetch_subscriptions).get(pk=user_pk)
-        user_upcoming_trainings = user.trainings.all()
-        context['user_upcoming_trainings'] = user_upcoming_trainings
-        user_last_year_subscriptions = user.subscriptions.all()[:3]
+        user = self.request.user
+        # даты, остаток тренировок и действительность абонементов
+        # вычисляются в одном запросе, тренировки - во втором
+        user_last_year_subscriptions = Subscription.objects.filter(
+            user=user, purchase_date__gte=year_ago,
+        ).with_activity().order_by('purchase_date')[:3]
+        context['user_upcoming_trainings'] = Training.objects.filter(
+            learners=user,
+        ).select_related('court').upcoming().order_by('start_at')
         user_active_subscriptions = []
         last_not_active_subscription = None
         for subscription in user_last_year_subscriptions:
-            if subscription.is_active():
+            if subscription.currently_active:
                 user_active_subscriptions.append(subscription)
             else:
                 last_not_active_subscription = subscription
@@ -254,8 +423,8 @@ class AccountView(LoginRequiredMixin, TemplateView):
     def post(self, request, *args, **kwargs):
         if request.POST.get('cancel', False):
             training = Training.get_upcoming_training_or_404(
-                request.POST.get('pk', None))
-            price_for_one_training = (OneTimeTraining.objects.first().price)
+                request.POST.get('pk', None), request.user)
+            price_for_one_training = OneTimeTraining.get_cached().price
             cancel_registration_for_training(request.user, training,
                                              price_for_one_training)
         return redirect('account')
@@ -273,15 +442,18 @@ class RegisterUserView(CreateView):
         return super().get(request, *args, **kwargs)
 
 
-class ReplenishmentView(LoginRequiredMixin, TemplateView):
+class ReplenishmentView(LoginRequiredMixin, IdempotentPostMixin,
+                        TemplateView):
 
     template_name = 'volleyballschool/replenishment.html'
 
     def post(self, request, *args, **kwargs):
         user = request.user
         if request.POST.get('replenishment_by', False) == 'test':
-            user.balance += int(request.POST.get('amount', 0))
-            user.save(update_fields=['balance'])
+            user.credit_balance(
+                int(request.POST.get('amount', 0)),
+                BalanceTransaction.Kinds.REPLENISHMENT,
+            )
             url = (reverse_lazy('replenishment-success')
                    + '?next=' + request.POST.get('next', None))
             return redirect(url)
@@ -301,3 +473,18 @@ class ReplenishmentSuccessView(LoginRequiredMixin, TemplateView):
 def logout_user(request):
     logout(request)
     return redirect('login')
+
+
+def show_metrics(request):
+    """Метрики всех процессов в текстовом формате Prometheus, см.
+    volleyballschool.metrics. Доступны с адресов из METRICS_ALLOWED_IPS и
+    сотрудникам, остальным отвечает 404. Адрес проверяется первым, чтобы
+    запрос сборщика метрик не обращался к базе за сессией.
+    """
+    if (request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS
+            and not request.user.is_staff):
+        raise Http404
+    return HttpResponse(
+        metrics.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )